@@ -1 +1,17 @@
-from hmdcquotas import HMDCQuotas
\ No newline at end of file
+from hmdcquotas import HMDCQuotas
+from aio import AsyncHMDCQuotas, QuotaDispatcher, QuotaFuture, gather
+from analytics import QuotaAnalytics
+from cache import QuotaCache
+from daemon import QuotaClient, QuotaDaemon
+from index import QuotaIndex
+from journal import QuotaJournal
+from locality import QuotaLocality
+from metrics import LatencyHistogram, ZapiMetrics
+from resilience import CircuitBreaker
+from results import QuotaEntry, QuotaRecord, QuotaUsage, ResizeJob
+from results import SearchResults
+from shard import ShardedQuotas
+from snapshot import QuotaSnapshot
+from topology import QuotaTopology
+from transport import ZapiConnectionPool, ZapiTransport
+from watch import QuotaWatch
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+from hmdcquotas import HMDCQuotas
+from results import SearchResults
+import collections
+import sys
+import threading
+import traceback
+
+
+class QuotaFuture:
+    """Handle for the eventual result of a dispatched quota call.
+
+    Example:
+        future = aqh.group_lookup(group, policy, volume, vserver)
+        future.add_done_callback(handle_entry)
+        entry = future.result(timeout=30)
+
+    Public Functions:
+        add_done_callback: Calls a function with the future once it is done.
+        done: Reports whether the call has finished.
+        exception: Returns the exception raised by the call, if any.
+        result: Waits for and returns the result of the call.
+        set_exception: Completes the future with an exception.
+        set_result: Completes the future with a result.
+    """
+
+    def __init__(self):
+        """Creates a pending future."""
+
+        self._callbacks = []
+        self._done = threading.Event()
+        self._exc_info = None
+        self._lock = threading.Lock()
+        self._result = None
+
+    def _finish(self):
+        """Marks the future done and runs the callbacks."""
+
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                # A broken callback must not take down a dispatcher thread.
+                traceback.print_exc()
+
+    def add_done_callback(self, callback):
+        """Calls a function with the future once it is done.
+
+        The callback runs on the dispatcher thread that completed the call,
+        or immediately if the future is already done.
+
+        Arguments:
+            callback (function): Called with this future as its argument.
+        """
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def done(self):
+        """Reports whether the call has finished.
+
+        Returns:
+            (boolean): True once a result or exception is set.
+        """
+
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the call, if any.
+
+        Arguments:
+            timeout (float): Seconds to wait; forever if None.
+
+        Returns:
+            (instance/None): The exception, or None on success.
+        """
+
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for quota call.")
+
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self, timeout=None):
+        """Waits for and returns the result of the call.
+
+        Arguments:
+            timeout (float): Seconds to wait; forever if None.
+
+        Returns:
+            (object): Whatever the dispatched call returned.
+
+        Raises:
+            RuntimeError: On timeout; otherwise the call's own exception.
+        """
+
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for quota call.")
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def set_exception(self, exc_info):
+        """Completes the future with an exception.
+
+        Arguments:
+            exc_info (tuple): sys.exc_info() of the failure.
+        """
+
+        self._exc_info = exc_info
+        self._finish()
+
+    def set_result(self, result):
+        """Completes the future with a result.
+
+        Arguments:
+            result (object): Return value of the call.
+        """
+
+        self._result = result
+        self._finish()
+
+
+class QuotaDispatcher:
+    """Runs queued quota calls on a fixed set of threads, per-SVM limited.
+
+    Calls are queued per vserver and handed out round-robin to max_workers
+    threads, never running more than svm_workers at once on one vserver, so
+    any number of calls can be in flight without a thread per call.
+
+    Public Functions:
+        close: Stops the dispatcher threads once the queue drains.
+        submit: Queues a call and returns its QuotaFuture.
+    """
+
+    def __init__(self, max_workers, svm_workers):
+        """Starts the dispatcher threads.
+
+        Arguments:
+            max_workers (int): Number of dispatcher threads.
+            svm_workers (int): Concurrent calls allowed per vserver.
+        """
+
+        self.svm_workers = svm_workers
+        self._closed = False
+        self._cond = threading.Condition()
+        self._order = collections.deque()
+        self._pending = {}
+        self._running = collections.defaultdict(int)
+        self._threads = []
+
+        for number in range(max_workers):
+            thread = threading.Thread(target=self._work,
+                                      name="QuotaDispatcher-" + str(number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        """Pops the next runnable call; the condition must be held.
+
+        Returns:
+            (tuple/None): (vserver, future, function, args), or None if every
+                          queued vserver is at its limit.
+        """
+
+        for _ in range(len(self._order)):
+            vserver = self._order[0]
+            self._order.rotate(-1)
+            if self._running[vserver] >= self.svm_workers:
+                continue
+            queue = self._pending[vserver]
+            call = queue.popleft()
+            if not queue:
+                del self._pending[vserver]
+                self._order.remove(vserver)
+            self._running[vserver] += 1
+            return (vserver,) + call
+
+        return None
+
+    def _work(self):
+        """Dispatcher thread body: runs calls until closed and drained."""
+
+        while True:
+            with self._cond:
+                call = self._next()
+                while call is None:
+                    if self._closed and not self._pending:
+                        return
+                    self._cond.wait()
+                    call = self._next()
+
+            vserver, future, function, args = call
+            try:
+                result = function(*args)
+            except Exception:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running[vserver] -= 1
+                    self._cond.notify_all()
+
+    def close(self):
+        """Stops the dispatcher threads once the queue drains."""
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, vserver, function, *args):
+        """Queues a call and returns its QuotaFuture.
+
+        Arguments:
+            args (objects): Arguments for the function.
+            function (function): The blocking call to run.
+            vserver (string): The vserver the call talks to.
+
+        Returns:
+            (instance): QuotaFuture of the call.
+        """
+
+        future = QuotaFuture()
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("QuotaDispatcher is closed.")
+            if vserver not in self._pending:
+                self._pending[vserver] = collections.deque()
+                self._order.append(vserver)
+            self._pending[vserver].append((future, function, args))
+            self._cond.notify()
+
+        return future
+
+
+def gather(futures):
+    """Combines many futures into one that completes when all have.
+
+    Arguments:
+        futures (list): QuotaFuture objects.
+
+    Returns:
+        (instance): QuotaFuture of the list of results, in the same order;
+                    fails with the first exception encountered.
+    """
+
+    combined = QuotaFuture()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    if not futures:
+        combined.set_result([])
+        return combined
+
+    def _one_done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if not last or combined.done():
+            return
+        for item in futures:
+            if item.exception() is not None:
+                combined.set_exception(item._exc_info)
+                return
+        combined.set_result([item.result() for item in futures])
+
+    for future in futures:
+        future.add_done_callback(_one_done)
+
+    return combined
+
+
+class AsyncHMDCQuotas:
+    """Non-blocking counterpart of HMDCQuotas.
+
+    Every call returns a QuotaFuture at once; the NetApp work runs on a
+    shared QuotaDispatcher, so one caller can keep hundreds of lookups in
+    flight with only max_workers threads and svm_workers calls per SVM.
+
+    Example:
+        aqh = AsyncHMDCQuotas()
+        futures = [aqh.search_vservers(group, policy) for group in groups]
+        results = gather(futures).result()
+
+    Public Functions:
+        close: Drains the dispatcher and closes the handler.
+        group_lookup: Queries a group on a specific volume.
+        modify: Executes an add/delete/modify query.
+        resize: Commits all quota changes on a volume.
+        search_vservers: Finds group quota on any vserver/volume combination.
+        search_volumes: Finds group quota on any volume in a vserver.
+    """
+
+    def __init__(self, handler=None, **kwargs):
+        """Wraps an HMDCQuotas handler and starts the dispatcher.
+
+        Arguments:
+            handler (instance): HMDCQuotas to use; one is built if None.
+            kwargs (dictionary): HMDCQuotas arguments when building one.
+        """
+
+        if handler is None:
+            handler = HMDCQuotas(**kwargs)
+
+        self.handler = handler
+        self.dispatcher = QuotaDispatcher(handler.options['max_workers'],
+                                          handler.options['svm_workers'])
+
+    def _collect(self, futures):
+        """Folds per-volume lookup futures into one matches future.
+
+        Arguments:
+            futures (list): QuotaFuture objects of QuotaEntry results.
+
+        Returns:
+            (instance): QuotaFuture of SearchResults keyed by vserver, then
+                        volume.
+        """
+
+        combined = QuotaFuture()
+
+        def _merge(gathered):
+            if gathered.exception() is not None:
+                combined.set_exception(gathered._exc_info)
+                return
+            combined.set_result(self.handler._search_fold(gathered.result()))
+
+        gather(futures).add_done_callback(_merge)
+        return combined
+
+    def close(self):
+        """Drains the dispatcher and closes the handler."""
+
+        self.dispatcher.close()
+        self.handler.close()
+
+    def group_lookup(self, group, policy, volume, vserver):
+        """Queries the NetApp for a group on a specific vserver/volume.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            volume (string): The volume where the group quota resides.
+            vserver (string): The vserver the volume lives on.
+
+        Returns:
+            (instance): QuotaFuture of the QuotaEntry.
+        """
+
+        return self.dispatcher.submit(vserver, self.handler.group_lookup,
+                                      group, policy, volume, vserver)
+
+    def modify(self, action, group, volume, vserver, policy, disk_limit=None,
+               file_limit=None, resize=True):
+        """Preps disk and file quotas, then executes add/delete/modify queries.
+
+        Arguments:
+            action (string): Type of NetApp query.
+            disk_limit (int): Group disk quota with unit.
+            file_limit (int): Number of maximum files allowed for the group.
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            resize (boolean): Commit with a quota resize.
+            volume (string): The volume where the group quota resides.
+            vserver (string): The vserver the volume lives on.
+
+        Returns:
+            (instance): QuotaFuture of the QuotaEntry.
+        """
+
+        return self.dispatcher.submit(vserver, self.handler.modify, action,
+                                      group, volume, vserver, policy,
+                                      disk_limit, file_limit, resize)
+
+    def resize(self, volume, vserver):
+        """Performs a quota resize to commit all quota changes on a volume.
+
+        Arguments:
+            volume (string): The volume to resize.
+            vserver (string): The vserver the volume lives on.
+
+        Returns:
+            (instance): QuotaFuture of the QuotaEntry for the volume.
+        """
+
+        return self.dispatcher.submit(vserver, self.handler._netapp_resize,
+                                      volume, vserver)
+
+    def search_vservers(self, group, policy, volume=None):
+        """Finds group quota on any vserver/volume combination.
+
+        Each volume is an independent lookup on the dispatcher.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            volume (string): The volume where the group quota resides.
+
+        Returns:
+            (instance): QuotaFuture of the matches dictionary, or of False
+                        if the volume is unknown.
+        """
+
+        if volume is None:
+            targets = [(name, vserver)
+                       for vserver, volumes in
+                       self.handler.VOLUMES.iteritems()
+                       for name in volumes]
+        else:
+            vserver = self.handler.get_vserver(volume)
+            if not vserver:
+                future = QuotaFuture()
+                future.set_result(False)
+                return future
+            targets = [(volume, vserver)]
+
+        return self._collect([self.group_lookup(group, policy, name, vserver)
+                              for name, vserver in targets])
+
+    def search_volumes(self, group, policy, vserver):
+        """Finds group quota on any volume in a specific vserver.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            vserver (string): The vserver to search.
+
+        Returns:
+            (instance): QuotaFuture of the matches dictionary for the vserver.
+        """
+
+        combined = QuotaFuture()
+        found = self._collect([self.group_lookup(group, policy, name, vserver)
+                               for name in
+                               self.handler.VOLUMES.get(vserver, ())])
+
+        def _unwrap(future):
+            if future.exception() is not None:
+                combined.set_exception(future._exc_info)
+            else:
+                matches = future.result()
+                combined.set_result(SearchResults(matches.get(vserver, {}),
+                                                  matches.unreachable))
+
+        found.add_done_callback(_unwrap)
+        return combined
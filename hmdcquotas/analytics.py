@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Fleet-wide capacity analytics over quota rules and usage.
+
+Every rule and usage row is loaded once into NumPy arrays of raw KB, and
+each aggregate is one vectorized pass over the whole fleet. Nothing is
+humanized here; callers format the numbers for display.
+
+    analytics = QuotaAnalytics.from_handler(qh)
+    analytics.overcommit()
+    analytics.top(10)
+    analytics.percentiles((50, 90, 99))
+
+NumPy is optional for the rest of the package; only QuotaAnalytics needs it.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Orderings top() accepts.
+TOP_KEYS = ('disk_used', 'files_used', 'utilization')
+
+
+class QuotaAnalytics:
+    """Columnar view of every quota rule and usage row in the fleet.
+
+    Public Functions:
+        from_handler: Loads a live handler or daemon client (class method).
+        from_snapshot: Loads an offline snapshot (class method).
+        overcommit: Compares the disk limits of each volume with its size.
+        percentiles: Returns utilization percentiles of the usage rows.
+        summary: Returns fleet-wide totals.
+        top: Returns the largest consumers.
+
+    Private Functions:
+        _code: Returns the integer code of a volume.
+        _on_volume: Returns which usage rows belong to a volume.
+        _utilization: Returns disk used over disk limit of each usage row.
+
+    Instance Variables:
+        sizes (array): Size of each volume in KB; 0 if unknown.
+        volumes (list): (volume, vserver) of each volume code.
+    """
+
+    def __init__(self, rules, usage, sizes=None):
+        """Loads rules and usage into columns.
+
+        Arguments:
+            rules (iterable): QuotaEntry of each rule.
+            sizes (dictionary): {vserver: {volume: size in KB}}.
+            usage (iterable): QuotaUsage of each group usage row.
+
+        Raises:
+            ImportError: When NumPy is not installed.
+        """
+
+        if numpy is None:
+            raise ImportError("Quota analytics require NumPy")
+
+        self.volumes = []
+        self._codes = {}
+
+        rules = list(rules)
+        self._rule_volume = numpy.array(
+            [self._code(entry.volume, entry.vserver) for entry in rules],
+            dtype=numpy.int32)
+        # An unlimited rule commits no space, so it counts as 0.
+        self._rule_disk = numpy.array(
+            [entry.disk_limit or 0 for entry in rules], dtype=numpy.int64)
+
+        usage = [record for record in usage if record.quota_type == 'group']
+        self._target = numpy.array([record.target for record in usage],
+                                   dtype=object)
+        self._usage_volume = numpy.array(
+            [self._code(record.volume, record.vserver) for record in usage],
+            dtype=numpy.int32)
+        self._disk_used = numpy.array(
+            [record.disk_used or 0 for record in usage], dtype=numpy.int64)
+        self._disk_limit = numpy.array(
+            [record.disk_limit or 0 for record in usage], dtype=numpy.int64)
+        self._files_used = numpy.array(
+            [record.files_used or 0 for record in usage], dtype=numpy.int64)
+
+        for vserver, volumes in (sizes or {}).iteritems():
+            for volume in volumes:
+                self._code(volume, vserver)
+
+        self.sizes = numpy.zeros(len(self.volumes), dtype=numpy.int64)
+        for vserver, volumes in (sizes or {}).iteritems():
+            for volume, size in volumes.iteritems():
+                self.sizes[self._codes[(volume, vserver)]] = size or 0
+
+    @classmethod
+    def from_handler(cls, handler):
+        """Loads a live handler: one report and one rule scan per volume.
+
+        Arguments:
+            handler (instance): HMDCQuotas, ShardedQuotas or QuotaClient to
+                                read from.
+
+        Returns:
+            (instance): QuotaAnalytics of the whole fleet.
+
+        Raises:
+            RuntimeError: When a scan fails.
+        """
+
+        return cls(handler.entries(), handler.report(),
+                   handler.volume_sizes())
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Loads an offline snapshot.
+
+        Arguments:
+            snapshot (instance): QuotaSnapshot to read from.
+
+        Returns:
+            (instance): QuotaAnalytics as of the snapshot.
+        """
+
+        return cls(snapshot.entries(), snapshot.usage(),
+                   snapshot.volume_sizes())
+
+    def _code(self, volume, vserver):
+        """Returns the integer code of a volume, assigning one if new."""
+
+        key = (volume, vserver)
+        if key not in self._codes:
+            self._codes[key] = len(self.volumes)
+            self.volumes.append(key)
+        return self._codes[key]
+
+    def _on_volume(self, volume):
+        """Returns a mask of the usage rows of a volume; all if None."""
+
+        if volume is None:
+            return numpy.ones(len(self._usage_volume), dtype=bool)
+
+        codes = [code for code, key in enumerate(self.volumes)
+                 if key[0] == volume]
+        return numpy.in1d(self._usage_volume, codes)
+
+    def _utilization(self):
+        """Returns disk used over disk limit of each row; NaN if unlimited."""
+
+        utilization = numpy.full(len(self._disk_used), numpy.nan)
+        limited = self._disk_limit > 0
+        utilization[limited] = (self._disk_used[limited] /
+                                self._disk_limit[limited].astype(float))
+        return utilization
+
+    def overcommit(self):
+        """Compares the sum of group disk limits of each volume with its size.
+
+        Returns:
+            (list): Per volume dictionaries of volume, vserver, rules,
+                    committed (KB), size (KB) and ratio of committed to
+                    size (None if the size is unknown), most overcommitted
+                    first.
+        """
+
+        count = len(self.volumes)
+        rules = numpy.bincount(self._rule_volume, minlength=count)
+        # Weighted sums are doubles, exact for totals below 2 ** 53 KB.
+        committed = numpy.bincount(self._rule_volume, weights=self._rule_disk,
+                                   minlength=count).round().astype(numpy.int64)
+
+        known = self.sizes > 0
+        ratio = numpy.full(count, -1.0)
+        ratio[known] = committed[known] / self.sizes[known].astype(float)
+
+        return [{'volume': self.volumes[code][0],
+                 'vserver': self.volumes[code][1],
+                 'rules': int(rules[code]),
+                 'committed': int(committed[code]),
+                 'size': int(self.sizes[code]),
+                 'ratio': float(ratio[code]) if known[code] else None}
+                for code in numpy.argsort(-ratio, kind='mergesort')]
+
+    def percentiles(self, points=(50, 90, 95, 99), volume=None):
+        """Returns utilization percentiles of the rows that have a limit.
+
+        Arguments:
+            points (tuple): Percentiles to compute, from 0 to 100.
+            volume (string): Only rows of this volume.
+
+        Returns:
+            (dictionary): {point: disk used over disk limit}; empty if no
+                          row has a limit.
+        """
+
+        utilization = self._utilization()
+        rows = ~numpy.isnan(utilization) & self._on_volume(volume)
+
+        if not rows.any():
+            return {}
+
+        values = numpy.percentile(utilization[rows], points)
+        return dict((point, float(value))
+                    for point, value in zip(points, values))
+
+    def summary(self):
+        """Returns fleet-wide totals.
+
+        Returns:
+            (dictionary): rules, rows, volumes, committed, used and size,
+                          in KB where they are sizes.
+        """
+
+        return {'rules': len(self._rule_disk),
+                'rows': len(self._disk_used),
+                'volumes': len(self.volumes),
+                'committed': int(self._rule_disk.sum()),
+                'used': int(self._disk_used.sum()),
+                'size': int(self.sizes.sum())}
+
+    def top(self, count=10, by='disk_used', volume=None):
+        """Returns the largest consumers.
+
+        Arguments:
+            by (string): disk_used, files_used or utilization.
+            count (int): Number of rows to return.
+            volume (string): Only rows of this volume.
+
+        Returns:
+            (list): Dictionaries of target, volume, vserver, disk_used,
+                    disk_limit, files_used and utilization, largest first.
+
+        Raises:
+            ValueError: When by is not one of TOP_KEYS.
+        """
+
+        if by not in TOP_KEYS:
+            raise ValueError("Cannot rank by " + str(by))
+
+        utilization = self._utilization()
+        if by == 'utilization':
+            values = numpy.nan_to_num(utilization)
+        elif by == 'files_used':
+            values = self._files_used
+        else:
+            values = self._disk_used
+
+        candidates = numpy.flatnonzero(self._on_volume(volume))
+        values = values[candidates]
+
+        count = min(count, len(values))
+        if count < 1:
+            return []
+
+        # Partition out the largest rows, then sort only those.
+        best = numpy.argpartition(-values, count - 1)[:count]
+        rows = candidates[best[numpy.argsort(-values[best],
+                                             kind='mergesort')]]
+
+        return [{'target': self._target[row],
+                 'volume': self.volumes[self._usage_volume[row]][0],
+                 'vserver': self.volumes[self._usage_volume[row]][1],
+                 'disk_used': int(self._disk_used[row]),
+                 'disk_limit': int(self._disk_limit[row]) or None,
+                 'files_used': int(self._files_used[row]),
+                 'utilization': (None if numpy.isnan(utilization[row])
+                                 else float(utilization[row]))}
+                for row in rows]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import collections
+import threading
+import time
+
+
+class QuotaCache:
+    """LRU cache of group lookups whose entries expire after a TTL.
+
+    Misses are cached too: a QuotaEntry carrying an error is a negative
+    entry, meaning "the group has no rule on this volume".
+
+    Example:
+        cache = QuotaCache(1024, 300)
+        cache.put(entry)
+        entry = cache.get(group, policy, volume)
+
+    Public Functions:
+        clear: Drops every entry.
+        get: Returns a fresh cached entry, or None.
+        invalidate: Drops one entry.
+        put: Stores an entry, evicting the least recently used if full.
+        stats: Returns hit, miss and eviction counters.
+    """
+
+    def __init__(self, size, ttl):
+        """Creates an empty cache.
+
+        Arguments:
+            size (int): Maximum number of entries kept.
+            ttl (int): Seconds an entry stays fresh.
+        """
+
+        self.size = size
+        self.ttl = ttl
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Drops every entry."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, group, policy, volume):
+        """Returns a fresh cached entry, or None.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            volume (string): The volume where the group quota resides.
+
+        Returns:
+            (instance/None): Cached QuotaEntry, possibly a negative one;
+                             None if absent or expired.
+        """
+
+        key = (group, policy, volume)
+
+        with self._lock:
+            cached = self._entries.pop(key, None)
+
+            if cached is None or cached[0] < time.time():
+                self.misses += 1
+                return None
+
+            # Re-insert to mark it as most recently used.
+            self._entries[key] = cached
+            self.hits += 1
+            return cached[1]
+
+    def invalidate(self, group, policy, volume):
+        """Drops one entry.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            volume (string): The volume where the group quota resides.
+        """
+
+        with self._lock:
+            self._entries.pop((group, policy, volume), None)
+
+    def put(self, entry):
+        """Stores an entry, evicting the least recently used if full.
+
+        Arguments:
+            entry (instance): QuotaEntry to cache; negative if it has an error.
+        """
+
+        key = (entry.group, entry.policy, entry.volume)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, entry)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Returns hit, miss and eviction counters.
+
+        Returns:
+            (dictionary): entries, evictions, hits and misses.
+        """
+
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'evictions': self.evictions,
+                    'hits': self.hits,
+                    'misses': self.misses}
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Long-running quota service behind a Unix domain socket.
+
+The daemon holds one HMDCQuotas, with its warm connections, cache, index
+and topology, and answers JSON requests, one per line:
+
+    {"method": "search_vservers", "args": ["mygroup", null], "kwargs": {}}
+
+Each answer is zero or more {"record": ...} lines, for streamed methods
+such as report, followed by one {"result": ...} or {"error": ...} line.
+QuotaEntry, QuotaUsage and ResizeJob results travel as {"__record__":
+class name, "fields": {...}}, and SearchResults as {"__search__": matches,
+"unreachable": {...}}; QuotaClient rebuilds them.
+
+Example:
+    daemon = QuotaDaemon(HMDCQuotas(), '/var/run/hmdcquotas/quotas.sock')
+    daemon.serve_forever()
+
+    qh = QuotaClient('/var/run/hmdcquotas/quotas.sock')
+    qh.search_vservers(group, policy)
+"""
+
+from results import QuotaEntry, QuotaRecord, QuotaUsage, ResizeJob
+from results import SearchResults
+import functools
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+DEFAULT_SOCKET = '/var/run/hmdcquotas/quotas.sock'
+
+# HMDCQuotas methods served by the daemon.
+METHODS = ('build_index', 'cache_stats', 'commit_journal',
+           'discover_volumes', 'drop_index', 'entries', 'get_vserver',
+           'group_lookup',
+           'job_status', 'list_entries', 'migrate', 'modify', 'modify_batch',
+           'queue_changes', 'reconcile', 'report', 'resize',
+           'search_groups', 'search_vservers', 'search_volumes', 'stats',
+           'volume_sizes', 'wait_resize_jobs')
+
+# Methods that yield records rather than return a result.
+STREAMED = ('entries', 'list_entries', 'report')
+
+# Result records that can cross the socket.
+RECORDS = {'QuotaEntry': QuotaEntry, 'QuotaUsage': QuotaUsage,
+           'ResizeJob': ResizeJob}
+
+
+def decode(value):
+    """Rebuilds a value sent by encode(), with str instead of unicode.
+
+    Arguments:
+        value (object): Value as parsed from JSON.
+
+    Returns:
+        (object): The value, with QuotaEntry and QuotaUsage records rebuilt.
+    """
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if '__search__' in value:
+            return SearchResults(decode(value['__search__']),
+                                 decode(value['unreachable']))
+        if '__record__' in value and value['__record__'] in RECORDS:
+            fields = decode(value['fields'])
+            record = RECORDS[value['__record__']]
+            return record(*[fields[name] for name in record.__slots__])
+        return dict((decode(key), decode(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def encode(value):
+    """Makes a result JSON serializable, tagging the result records.
+
+    Arguments:
+        value (object): Result of an HMDCQuotas method.
+
+    Returns:
+        (object): Value made of JSON types only.
+    """
+
+    if isinstance(value, QuotaRecord):
+        return {'__record__': value.__class__.__name__,
+                'fields': value.as_dict()}
+    if isinstance(value, SearchResults):
+        return {'__search__': encode(dict(value)),
+                'unreachable': value.unreachable}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, encode(item)) for key, item in value.iteritems())
+    return value
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """Answers the requests of one client connection, in order."""
+
+    # Buffer each answer and flush it once, rather than a send per line.
+    wbufsize = -1
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                self.server.quota_daemon.answer(json.loads(line), self._send)
+            except socket.error:
+                # The client went away mid-answer.
+                return
+            except ValueError:
+                self._send({'error': "Malformed request"})
+            except Exception as err:
+                # Keep serving this client whatever went wrong.
+                self._send({'error': "Could not serve request: " + str(err)})
+            self.wfile.flush()
+
+    def _send(self, message):
+        self.wfile.write(json.dumps(message) + "\n")
+
+
+class _Listener(SocketServer.ThreadingMixIn,
+                SocketServer.UnixStreamServer):
+    """Threaded Unix domain socket server, one thread per connection."""
+
+    daemon_threads = True
+
+
+class QuotaDaemon:
+    """Serves one HMDCQuotas over a Unix domain socket.
+
+    Public Functions:
+        answer: Runs one request and sends its answer.
+        serve_forever: Accepts clients until shutdown() is called.
+        shutdown: Stops serving and removes the socket.
+        write_metrics: Writes the ZAPI call metrics of the handler.
+
+    Instance Variables:
+        handler (instance): The HMDCQuotas serving every request.
+        path (string): Location of the socket.
+    """
+
+    def __init__(self, handler, path=DEFAULT_SOCKET, mode=0660):
+        """Binds the socket; call serve_forever() to accept clients.
+
+        Arguments:
+            handler (instance): HMDCQuotas to serve.
+            mode (int): Permissions of the socket file.
+            path (string): Location of the socket.
+        """
+
+        self.handler = handler
+        self.path = path
+
+        # A socket left behind by a daemon that died blocks the bind.
+        if os.path.exists(path):
+            os.remove(path)
+
+        self._listener = _Listener(path, _Handler)
+        self._listener.quota_daemon = self
+        os.chmod(path, mode)
+
+    def answer(self, request, send):
+        """Runs one request and sends its answer.
+
+        Arguments:
+            request (dictionary): method, and optionally args and kwargs.
+            send (function): Called with each message of the answer.
+        """
+
+        method = request.get('method')
+
+        try:
+            args = decode(request.get('args') or [])
+            kwargs = decode(request.get('kwargs') or {})
+        except Exception as err:
+            send({'error': "Malformed arguments: " + str(err)})
+            return
+
+        if method == 'write_metrics':
+            target = self.write_metrics
+        elif method in METHODS:
+            target = getattr(self.handler, method)
+        else:
+            send({'error': "Unknown method " + str(method)})
+            return
+
+        self.handler.hmdclog.log('debug', "Serving " + method)
+        # Other clients run requests on the same handler at the same time,
+        # so only this thread's error belongs to this request.
+        self.handler.thread_error(clear=True)
+
+        try:
+            if method in STREAMED:
+                for record in target(*args, **kwargs):
+                    send({'record': encode(record)})
+                result = None
+            else:
+                result = target(*args, **kwargs)
+        except Exception as err:
+            self.handler.hmdclog.log('error', method + " failed: " +
+                                     str(err))
+            send({'error': str(err)})
+            return
+
+        if isinstance(result, QuotaRecord) and result.error:
+            error_msg = result.error
+        else:
+            error_msg = self.handler.thread_error()
+
+        send({'result': encode(result), 'error_msg': error_msg})
+
+    def serve_forever(self):
+        """Accepts clients until shutdown() is called."""
+
+        self.handler.hmdclog.log('info', "Serving quotas on " + self.path)
+        self._listener.serve_forever()
+
+    def shutdown(self):
+        """Stops serving and removes the socket.
+
+        Must be called from another thread than serve_forever().
+        """
+
+        self._listener.shutdown()
+        self._listener.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write_metrics(self, path, output_format='json'):
+        """Writes the ZAPI call metrics of the handler.
+
+        Arguments:
+            output_format (string): json or prometheus.
+            path (string): Destination file, written by the daemon.
+        """
+
+        self.handler.metrics.write(path, output_format)
+
+
+class QuotaClient:
+    """Calls a QuotaDaemon as if it were a local HMDCQuotas.
+
+    Every method in METHODS, and write_metrics, is available on the client
+    with the same arguments and results; streamed methods are generators.
+    One connection is kept open and shared, one request at a time.
+
+    Public Functions:
+        call: Runs a method on the daemon and returns its result.
+        close: Closes the connection.
+        stream: Runs a streamed method on the daemon and yields its records.
+
+    Instance Variables:
+        ERROR_MSG (string): Error message of the last call, as the daemon's
+                            handler set it while serving that call.
+        path (string): Location of the socket.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=None):
+        """Connects to the daemon.
+
+        Arguments:
+            path (string): Location of the socket.
+            timeout (float): Seconds to wait on the daemon; None waits
+                             forever.
+
+        Raises:
+            socket.error: When no daemon listens on the socket.
+        """
+
+        self.ERROR_MSG = ''
+        self.path = path
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(path)
+        self._reader = self._socket.makefile('rb')
+
+    def __getattr__(self, name):
+        if name in STREAMED:
+            return functools.partial(self.stream, name)
+        if name in METHODS or name == 'write_metrics':
+            return functools.partial(self.call, name)
+        raise AttributeError(name)
+
+    def _request(self, method, args, kwargs):
+        """Sends one request and yields each message of its answer."""
+
+        with self._lock:
+            self._socket.sendall(json.dumps({'method': method,
+                                             'args': encode(args),
+                                             'kwargs': encode(kwargs)}) +
+                                 "\n")
+            finished = False
+            try:
+                while not finished:
+                    line = self._reader.readline()
+                    if not line:
+                        raise RuntimeError("Quota daemon closed the "
+                                           "connection")
+                    message = json.loads(line)
+                    finished = 'record' not in message
+                    yield message
+            finally:
+                # A caller that stops reading a stream early leaves the rest
+                # of the answer on the socket; drain it for the next call.
+                while not finished:
+                    line = self._reader.readline()
+                    finished = not line or 'record' not in json.loads(line)
+
+    def call(self, method, *args, **kwargs):
+        """Runs a method on the daemon and returns its result.
+
+        Arguments:
+            args (list): Positional arguments of the method.
+            kwargs (dictionary): Keyword arguments of the method.
+            method (string): Name of the HMDCQuotas method.
+
+        Returns:
+            (object): Result of the method.
+
+        Raises:
+            RuntimeError: When the method failed on the daemon.
+        """
+
+        for message in self._request(method, args, kwargs):
+            pass
+
+        if 'error' in message and 'result' not in message:
+            self.ERROR_MSG = decode(message['error'])
+            raise RuntimeError(self.ERROR_MSG)
+
+        self.ERROR_MSG = decode(message.get('error_msg') or '')
+        return decode(message['result'])
+
+    def close(self):
+        """Closes the connection."""
+
+        self._reader.close()
+        self._socket.close()
+
+    def stream(self, method, *args, **kwargs):
+        """Runs a streamed method on the daemon and yields its records.
+
+        Arguments:
+            args (list): Positional arguments of the method.
+            kwargs (dictionary): Keyword arguments of the method.
+            method (string): Name of the HMDCQuotas method.
+
+        Yields:
+            (object): Each record, as the method yields it.
+
+        Raises:
+            RuntimeError: When the method failed on the daemon.
+        """
+
+        for message in self._request(method, args, kwargs):
+            if 'record' in message:
+                yield decode(message['record'])
+            elif 'error' in message and 'result' not in message:
+                self.ERROR_MSG = decode(message['error'])
+                raise RuntimeError(self.ERROR_MSG)
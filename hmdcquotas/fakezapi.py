@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Development"
+
+"""
+Local stand-in for the NetApp ZAPI endpoints used by HMDCQuotas.
+
+Serves the quota APIs from synthetic in-memory tables, one listener per
+vserver, with configurable latency and failure injection. Meant for
+benchmarks and offline testing, never for production.
+
+Example:
+    fake = FakeZapiServer(HMDCQuotas.VOLUMES, rules_per_volume=5000)
+    fake.start()
+    qh.endpoints = fake.endpoints
+    ...
+    print(fake.calls)
+    fake.stop()
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+import BaseHTTPServer
+import collections
+import random
+import SocketServer
+import ssl
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+# Error numbers returned by the stand-in.
+EINJECTED = 13001
+EDUPLICATE = 13130
+ENOTFOUND = 15661
+EUNSUPPORTED = 13005
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers ZAPI POSTs for one vserver of a FakeZapiServer."""
+
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response into one write; the default of one send per
+    # header line trips Nagle and delayed ACKs, adding ~40ms per call.
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        response = self.server.fake.handle(self.server.vserver, body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Listener(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server bound to one vserver."""
+
+    daemon_threads = True
+
+
+class FakeZapiServer:
+    """Serves synthetic quota tables over ZAPI, one port per vserver.
+
+    Public Functions:
+        handle: Answers one ZAPI request document.
+        reset_counters: Zeroes the per-API call counters.
+        start: Opens a listener for every vserver.
+        stop: Shuts every listener down.
+
+    Instance Variables:
+        calls (Counter): Number of calls per ZAPI name.
+        endpoints (dictionary): (host, port) of each vserver's listener.
+        tables (dictionary): {volume: {(group, policy): [disk, files]}}.
+    """
+
+    def __init__(self, volumes, rules_per_volume=1000, latency=0.0,
+                 jitter=0.0, resize_latency=0.0, failure_rate=0.0,
+                 certfile=None, seed=None, volume_size=107374182400):
+        """Builds the synthetic tables; call start() to listen.
+
+        Arguments:
+            certfile (string): PEM certificate and key to serve HTTPS;
+                               plain HTTP if None.
+            failure_rate (float): Share of calls answered with an injected
+                                  failure, from 0 to 1.
+            jitter (float): Extra random latency in seconds, up to this much.
+            latency (float): Seconds added to every call.
+            resize_latency (float): Seconds a quota-resize job runs before
+                                    job-get reports it done.
+            rules_per_volume (int/dictionary): Rules generated per volume,
+                                               or a count for each volume.
+            seed (int): Random seed, for repeatable tables and failures.
+            volume_size (int): Size every volume reports, in KB.
+            volumes (dictionary): SVMs with their respective volumes.
+        """
+
+        self.certfile = certfile
+        self.calls = collections.Counter()
+        self.endpoints = {}
+        self.failure_rate = failure_rate
+        self.jitter = jitter
+        self.latency = latency
+        self.resize_latency = resize_latency
+        self.tables = {}
+        self.volume_size = volume_size
+        self.volumes = volumes
+        self._jobs = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+        for vserver, names in volumes.iteritems():
+            for volume in names:
+                if isinstance(rules_per_volume, dict):
+                    count = rules_per_volume.get(volume, 0)
+                else:
+                    count = rules_per_volume
+                self.tables[volume] = self._synthesize(count)
+
+    def _synthesize(self, count):
+        """Generates a quota table of count group rules.
+
+        Arguments:
+            count (int): Number of rules.
+
+        Returns:
+            (dictionary): {(group, 'default'): [disk_kb, files]}
+        """
+
+        table = {}
+        for number in range(count):
+            disk = self._random.choice((5, 10, 50, 100, 500)) * 1048576
+            table[('grp%05d' % number, 'default')] = [disk, disk / 16]
+        return table
+
+    def _args(self, request):
+        """Returns the leaf children of a request as a dictionary."""
+
+        return dict((child.tag, child.text or '') for child in request
+                    if len(child) == 0)
+
+    def _fail(self, errno, reason):
+        """Builds a failed results element."""
+
+        return ('<results status="failed" errno=' + quoteattr(str(errno)) +
+                ' reason=' + quoteattr(reason) + '/>')
+
+    def _fields(self, fields):
+        """Renders (name, value) pairs as child elements."""
+
+        return ''.join('<' + name + '>' + escape(str(value)) + '</' + name +
+                       '>' for name, value in fields)
+
+    def _iter(self, request, rows):
+        """Pages through rows the way *-iter APIs do.
+
+        Arguments:
+            request (instance): ElementTree request element.
+            rows (list): Rendered record elements.
+
+        Returns:
+            (string): results element with one page and a next-tag.
+        """
+
+        args = self._args(request)
+        start = int(args.get('tag') or 0)
+        size = int(args.get('max-records') or 20)
+        page = rows[start:start + size]
+        body = ('<attributes-list>' + ''.join(page) + '</attributes-list>' +
+                '<num-records>' + str(len(page)) + '</num-records>')
+
+        if start + size < len(rows):
+            body += '<next-tag>' + str(start + size) + '</next-tag>'
+
+        return '<results status="passed">' + body + '</results>'
+
+    def _query(self, request, name):
+        """Returns the leaf fields of request/query/name as a dictionary."""
+
+        query = request.find('query')
+        if query is None or query.find(name) is None:
+            return {}
+        return self._args(query.find(name))
+
+    def _quota_api(self, vserver, api, request):
+        """Dispatches one quota ZAPI.
+
+        Arguments:
+            api (string): ZAPI name.
+            request (instance): ElementTree request element.
+            vserver (string): The vserver the request arrived on.
+
+        Returns:
+            (string): results element.
+        """
+
+        args = self._args(request)
+        volume = args.get('volume')
+        key = (args.get('quota-target'), args.get('policy') or 'default')
+
+        if api in ('quota-get-entry', 'quota-add-entry', 'quota-modify-entry',
+                   'quota-delete-entry', 'quota-resize'):
+            if volume not in self.volumes.get(vserver, ()):
+                return self._fail(ENOTFOUND, "Volume " + str(volume) +
+                                  " not found on " + vserver)
+            table = self.tables[volume]
+
+        with self._lock:
+            if api == 'quota-get-entry':
+                if key not in table:
+                    return self._fail(ENOTFOUND, "entry doesn't exist")
+                disk, files = table[key]
+                return ('<results status="passed">' +
+                        self._fields((('disk-limit', disk),
+                                      ('soft-file-limit', files),
+                                      ('file-limit', '-'),
+                                      ('soft-disk-limit', '-'),
+                                      ('threshold', '-'))) + '</results>')
+
+            if api in ('quota-add-entry', 'quota-modify-entry'):
+                if api == 'quota-add-entry' and key in table:
+                    return self._fail(EDUPLICATE, "duplicate entry")
+                if api == 'quota-modify-entry' and key not in table:
+                    return self._fail(ENOTFOUND, "entry doesn't exist")
+                table[key] = [int(args.get('disk-limit') or 0),
+                              args.get('soft-file-limit') or '-']
+                return '<results status="passed"/>'
+
+            if api == 'quota-delete-entry':
+                if table.pop(key, None) is None:
+                    return self._fail(ENOTFOUND, "entry doesn't exist")
+                return '<results status="passed"/>'
+
+            if api == 'quota-resize':
+                jobid = len(self._jobs) + 1
+                self._jobs[jobid] = (time.time(), self.resize_latency)
+                return ('<results status="passed">' +
+                        self._fields((('result-jobid', jobid),
+                                      ('result-status', 'in_progress'))) +
+                        '</results>')
+
+            if api == 'job-get':
+                jobid = int(args.get('job-id') or 0)
+                if jobid not in self._jobs:
+                    return self._fail(ENOTFOUND, "job doesn't exist")
+                started, duration = self._jobs[jobid]
+                elapsed = time.time() - started
+                if elapsed >= duration:
+                    state, percent = 'success', 100
+                else:
+                    state, percent = 'running', int(100 * elapsed / duration)
+                return ('<results status="passed"><attributes><job-info>' +
+                        self._fields((('job-completion', ''),
+                                      ('job-id', jobid),
+                                      ('job-progress', str(percent) + '%'),
+                                      ('job-state', state))) +
+                        '</job-info></attributes></results>')
+
+            if api == 'quota-list-entries-iter':
+                query = self._query(request, 'quota-entry')
+                rows = []
+                for name in self._volumes_of(vserver, query.get('volume')):
+                    for (group, policy), (disk, files) in \
+                            sorted(self.tables[name].iteritems()):
+                        rows.append('<quota-entry>' + self._fields((
+                            ('disk-limit', disk),
+                            ('policy', policy),
+                            ('qtree', ''),
+                            ('quota-target', group),
+                            ('quota-type', 'group'),
+                            ('soft-file-limit', files),
+                            ('volume', name),
+                            ('vserver', vserver))) + '</quota-entry>')
+                return self._iter(request, rows)
+
+            if api == 'quota-report-iter':
+                query = self._query(request, 'quota')
+                target = query.get('quota-target')
+                rows = []
+                for name in self._volumes_of(vserver, query.get('volume')):
+                    for (group, policy), (disk, files) in \
+                            sorted(self.tables[name].iteritems()):
+                        if target is not None and group != target:
+                            continue
+                        rows.append('<quota>' + self._fields((
+                            ('disk-limit', disk),
+                            ('disk-used', disk / 3),
+                            ('file-limit', '-'),
+                            ('files-used', 1000),
+                            ('quota-target', group),
+                            ('quota-type', 'group'),
+                            ('soft-disk-limit', '-'),
+                            ('soft-file-limit', files),
+                            ('tree', ''),
+                            ('volume', name),
+                            ('vserver', vserver))) + '</quota>')
+                return self._iter(request, rows)
+
+            if api == 'volume-get-iter':
+                # Every SVM has a root volume that holds no quotas.
+                names = [(vserver.replace('-', '_') + '_root', 'true')]
+                names += [(name, 'false')
+                          for name in self._volumes_of(vserver)]
+                rows = ['<volume-attributes><volume-id-attributes>' +
+                        self._fields((('name', name),
+                                      ('owning-vserver-name', vserver))) +
+                        '</volume-id-attributes><volume-state-attributes>' +
+                        self._fields((('is-vserver-root', root),
+                                      ('state', 'online'))) +
+                        '</volume-state-attributes>'
+                        '<volume-space-attributes>' +
+                        self._fields((('size', self.volume_size * 1024),)) +
+                        '</volume-space-attributes></volume-attributes>'
+                        for name, root in names]
+                return self._iter(request, rows)
+
+        return self._fail(EUNSUPPORTED, "Unsupported API " + api)
+
+    def _volumes_of(self, vserver, volume=None):
+        """Returns the volumes of a vserver, optionally just one of them."""
+
+        names = self.volumes.get(vserver, ())
+        if volume is not None:
+            return [name for name in names if name == volume]
+        return list(names)
+
+    def handle(self, vserver, body):
+        """Answers one ZAPI request document.
+
+        Arguments:
+            body (string): XML request, including the netapp envelope.
+            vserver (string): The vserver the request arrived on.
+
+        Returns:
+            (string): XML response, including the netapp envelope.
+        """
+
+        request = None
+        try:
+            root = ElementTree.fromstring(body)
+            # Drop the ZAPI namespace from every tag.
+            for node in root.iter():
+                node.tag = node.tag.split('}', 1)[-1]
+            request = root[0]
+        except (ElementTree.ParseError, IndexError):
+            results = self._fail(EUNSUPPORTED, "Malformed request")
+
+        if request is not None:
+            api = request.tag
+            with self._lock:
+                self.calls[api] += 1
+                failed = self._random.random() < self.failure_rate
+
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            if delay:
+                time.sleep(delay)
+
+            if failed:
+                results = self._fail(EINJECTED, "Injected failure")
+            else:
+                results = self._quota_api(vserver, api, request)
+
+        return ("<?xml version='1.0' encoding='UTF-8' ?>" +
+                "<netapp version='1.20' " +
+                "xmlns='http://www.netapp.com/filer/admin'>" + results +
+                "</netapp>")
+
+    def reset_counters(self):
+        """Zeroes the per-API call counters."""
+
+        with self._lock:
+            self.calls.clear()
+
+    def start(self, host='127.0.0.1'):
+        """Opens a listener for every vserver on an ephemeral port.
+
+        Arguments:
+            host (string): Address to listen on.
+
+        Returns:
+            (dictionary): endpoints, {vserver: (host, port)}.
+        """
+
+        for vserver in self.volumes.iterkeys():
+            listener = _Listener((host, 0), _Handler)
+            listener.fake = self
+            listener.vserver = vserver
+            if self.certfile:
+                listener.socket = ssl.wrap_socket(listener.socket,
+                                                  certfile=self.certfile,
+                                                  server_side=True)
+            thread = threading.Thread(target=listener.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._listeners.append(listener)
+            self.endpoints[vserver] = (host, listener.server_address[1])
+
+        return self.endpoints
+
+    def stop(self):
+        """Shuts every listener down."""
+
+        for listener in self._listeners:
+            listener.shutdown()
+            listener.server_close()
+
+        self._listeners = []
+        self.endpoints = {}
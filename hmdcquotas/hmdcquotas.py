@@ -8,12 +8,25 @@ __maintainer__ = "HMDC"
 __email__ = "ops@latte.harvard.edu"
 __status__ = "Production"
 
+from cache import QuotaCache
+from index import QuotaIndex
+from journal import QuotaJournal
+from locality import QuotaLocality
+from metrics import ZapiMetrics
+from multiprocessing.pool import ThreadPool
 from NaServer import *
+from resilience import backoff_delay, CircuitBreaker, TRANSPORT_ERRNO
+from results import QuotaEntry, QuotaUsage, ResizeJob, SearchResults
+from throttle import OVERLOAD_ERRNOS, QuotaThrottle
+from topology import QuotaTopology
+from transport import failed_result, ZapiTransport
 import ConfigParser
+import fnmatch
 import hmdclogger
 import humanize
 import re
 import sys
+import threading
 import time
 
 
@@ -24,36 +37,147 @@ class HMDCQuotas:
         qh = HMDCQuotas()
         # Modify a group
         qh.modify(action, group, volume, vserver, policy, size, files)
+        # Modify many groups, resizing each volume once
+        qh.modify_batch(changes)
         # Search everything
         qh.search_vservers(group)
         # Search all volumes
         qh.search_volumes(group, vserver)
         # Search when vserver and volume is known
         group_lookup(group, volume, vserver)
+        # Search everything in parallel
+        qh.search_vservers(group, policy, concurrent=True)
+        # Probe where the group was last found first; stop at the first hit
+        qh.search_vservers(group, policy, first_hit=True)
+        # Check how often lookups were answered from the cache
+        qh.cache_stats()
+        # Stream usage for every group rule on one SVM
+        records = qh.report(vserver=vserver)
+        # Answer searches from one bulk scan per volume
+        qh.build_index()
+        qh.search_vservers(group, policy)
+        # Search many groups at once, scanning each volume once
+        results = qh.search_groups(groups, policy)
+        # Rediscover the SVMs and volumes now rather than when stale
+        qh.discover_volumes()
+        # Bring the NetApp in line with a desired state, changing only drift
+        changes, failures = qh.reconcile(desired)
+        # Start resizes without blocking, then wait for all of them
+        jobs = [qh.resize(volume, vserver) for volume, vserver in targets]
+        jobs = qh.wait_resize_jobs(jobs)
+        # Journal changes durably, then apply them with one resize a volume
+        qh.queue_changes(changes)
+        failures = qh.commit_journal()
 
     Private Functions:
+        _apply_topology: Publishes the topology map as VOLUMES.
+        _batch_resize_task: Worker body for starting one resize of a batch.
+        _batch_task: Worker body for one change of a batch.
+        _check_topology: Starts a background rediscovery when stale.
+        _convert_to_kb: Parses a quota to KB without touching ERROR_MSG.
+        _discover_task: Worker body for listing the volumes of one SVM.
+        _humanize_limits: Makes raw disk and file limits human readable.
+        _index_task: Worker body for scanning one volume into the index.
+        _journal_lane: Worker body for applying one rule's journaled changes.
+        _journal_task: Applies one journaled change.
         _netapp_auth: Authenticates the vserver connections.
-        _netapp_invoke: Handles add/delete/modify/search queries on the NetApp.
+        _netapp_call: Sends a flat ZAPI request to a vserver.
+        _netapp_call_elem: Sends a ZAPI request and records its metrics.
+        _netapp_connect: Returns a vserver connection, creating it lazily.
+        _netapp_iter: Pages through a NetApp *-iter query.
+        _netapp_query: Handles add/delete/modify/search queries on the NetApp.
         _netapp_resize: Handles the resize query on the NetApp.
+        _parse_clusters: Parses the clusters setting.
+        _remember_location: Records where a lookup did or did not find a group.
+        _save_locality: Writes the group locations once an interval.
+        _scan_task: Worker body for reading every rule of one volume.
+        _search_concurrent: Probes many volumes at once on the worker pool.
+        _search_first: Probes the likeliest volumes until the first hit.
+        _search_fold: Gathers probe results into matches and unreachables.
+        _search_index: Answers a search from the index where it can.
+        _search_serial: Probes volumes one at a time.
+        _search_targets: Searches volumes via the index, then the NetApp.
+        _search_task: Worker body for a single concurrent probe.
+        _size_task: Worker body for reading the volume sizes of one SVM.
+        _rediscover: Rediscovers at once after a volume or SVM lookup miss.
+        _topology_task: Thread body for a background rediscovery.
+        _volume_targets: Returns the volumes a fleet-wide job covers.
+        _worker_pool: Returns the shared, lazily created worker pool.
 
     Public Functions:
+        build_index: Bulk loads group quota rules into an in-memory index.
+        cache_stats: Returns lookup cache hit/miss counters.
+        close: Shuts down the worker pool and pooled connections.
+        commit_journal: Applies journaled changes with one resize per volume.
         convert_to_kb: Parses and converts given quota to KB.
+        discover_volumes: Rediscovers the SVMs and volumes via the NetApp.
+        drop_index: Discards the in-memory index.
+        entries: Yields every group quota rule, scanning volumes in parallel.
         humanize_quotas: Makes NetApp quota results human readable.
         get_vserver: Returns the vserver of the given volume.
         group_lookup: Queries the NetApp for a group on a specific volume.
+        job_status: Polls the cluster for the state of a resize job.
+        list_entries: Yields every group quota rule on a volume.
+        migrate: Copies group rules from one volume to another, in bulk.
         modify: Preps and executes add/delete/modify queries.
+        modify_batch: Applies many changes with one resize per volume.
+        queue_changes: Durably records changes in the journal.
+        reconcile: Applies the minimal changes to reach a desired state.
+        resize: Starts a quota resize and returns its job without waiting.
+        report: Streams quota usage records page by page.
+        search_groups: Finds the quotas of many groups in one scan per volume.
         search_vservers: Finds group quota on any vserver/volume combination.
         search_volumes: Finds group quota on any volume in a specific vserver.
+        stats: Returns per-verb and per-vserver call metrics.
+        thread_error: Returns the last ERROR_MSG set by the calling thread.
+        volume_sizes: Returns the size of every data volume.
+        wait_resize_jobs: Waits on many resize jobs at once.
 
     Class Variables:
+        CONFIG_DEFAULTS (dictionary): Fallbacks for optional conf settings.
         CONFIG_FILE (string): Location of the conf file.
         DEFAULT_QUOTA (string): The quota value to use when none is specified.
-        ERROR_MSG (string): Error message if raised.
+        ERROR_MSG (string): Last error message; kept for older callers,
+                            the error field of results is thread-safe.
         FILESIZES (dictionary): Valid filesize units and their kb multiplier.
-        NA_INVOKE (instance): Stores last result from NetApp query.
-        VOLUMES (dictionary): SVMs with their respective volumes.
+        IDEMPOTENT_APIS (tuple): ZAPIs safe to retry after a transport error.
+        MISS_REDISCOVERY (int): Minimum seconds between rediscoveries caused
+                                by lookups of unknown volumes or SVMs.
+        NA_INVOKE (instance): Stores last result from group_lookup.
+        VOLUMES (dictionary): SVMs with their respective volumes; seeds the
+                              topology until the first discovery, after
+                              which each instance holds the discovered map.
     """
 
+    CONFIG_DEFAULTS = {'breaker_reset': '30',
+                       'breaker_threshold': '5',
+                       'cache_size': '0',
+                       'cache_ttl': '300',
+                       'call_timeout': '30',
+                       'cdot_transport': 'HTTPS',
+                       'cluster_max_inflight': '16',
+                       'cluster_rate': '0',
+                       'clusters': '',
+                       'job_poll_interval': '2',
+                       'journal': '',
+                       'journal_window': '5',
+                       'latency_apis': 'quota-get-entry',
+                       'latency_target': '1.0',
+                       'locality_cache': '/var/cache/hmdcquotas/locality.json',
+                       'locality_flush': '60',
+                       'max_records': '1000',
+                       'max_workers': '8',
+                       'pool_idle_timeout': '60',
+                       'pool_size': '4',
+                       'retries': '2',
+                       'retry_backoff': '0.2',
+                       'shard_processes': '0',
+                       'svm_max_inflight': '8',
+                       'svm_workers': '2',
+                       'throttle': 'adaptive',
+                       'topology_cache': '/var/cache/hmdcquotas/topology.json',
+                       'topology_ttl': '86400',
+                       'vservers': ''}
     CONFIG_FILE = '/etc/hmdcquotas.conf'
     DEFAULT_QUOTA = '5G'
     ERROR_MSG = ''
@@ -61,6 +185,10 @@ class HMDCQuotas:
                  'M': 1024,
                  'G': 1048576,
                  'T': 1073741824}
+    IDEMPOTENT_APIS = ('job-get', 'quota-get-entry',
+                       'quota-list-entries-iter', 'quota-report-iter',
+                       'volume-get-iter')
+    MISS_REDISCOVERY = 60
     NA_INVOKE = None
     # these must be tuples because python
     VOLUMES = {'nc-projects-svm01-mgmt': ('projects',
@@ -77,29 +205,105 @@ class HMDCQuotas:
                'nc-rshiny-svm01-mgmt': ('rshiny_ci3',)}
 
     def __init__(self, logger=None, debug_level=None, log_console=False,
-                 log_file=False):
-        """Initializes settings, logging, and creates connections to vservers.
+                 log_file=False, config_file=None):
+        """Initializes settings and logging; vservers connect on first use.
 
         Arguments:
+            config_file (string): Conf file to read; CONFIG_FILE if None.
             debug_level (string): Level of debugging information to log.
             logger (instance): A previously instantiated HMDCLogger instance.
             log_console (boolean): Enable/disable logging to the console.
             log_file (string): Full path to log file; False if disabled.
         """
 
+        # First, so that every later ERROR_MSG is also kept per thread.
+        self._errors = threading.local()
         config_name = self.__class__.__name__
+        self.config_file = config_file or self.CONFIG_FILE
+        self.breakers = {}
         self.vservers = {}
+        self._connect_lock = threading.Lock()
+        self.svm_semaphores = {}
+        self.cache = None
+        # Overrides of (host, port) per vserver, e.g. for a FakeZapiServer.
+        self.endpoints = {}
+        self.index = None
+        self.journal = None
+        self.locality = None
+        self._locality_failed = False
+        self._locality_saved = time.time()
+        self.metrics = ZapiMetrics()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._rediscovered = 0
+        self._rediscovery_lock = threading.Lock()
+        self._topology_lock = threading.Lock()
+        self._topology_thread = None
 
         # Import conf file settings.
-        conf = ConfigParser.ConfigParser()
-        conf.read(self.CONFIG_FILE)
+        conf = ConfigParser.ConfigParser(self.CONFIG_DEFAULTS)
+        conf.read(self.config_file)
 
         self.options = {
             'debug_level': conf.get(config_name, 'debug_level'),
             'cdot_password': conf.get(config_name, 'cdot_password'),
+            'cdot_transport': conf.get(config_name, 'cdot_transport'),
             'cdot_username': conf.get(config_name, 'cdot_username'),
+            'breaker_reset': conf.getint(config_name, 'breaker_reset'),
+            'breaker_threshold': conf.getint(config_name,
+                                             'breaker_threshold'),
+            'cache_size': conf.getint(config_name, 'cache_size'),
+            'cache_ttl': conf.getint(config_name, 'cache_ttl'),
+            'call_timeout': conf.getint(config_name, 'call_timeout'),
+            'cluster_max_inflight': conf.getint(config_name,
+                                                'cluster_max_inflight'),
+            'cluster_rate': conf.getfloat(config_name, 'cluster_rate'),
+            'clusters': conf.get(config_name, 'clusters'),
+            'job_poll_interval': conf.getfloat(config_name,
+                                               'job_poll_interval'),
+            'journal': conf.get(config_name, 'journal'),
+            'journal_window': conf.getfloat(config_name, 'journal_window'),
+            'latency_apis': [name.strip() for name in
+                             conf.get(config_name, 'latency_apis').split(',')
+                             if name.strip()],
+            'latency_target': conf.getfloat(config_name, 'latency_target'),
+            'locality_cache': conf.get(config_name, 'locality_cache'),
+            'locality_flush': conf.getint(config_name, 'locality_flush'),
+            'max_records': conf.getint(config_name, 'max_records'),
+            'max_workers': conf.getint(config_name, 'max_workers'),
+            'pool_idle_timeout': conf.getint(config_name,
+                                             'pool_idle_timeout'),
+            'pool_size': conf.getint(config_name, 'pool_size'),
+            'retries': conf.getint(config_name, 'retries'),
+            'retry_backoff': conf.getfloat(config_name, 'retry_backoff'),
+            'shard_processes': conf.getint(config_name, 'shard_processes'),
+            'svm_max_inflight': conf.getint(config_name,
+                                            'svm_max_inflight'),
+            'svm_workers': conf.getint(config_name, 'svm_workers'),
+            'throttle': conf.get(config_name, 'throttle'),
+            'topology_cache': conf.get(config_name, 'topology_cache'),
+            'topology_ttl': conf.getint(config_name, 'topology_ttl'),
+            'vservers': [name.strip() for name in
+                         conf.get(config_name, 'vservers').split(',')
+                         if name.strip()],
         }
 
+        if self.options['cache_size'] > 0:
+            self.cache = QuotaCache(self.options['cache_size'],
+                                    self.options['cache_ttl'])
+
+        # Admission control for every NetApp call; any object with the same
+        # acquire/release/snapshot functions can be swapped in.
+        self.throttle = None
+        if self.options['throttle'] == 'adaptive':
+            self.throttle = QuotaThrottle(
+                self.options['svm_max_inflight'],
+                self.options['cluster_max_inflight'],
+                self.options['cluster_rate'],
+                self.options['latency_target'],
+                self._parse_clusters(self.options['clusters']),
+                self.options['latency_apis'])
+
         if (self.options['cdot_username'] == "" or
             self.options['cdot_password'] == ""):
             self.ERROR_MSG = "NetApp username or password not found."
@@ -117,12 +321,285 @@ class HMDCQuotas:
         else:
             self.hmdclog = logger
 
-        # Instantiate and authenticate NetApp connections.
-        for vserver in self.VOLUMES.iterkeys():
-            # API major release 1, minor 20.
-            self.vservers[vserver] = NaServer(vserver, 1, 20)
-            # Authenticate to the NetApp.
-            self._netapp_auth(vserver)
+        if self.options['journal']:
+            try:
+                self.journal = QuotaJournal(self.options['journal'])
+            except (IOError, OSError) as err:
+                self.hmdclog.log('error', "Could not open the journal " +
+                                 self.options['journal'] + ": " + str(err))
+
+        # Where groups were last found, to order searches by.
+        self.locality = QuotaLocality(self.options['locality_cache'])
+        if self.locality.load():
+            self.hmdclog.log('debug', "Loaded group locations from " +
+                             self.locality.path)
+
+        # Start from the cached topology, or VOLUMES the first time; a
+        # stale map is rediscovered in the background.
+        self.topology = QuotaTopology(self.options['topology_cache'],
+                                      self.options['topology_ttl'],
+                                      self.VOLUMES)
+        if self.topology.load():
+            self.hmdclog.log('debug', "Loaded topology from " +
+                             self.topology.path)
+        self._apply_topology()
+
+        # NetApp connections are made lazily by _netapp_connect.
+        self._check_topology()
+
+    def __setattr__(self, name, value):
+        # ERROR_MSG is shared by every thread; keep each thread's own copy
+        # too, for callers that run requests concurrently.
+        if name == 'ERROR_MSG' and '_errors' in self.__dict__:
+            self._errors.message = value
+        self.__dict__[name] = value
+
+    def _apply_topology(self):
+        """Publishes the topology map as VOLUMES, with a semaphore per SVM."""
+
+        for vserver in self.topology.volumes.iterkeys():
+            if vserver not in self.svm_semaphores:
+                # Caps the concurrent probes against a single SVM.
+                self.svm_semaphores[vserver] = threading.BoundedSemaphore(
+                    self.options['svm_workers'])
+
+        self.VOLUMES = self.topology.volumes
+
+    def _batch_resize_task(self, target):
+        """Worker body for modify_batch: starts one quota resize.
+
+        Arguments:
+            target (tuple): volume and vserver to resize.
+
+        Returns:
+            (instance): ResizeJob for the volume; false if it failed to start.
+        """
+
+        volume, vserver = target
+
+        with self.svm_semaphores[vserver]:
+            return self.resize(volume, vserver)
+
+    def _batch_task(self, change):
+        """Worker body for modify_batch: one add/delete/modify change.
+
+        Arguments:
+            change (dictionary): Change with its vserver already resolved.
+
+        Returns:
+            (instance): QuotaEntry of the change; false if it failed.
+        """
+
+        with self.svm_semaphores[change['vserver']]:
+            return self.modify(change['action'], change['group'],
+                               change['volume'], change['vserver'],
+                               change.get('policy'), change.get('size'),
+                               change.get('files'), resize=False)
+
+    def _check_topology(self):
+        """Starts a background rediscovery when the topology is stale.
+
+        Does nothing if discovery is disabled (topology_ttl of 0) or a
+        rediscovery is already running.
+        """
+
+        if self.options['topology_ttl'] <= 0 or not self.topology.is_stale():
+            return
+
+        with self._topology_lock:
+            if (self._topology_thread is not None and
+                    self._topology_thread.is_alive()):
+                return
+            self.hmdclog.log('debug', "Topology is stale; rediscovering.")
+            self._topology_thread = threading.Thread(
+                target=self._topology_task)
+            self._topology_thread.daemon = True
+            self._topology_thread.start()
+
+    def _convert_to_kb(self, disk_limit):
+        """Converts almost any file size unit into KB.
+
+        Arguments:
+            disk_limit (string): Disk size in any unit, with unit label.
+
+        Returns:
+            ((int, string)): Disk size in KB and None on success,
+                             or None and an error message on failure.
+        """
+
+        # Use regex to parse the disk quota into numeric values and units.
+        match = re.match(r"^([0-9]+)([a-z])[Bb]?$", disk_limit, re.I)
+        if match:
+            items = match.groups()
+        else:
+            error = "Unreadble disk quota format: " + disk_limit
+            self.hmdclog.log('error', error)
+            return (None, error)
+
+        size = int(items[0])
+        unit = items[1][0].upper()
+
+        self.hmdclog.log('debug', "Parsed disk quota: " + str(size) + unit)
+
+        # Sanity check so the numbers don't get out of control.
+        if unit in self.FILESIZES:
+            disk_limit = size * self.FILESIZES[unit]
+            _log_msg = "Converted disk quota: " + str(disk_limit)
+            self.hmdclog.log('debug', _log_msg)
+            return (int(disk_limit), None)
+        else:
+            error = "Unrecognized unit: " + unit
+            self.hmdclog.log('error', error)
+            return (None, error)
+
+    def _discover_task(self, vserver):
+        """Worker body for discover_volumes: lists the volumes of one SVM.
+
+        Arguments:
+            vserver (string): Management host of the SVM.
+
+        Returns:
+            ((string, tuple/None)): The vserver and its data volumes, or
+                                    None if the SVM could not be queried.
+        """
+
+        desired = NaElement('volume-attributes')
+        id_attributes = NaElement('volume-id-attributes')
+        id_attributes.child_add_string('name', '')
+        desired.child_add(id_attributes)
+        state_attributes = NaElement('volume-state-attributes')
+        state_attributes.child_add_string('is-vserver-root', '')
+        desired.child_add(state_attributes)
+
+        names = []
+
+        try:
+            for volume in self._netapp_iter(vserver, 'volume-get-iter',
+                                            desired=desired):
+                state = volume.child_get('volume-state-attributes')
+                if (state is not None and
+                        state.child_get_string('is-vserver-root') == 'true'):
+                    continue
+                names.append(volume.child_get('volume-id-attributes')
+                             .child_get_string('name'))
+        except RuntimeError:
+            self.hmdclog.log('warning', "Could not list volumes on " +
+                             vserver + ": " + self.ERROR_MSG)
+            return (vserver, None)
+
+        return (vserver, tuple(sorted(names)))
+
+    def _humanize_limits(self, disk_quota, file_quota):
+        """Makes raw NetApp disk and file limits human readable.
+
+        Arguments:
+            disk_quota (string): Disk limit in KB, as the NetApp reports it.
+            file_quota (string): Soft file limit, as the NetApp reports it.
+
+        Returns:
+            ((string, int)): Tuple of disk_quota, file_quota.
+        """
+
+        #
+        # The quota-get-entry disk-limit API reports in KB, but humanize
+        # translates bytes, therefore the * 1024.
+        #
+        self.hmdclog.log('debug', "Disk quota (raw): " + str(disk_quota))
+        disk_quota = int(disk_quota) * 1024
+        disk_quota = humanize.naturalsize(disk_quota, gnu=True)
+        self.hmdclog.log('info', "Disk quota: " + str(disk_quota))
+
+        file_quota = str(file_quota)
+        file_quota = None if file_quota == "-" else int(file_quota)
+        self.hmdclog.log('info', "File quota: " + str(file_quota))
+
+        return (disk_quota, file_quota)
+
+    def _index_task(self, target):
+        """Worker body for build_index: scans one volume into the index.
+
+        Arguments:
+            target (tuple): volume and vserver to scan.
+
+        Returns:
+            (int): Number of rules loaded from the volume.
+        """
+
+        volume, vserver = target
+        count = 0
+
+        for entry in self.list_entries(volume, vserver):
+            self.index.add(entry)
+            count += 1
+
+        self.index.mark_scanned(volume)
+        self.hmdclog.log('debug', "Indexed " + str(count) + " rules on " +
+                         volume)
+        return count
+
+    def _journal_lane(self, lane):
+        """Worker body for commit_journal: applies the changes of one rule.
+
+        Changes to the same rule are applied one after another, in journal
+        order, so the last one queued is the one that sticks. The lane stops
+        at the first change that could not reach the NetApp.
+
+        Arguments:
+            lane (list): (journal id, change) of each change to the rule.
+
+        Returns:
+            (list): QuotaEntry of each change tried, in order; false if it
+                    failed.
+        """
+
+        entries = []
+
+        for item in lane:
+            entries.append(self._journal_task(item))
+            # Later changes must not overtake one that may yet be applied.
+            if str(entries[-1].errno) == str(TRANSPORT_ERRNO):
+                break
+
+        return entries
+
+    def _journal_task(self, item):
+        """Applies one journaled change.
+
+        A change replayed after a crash may already be on the NetApp, so an
+        add that fails on an existing rule is retried as a modify, and a
+        delete that fails on a missing rule counts as done.
+
+        Arguments:
+            item (tuple): Journal id and change, with its vserver resolved.
+
+        Returns:
+            (instance): QuotaEntry of the change; false if it failed.
+        """
+
+        change_id, change = item
+        entry = self._batch_task(change)
+
+        if entry or change['action'] not in ('add', 'delete'):
+            return entry
+
+        found = self.group_lookup(change['group'], change.get('policy'),
+                                  change['volume'], change['vserver'])
+
+        if not found and str(found.errno) == str(TRANSPORT_ERRNO):
+            return found
+
+        if change['action'] == 'add' and found:
+            self.hmdclog.log('info', change['group'] + " already on " +
+                             change['volume'] + "; modifying instead.")
+            return self._batch_task(dict(change, action='modify'))
+
+        if change['action'] == 'delete' and not found:
+            self.hmdclog.log('info', change['group'] + " already gone from " +
+                             change['volume'] + ".")
+            return QuotaEntry(change['group'], change.get('policy') or
+                              'default', change['volume'], change['vserver'])
+
+        return entry
 
     def _netapp_auth(self, vserver):
         """Authenticates the vserver connections.
@@ -134,13 +611,198 @@ class HMDCQuotas:
         self.hmdclog.log('debug', "Authenticating \"" + vserver + "\"")
         svm = self.vservers[vserver]
         svm.set_style('LOGIN')
-        svm.set_transport_type('HTTPS')
+        svm.set_transport_type(self.options['cdot_transport'])
         svm.set_admin_user(self.options['cdot_username'],
                            self.options['cdot_password'])
 
-    def _netapp_invoke(self, action, group, volume, vserver, policy,
-                       disk_limit, file_limit):
-        """Handles invokes to the NetApp: add/delete/modify/search queries.
+    def _netapp_call(self, vserver, api, *args):
+        """Builds a flat ZAPI request and sends it, like NaServer.invoke.
+
+        Arguments:
+            api (string): Name of the ZAPI.
+            args (strings): Alternating child names and values.
+            vserver (string): The vserver to send the request to.
+
+        Returns:
+            (instance): NaElement results.
+        """
+
+        request = NaElement(api)
+
+        for i in range(0, len(args), 2):
+            request.child_add_string(args[i], args[i + 1])
+
+        return self._netapp_call_elem(vserver, api, request)
+
+    def _netapp_call_elem(self, vserver, api, request):
+        """Sends a ZAPI request to a vserver and records its metrics.
+
+        Every NetApp call goes through here. Calls to a vserver whose
+        circuit breaker is open fail at once; IDEMPOTENT_APIS are retried
+        with jittered backoff when the vserver cannot be reached.
+
+        Arguments:
+            api (string): Name of the ZAPI, for the metrics.
+            request (instance): NaElement request.
+            vserver (string): The vserver to send the request to.
+
+        Returns:
+            (instance): NaElement results; transport failures and skipped
+                        calls have errno TRANSPORT_ERRNO.
+        """
+
+        svm = self._netapp_connect(vserver)
+        breaker = self.breakers[vserver]
+
+        attempts = 1
+        if api in self.IDEMPOTENT_APIS:
+            attempts += max(0, self.options['retries'])
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                self.hmdclog.log('debug', "Skipping " + vserver +
+                                 "; its circuit breaker is open.")
+                return failed_result(TRANSPORT_ERRNO, "Skipped " + vserver +
+                                     " after repeated failures")
+
+            if self.throttle is not None:
+                self.throttle.acquire(vserver)
+
+            started = time.time()
+            result = None
+            try:
+                result = svm.invoke_elem(request)
+            finally:
+                elapsed = time.time() - started
+                if self.throttle is not None:
+                    self.throttle.release(
+                        vserver, elapsed, result is not None and
+                        str(result.results_errno()) in OVERLOAD_ERRNOS, api)
+
+            failed = result.results_status() == "failed"
+            self.metrics.record(api, vserver, elapsed, failed)
+
+            unreachable = (failed and
+                           str(result.results_errno()) == str(TRANSPORT_ERRNO))
+            breaker.record(not unreachable)
+
+            if not unreachable or attempt + 1 == attempts:
+                return result
+
+            delay = backoff_delay(attempt, self.options['retry_backoff'])
+            self.hmdclog.log('debug', "Retrying " + api + " on " + vserver +
+                             " in " + str(round(delay, 2)) + "s: " +
+                             str(result.results_reason()))
+            time.sleep(delay)
+
+    def _netapp_connect(self, vserver):
+        """Returns the vserver connection, creating it on first use.
+
+        Arguments:
+            vserver (string): Name of the vserver to connect to.
+
+        Returns:
+            (instance): Pooled ZapiTransport, or an authenticated NaServer
+                        when pool_size is 0.
+        """
+
+        with self._connect_lock:
+            if vserver in self.vservers:
+                return self.vservers[vserver]
+
+            host, port = self.endpoints.get(vserver, (vserver, None))
+            timeout = self.options['call_timeout'] or None
+            self.breakers[vserver] = CircuitBreaker(
+                self.options['breaker_threshold'],
+                self.options['breaker_reset'])
+
+            if self.options['pool_size'] > 0:
+                # API major release 1, minor 20, over keep-alive HTTPS.
+                self.hmdclog.log('debug', "Pooling \"" + vserver + "\"")
+                self.vservers[vserver] = ZapiTransport(
+                    host, 1, 20,
+                    self.options['cdot_username'],
+                    self.options['cdot_password'],
+                    self.options['pool_size'],
+                    self.options['pool_idle_timeout'],
+                    self.options['cdot_transport'],
+                    port,
+                    timeout,
+                    self.IDEMPOTENT_APIS)
+            else:
+                # API major release 1, minor 20.
+                self.vservers[vserver] = NaServer(host, 1, 20)
+                # Authenticate to the NetApp.
+                self._netapp_auth(vserver)
+                if port is not None:
+                    self.vservers[vserver].set_port(port)
+                if timeout is not None:
+                    self.vservers[vserver].set_timeout(timeout)
+
+            return self.vservers[vserver]
+
+
+    def _netapp_iter(self, vserver, api, query=None, desired=None):
+        """Pages through a NetApp *-iter query, one record at a time.
+
+        Each page is a single call of up to max_records records; the
+        next-tag of one page is passed as the tag of the next.
+
+        Arguments:
+            api (string): Name of the *-iter API to call.
+            desired (instance): NaElement placed in the desired-attributes
+                                field, to trim the records returned.
+            query (instance): NaElement placed in the query field.
+            vserver (string): The vserver to query.
+
+        Yields:
+            (instance): NaElement of each record in the attributes-list.
+
+        Raises:
+            RuntimeError: When the NetApp reports a failed query
+                          (also sets ERROR_MSG).
+        """
+
+        tag = None
+
+        while True:
+            request = NaElement(api)
+            request.child_add_string('max-records',
+                                     str(self.options['max_records']))
+            if query is not None:
+                wrapper = NaElement('query')
+                wrapper.child_add(query)
+                request.child_add(wrapper)
+            if desired is not None:
+                wrapper = NaElement('desired-attributes')
+                wrapper.child_add(desired)
+                request.child_add(wrapper)
+            if tag:
+                request.child_add_string('tag', tag)
+
+            self.hmdclog.log('debug', "Using action: " + api)
+            result = self._netapp_call_elem(vserver, api, request)
+
+            if result.results_status() == "failed":
+                self.ERROR_MSG = str(result.results_reason())
+                self.hmdclog.log('debug', self.ERROR_MSG)
+                raise RuntimeError(self.ERROR_MSG)
+
+            records = result.child_get('attributes-list')
+            if records is not None:
+                for record in records.children_get():
+                    yield record
+
+            tag = result.child_get_string('next-tag')
+            if not tag:
+                break
+
+    def _netapp_query(self, action, group, volume, vserver, policy,
+                      disk_limit, file_limit):
+        """Runs an add/delete/modify/search query and returns the raw result.
+
+        This touches no shared instance state, so it is safe to call from
+        several worker threads at once.
 
         Arguments:
             action (string): Type of NetApp query.
@@ -152,29 +814,23 @@ class HMDCQuotas:
             vserver (string): The vserver the volume lives on.
 
         Returns:
-            (boolean): True on success or False on failure
-                       (also sets ERROR_MSG on error)
+            (instance/None): NaElement result, or None for unknown actions.
         """
 
-        svm = self.vservers[vserver]
-
         # Convert the action to NetApp commands.
         if "add" in action:
             action = 'quota-add-entry'
-            self.hmdclog.log('debug', "Using action: " + action)
         elif "delete" in action:
             action = 'quota-delete-entry'
-            self.hmdclog.log('debug', "Using action: " + action)
         elif "modify" in action:
             action = 'quota-modify-entry'
-            self.hmdclog.log('debug', "Using action: " + action)
         elif "get" in action or "search" in action:
             action = 'quota-get-entry'
-            self.hmdclog.log('debug', "Using action: " + action)
         else:
-            self.ERROR_MSG = "Unrecognized action."
-            self.hmdclog.log('debug', self.ERROR_MSG)
-            return False
+            self.hmdclog.log('debug', "Unrecognized action.")
+            return None
+
+        self.hmdclog.log('debug', "Using action: " + action)
 
         # Set a default quota policy.
         if not policy:
@@ -182,56 +838,614 @@ class HMDCQuotas:
 
         # Delete and search queries do not use disk_limit and file_limit.
         if "delete" in action or "get" in action:
-            self.NA_INVOKE = svm.invoke(action,
-                                        'policy', policy,
-                                        'qtree', '',
-                                        'quota-target', group,
-                                        'quota-type', 'group',
-                                        'volume', volume)
-        elif "add" in action or "modify" in action:
-            self.NA_INVOKE = svm.invoke(action,
-                                        'policy', policy,
-                                        'qtree', '',
-                                        'quota-target', group,
-                                        'quota-type', 'group',
-                                        'volume', volume,
-                                        'disk-limit', disk_limit,
-                                        'soft-file-limit', file_limit)
-
-        if self.NA_INVOKE.results_status() == "failed":
-            self.ERROR_MSG = str(self.NA_INVOKE.results_reason())
+            return self._netapp_call(vserver, action,
+                                     'policy', policy,
+                                     'qtree', '',
+                                     'quota-target', group,
+                                     'quota-type', 'group',
+                                     'volume', volume)
+        else:
+            return self._netapp_call(vserver, action,
+                                     'policy', policy,
+                                     'qtree', '',
+                                     'quota-target', group,
+                                     'quota-type', 'group',
+                                     'volume', volume,
+                                     'disk-limit', disk_limit,
+                                     'soft-file-limit', file_limit)
+
+    def _netapp_resize(self, volume, vserver):
+        """Performs a quota resize on the NetApp to commit all quota changes.
+
+        Arguments:
+            volume (string): The volume where the group quota resides.
+            vserver (string): The vserver the volume lives on.
+
+        Returns:
+            (instance): QuotaEntry for the volume, false if the resize failed
+                        (also sets ERROR_MSG on error)
+        """
+
+        started = time.time()
+        result = self._netapp_call(vserver, 'quota-resize', 'volume', volume)
+
+        status = result.child_get_string("result-status")
+        error = result.child_get_string("result-error-message")
+        # status and error may be null if quota resize is done twice rapidly
+
+        self.hmdclog.log('debug', "Quota resize job is " + str(status))
+
+        errno = None
+        if result.results_status() == "failed":
+            # The call itself failed, rather than the resize job.
+            status = "failed"
+            error = result.results_reason()
+            errno = result.results_errno()
+
+        self.metrics.record_resize(volume, vserver, time.time() - started,
+                                   status == "failed")
+
+        if status == "failed":
+            self.ERROR_MSG = str(error)
             self.hmdclog.log('debug', self.ERROR_MSG)
-            return False
+            return QuotaEntry(None, None, volume, vserver, error=str(error),
+                              errno=errno)
+        else:
+            return QuotaEntry(None, None, volume, vserver)
+
+    def _scan_task(self, target):
+        """Worker body for reconcile, search_groups and entries: reads every
+        group rule on a volume.
+
+        Arguments:
+            target (tuple): volume and vserver to scan.
+
+        Returns:
+            ((list, string)): QuotaEntry of each rule and None on success,
+                              or None and an error message on failure.
+        """
+
+        volume, vserver = target
+
+        try:
+            with self.svm_semaphores[vserver]:
+                return (list(self.list_entries(volume, vserver)), None)
+        except RuntimeError as err:
+            return (None, str(err))
+
+    def _parse_clusters(self, setting):
+        """Parses the clusters setting into a vserver to cluster map.
+
+        Arguments:
+            setting (string): "cluster: svm, svm; cluster: svm".
+
+        Returns:
+            (dictionary): {vserver: cluster}.
+        """
+
+        clusters = {}
+
+        for spec in setting.split(';'):
+            if ':' not in spec:
+                continue
+            cluster, vservers = spec.split(':', 1)
+            for vserver in vservers.split(','):
+                if vserver.strip():
+                    clusters[vserver.strip()] = cluster.strip()
+
+        return clusters
+
+    def _remember_location(self, entry):
+        """Records where a lookup did, or did not, find a group.
+
+        Arguments:
+            entry (instance): QuotaEntry result of the lookup; transport
+                              failures say nothing and are ignored.
+        """
+
+        if entry:
+            self.locality.found(entry.group, entry.volume)
+        elif str(entry.errno) != str(TRANSPORT_ERRNO):
+            self.locality.forget(entry.group, entry.volume)
+
+    def _save_locality(self, force=False):
+        """Writes the group locations to their cache file, if they changed.
+
+        Lookups only mark the map dirty; it is written at most once every
+        locality_flush seconds, and by close(), to keep file writes off the
+        search path.
+
+        Arguments:
+            force (boolean): Write now, however recently it was written.
+        """
+
+        if (not force and time.time() - self._locality_saved <
+                self.options['locality_flush']):
+            return
+        self._locality_saved = time.time()
+
+        try:
+            self.locality.save()
+        except (IOError, OSError) as err:
+            # Say so once; an unwritable cache fails the same way each time.
+            level = 'debug' if self._locality_failed else 'warning'
+            self._locality_failed = True
+            self.hmdclog.log(level, "Could not save group locations to " +
+                             str(self.locality.path) + ": " + str(err))
+
+    def _search_concurrent(self, group, policy, targets):
+        """Probes many volumes at once on the worker pool.
+
+        Every (volume, vserver) pair becomes one quota-get-entry call; the
+        calls run in parallel, bounded by max_workers overall and by
+        svm_workers per vserver.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            targets (list): (volume, vserver) tuples to probe.
+
+        Returns:
+            (instance): SearchResults keyed by vserver, then volume.
+        """
+
+        tasks = [(group, policy, volume, vserver)
+                 for volume, vserver in targets]
+
+        return self._search_fold(self._worker_pool().map(self._search_task,
+                                                         tasks))
+
+    def _search_first(self, group, policy, targets, concurrent=False):
+        """Probes volumes in order until the group is found.
+
+        The volumes the group was last found on are probed one at a time.
+        If none holds it, the rest are probed in parallel when concurrent,
+        which returns every hit among them, or else one at a time until the
+        first hit.
+
+        Arguments:
+            concurrent (boolean): Probe the volumes without a remembered
+                                  location in parallel.
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            targets (list): (volume, vserver) tuples, likeliest first.
+
+        Returns:
+            (instance): SearchResults keyed by vserver, then volume.
+        """
+
+        known = self.locality.known(group)
+        entries = []
+
+        for position, (volume, vserver) in enumerate(targets):
+            if concurrent and volume not in known:
+                rest = [(group, policy, name, owner)
+                        for name, owner in targets[position:]]
+                entries.extend(self._worker_pool().map(self._search_task,
+                                                       rest))
+                break
+
+            self.hmdclog.log('debug', "Searching " + volume)
+            entry = self.group_lookup(group, policy, volume, vserver)
+            entries.append(entry)
+            if entry:
+                break
+
+        return self._search_fold(entries)
+
+    def _search_fold(self, entries):
+        """Gathers probe results into matches and unreachable vservers.
+
+        Arguments:
+            entries (list): QuotaEntry result of each probe.
+
+        Returns:
+            (instance): SearchResults of the hits, flagging every vserver
+                        with a probe that could not reach it.
+        """
+
+        matches = SearchResults()
+
+        for entry in entries:
+            if entry:
+                matches.setdefault(entry.vserver, {})[entry.volume] = entry
+            elif entry.errno == TRANSPORT_ERRNO:
+                matches.unreachable[entry.vserver] = entry.error
+
+        return matches
+
+    def _search_task(self, task):
+        """Worker body for _search_concurrent: a single quota-get-entry.
+
+        Arguments:
+            task (tuple): group, policy, volume and vserver to probe.
+
+        Returns:
+            (instance): QuotaEntry; false on a miss or failure.
+        """
+
+        group, policy, volume, vserver = task
+        self.hmdclog.log('debug', "Searching " + volume)
+
+        with self.svm_semaphores[vserver]:
+            return self.group_lookup(group, policy, volume, vserver)
+
+    def _search_index(self, group, policy, targets):
+        """Answers a search from the index wherever it covers the volume.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            targets (list): (volume, vserver) tuples to search.
+
+        Returns:
+            ((dictionary, list)): Matches found in the index, and the targets
+                                  the index does not cover.
+        """
+
+        if self.index is None:
+            return ({}, targets)
+
+        matches = {}
+        remaining = []
+        rules = self.index.lookup(group, policy or 'default')
+
+        for volume, vserver in targets:
+            if not self.index.covers(volume):
+                remaining.append((volume, vserver))
+                continue
+            entry = rules.get(vserver, {}).get(volume)
+            if entry is None:
+                continue
+            self.hmdclog.log('info', group + " found on " + volume)
+            matches.setdefault(vserver, {})[volume] = entry
+
+        return (matches, remaining)
+
+    def _search_serial(self, group, policy, targets):
+        """Probes volumes one at a time.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            targets (list): (volume, vserver) tuples to probe.
+
+        Returns:
+            (instance): SearchResults keyed by vserver, then volume.
+        """
+
+        entries = []
+
+        for volume, vserver in targets:
+            self.hmdclog.log('debug', "Searching " + volume)
+            entries.append(self.group_lookup(group, policy, volume, vserver))
+
+        return self._search_fold(entries)
+
+    def _search_targets(self, group, policy, targets, concurrent=False,
+                        first_hit=False):
+        """Searches a set of volumes, from the index first, then the NetApp.
+
+        Volumes are searched likeliest first, as the locality map ranks
+        them.
+
+        Arguments:
+            concurrent (boolean): Probe uncovered volumes in parallel.
+            first_hit (boolean): Stop at the first volume holding the group.
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            targets (list): (volume, vserver) tuples to search.
+
+        Returns:
+            (instance): SearchResults keyed by vserver, then volume.
+        """
+
+        targets = self.locality.order(group, targets)
+        indexed, targets = self._search_index(group, policy, targets)
+
+        if not targets or (first_hit and indexed):
+            matches = SearchResults()
+        elif first_hit:
+            matches = self._search_first(group, policy, targets, concurrent)
+        elif concurrent:
+            matches = self._search_concurrent(group, policy, targets)
         else:
-            return True
+            matches = self._search_serial(group, policy, targets)
+
+        for vserver, volumes in indexed.iteritems():
+            matches.setdefault(vserver, {}).update(volumes)
+
+        return matches
+
+    def _size_task(self, vserver):
+        """Worker body for volume_sizes: reads the volume sizes of one SVM.
+
+        Arguments:
+            vserver (string): Management host of the SVM.
+
+        Returns:
+            ((string, dictionary)): The vserver and {volume: size in KB} of
+                                    its known data volumes; empty if the SVM
+                                    could not be queried.
+        """
+
+        desired = NaElement('volume-attributes')
+        id_attributes = NaElement('volume-id-attributes')
+        id_attributes.child_add_string('name', '')
+        desired.child_add(id_attributes)
+        space_attributes = NaElement('volume-space-attributes')
+        space_attributes.child_add_string('size', '')
+        desired.child_add(space_attributes)
+
+        names = self.VOLUMES.get(vserver, ())
+        sizes = {}
+
+        try:
+            for volume in self._netapp_iter(vserver, 'volume-get-iter',
+                                            desired=desired):
+                name = (volume.child_get('volume-id-attributes')
+                        .child_get_string('name'))
+                space = volume.child_get('volume-space-attributes')
+                if name not in names or space is None:
+                    continue
+                # volume-get-iter reports bytes; quotas are in KB.
+                sizes[name] = int(space.child_get_string('size')) / 1024
+        except RuntimeError:
+            self.hmdclog.log('warning', "Could not read volume sizes on " +
+                             vserver + ": " + self.ERROR_MSG)
+
+        return (vserver, sizes)
+
+    def _rediscover(self, known):
+        """Rediscovers the topology at once after a lookup missed.
+
+        Runs at most once every MISS_REDISCOVERY seconds, so lookups of
+        mistyped names cannot hammer the SVMs, and never when discovery is
+        disabled (topology_ttl of 0). Concurrent misses share one discovery.
+
+        Arguments:
+            known (function): Returns whether the name looked up is in the
+                              current map.
+
+        Returns:
+            (boolean): True if the name is known after waiting or
+                       rediscovering, False otherwise.
+        """
+
+        if self.options['topology_ttl'] <= 0:
+            return False
+
+        with self._rediscovery_lock:
+            # Another thread may have rediscovered while this one waited.
+            if known():
+                return True
+            if time.time() - self._rediscovered < self.MISS_REDISCOVERY:
+                return False
+            self._rediscovered = time.time()
+            self.hmdclog.log('info', "Lookup missed the topology; "
+                             "rediscovering.")
+            self.discover_volumes()
+
+        return bool(known())
+
+    def _topology_task(self):
+        """Thread body for a background rediscovery of the topology."""
+
+        try:
+            self.discover_volumes()
+        except Exception as err:
+            # Never let a background refresh take the caller down.
+            self.hmdclog.log('error', "Topology discovery failed: " +
+                             str(err))
+
+    def _volume_targets(self, volume=None, vserver=None):
+        """Returns the volumes a fleet-wide job should cover.
+
+        Arguments:
+            volume (string): Only this volume.
+            vserver (string): Only the volumes of this vserver; every
+                              volume in VOLUMES if neither is given.
+
+        Returns:
+            (list): (volume, vserver) tuples.
+
+        Raises:
+            RuntimeError: On an unknown volume or vserver
+                          (also sets ERROR_MSG).
+        """
+
+        if volume is not None:
+            owner = self.get_vserver(volume)
+            if not owner:
+                raise RuntimeError(self.ERROR_MSG)
+            return [(volume, owner)]
+
+        if vserver is not None:
+            if vserver not in self.VOLUMES and not self._rediscover(
+                    lambda: vserver in self.VOLUMES):
+                self.ERROR_MSG = "Could not find vserver " + vserver + "."
+                raise RuntimeError(self.ERROR_MSG)
+            return [(name, vserver) for name in self.VOLUMES[vserver]]
+
+        self._check_topology()
+        return [(name, owner)
+                for owner, volumes in sorted(self.VOLUMES.iteritems())
+                for name in volumes]
+
+    def _worker_pool(self):
+        """Returns the shared worker pool, creating it on first use.
+
+        Returns:
+            (instance): ThreadPool sized by the max_workers setting.
+        """
+
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.options['max_workers'])
+            return self._pool
+
+    def build_index(self, volumes=None):
+        """Bulk loads group quota rules into an in-memory index.
+
+        Each volume costs one paginated quota-list-entries-iter scan instead
+        of one quota-get-entry per group; afterwards search_vservers and
+        search_volumes answer from the index for every scanned volume.
+
+        Arguments:
+            volumes (list): Volumes to scan; all of VOLUMES if None.
+
+        Returns:
+            (int/boolean): Number of rules loaded on success, False on
+                           failure (also sets ERROR_MSG on error).
+        """
+
+        self._check_topology()
+        targets = []
+        for vserver, names in self.VOLUMES.iteritems():
+            for name in names:
+                if volumes is None or name in volumes:
+                    targets.append((name, vserver))
+
+        self.index = QuotaIndex()
+        self.hmdclog.log('info', "Indexing " + str(len(targets)) +
+                         " volumes.")
+
+        try:
+            counts = self._worker_pool().map(self._index_task, targets)
+        except RuntimeError:
+            self.index = None
+            return False
 
-    def _netapp_resize(self, volume, vserver):
-        """Performs a quota resize on the NetApp to commit all quota changes.
+        return sum(counts)
 
-        Arguments:
-            volume (string): The volume where the group quota resides.
-            vserver (string): The vserver the volume lives on.
+    def cache_stats(self):
+        """Returns lookup cache hit/miss counters.
 
         Returns:
-            (boolean): True on success or False on failure
-                       (also sets ERROR_MSG on error)
+            (dictionary/boolean): entries, evictions, hits and misses;
+                                  False if the cache is disabled.
         """
 
-        svm = self.vservers[vserver]
-        self.NA_INVOKE = svm.invoke('quota-resize','volume',volume)
+        if self.cache is None:
+            return False
 
-        status = self.NA_INVOKE.child_get_string("result-status")
-        error = self.NA_INVOKE.child_get_string("result-error-message")
-        # status and error may be null if quota resize is done twice rapidly
+        return self.cache.stats()
 
-        self.hmdclog.log('debug', "Quota resize job is " + str(status))
+    def close(self):
+        """Shuts down the worker pool and closes pooled connections."""
 
-        if status == "failed":
-            self.ERROR_MSG = str(error)
-            self.hmdclog.log('debug', self.ERROR_MSG)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+        self._save_locality(force=True)
+
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+        with self._connect_lock:
+            for svm in self.vservers.itervalues():
+                if isinstance(svm, ZapiTransport):
+                    svm.close()
+
+    def commit_journal(self, wait=False, progress=None):
+        """Applies journaled changes with one resize per volume.
+
+        Every change queued and not yet applied is applied, its outcome
+        journaled; then each volume with applied but uncommitted changes,
+        including those left by a crash, gets one quota resize. Replaying
+        is idempotent, so a commit can always be retried. A change that
+        could not reach the NetApp, and any later change to the same rule,
+        stays queued for the next commit; only rejected changes are
+        journaled as failed.
+
+        Arguments:
+            progress (function): Called with each ResizeJob whose state
+                                 changes while waiting.
+            wait (boolean): Wait for the resize jobs, and journal only those
+                            that finished; otherwise a started resize is
+                            journaled as done.
+
+        Returns:
+            (list/boolean): (change, error) tuples for each failed change or
+                            resize, as modify_batch; False if there is no
+                            journal (also sets ERROR_MSG on error).
+        """
+
+        if self.journal is None:
+            self.ERROR_MSG = "No journal is configured."
             return False
-        else:
-            return True
+
+        # Another thread or process sharing the journal must not apply the
+        # same changes in between.
+        with self.journal.committing():
+            pending, unresized = self.journal.outstanding()
+            failures = []
+
+            if pending:
+                self.hmdclog.log('info', "Applying " + str(len(pending)) +
+                                 " journaled changes.")
+                # Changes to different rules run in parallel; changes to
+                # one rule, in journal order.
+                lanes = {}
+                for change_id, change in pending:
+                    key = (change['group'], change.get('policy') or 'default',
+                           change['volume'], change['vserver'])
+                    lanes.setdefault(key, []).append((change_id, change))
+                lanes = lanes.values()
+                results = self._worker_pool().map(self._journal_lane, lanes)
+
+                outcomes = []
+                for lane, entries in zip(lanes, results):
+                    for (change_id, change), entry in zip(lane, entries):
+                        if entry:
+                            outcomes.append((change_id, None))
+                            unresized.setdefault((change['volume'],
+                                                  change['vserver']),
+                                                 []).append(change_id)
+                        elif str(entry.errno) == str(TRANSPORT_ERRNO):
+                            # Unreachable, not rejected: the change and the
+                            # rest of its lane stay queued for the next try.
+                            failures.append((change, entry.error +
+                                             " (left queued)"))
+                        else:
+                            failures.append((change, entry.error))
+                            outcomes.append((change_id, entry.error))
+                self.journal.record_applied(outcomes)
+
+                held = len(pending) - len(outcomes)
+                if held:
+                    self.hmdclog.log('warning', str(held) + " journaled " +
+                                     "changes could not reach the NetApp; " +
+                                     "left queued for retry.")
+
+            targets = sorted(unresized)
+            self.hmdclog.log('info', "Resizing " + str(len(targets)) +
+                             " volumes.")
+            jobs = self._worker_pool().map(self._batch_resize_task, targets)
+
+            if wait:
+                jobs = self.wait_resize_jobs(jobs, progress=progress)
+
+            resized = []
+            for job in jobs:
+                if job:
+                    resized.append((job.volume, job.vserver,
+                                    unresized[(job.volume, job.vserver)]))
+                else:
+                    failures.append(({'action': 'resize',
+                                      'volume': job.volume,
+                                      'vserver': job.vserver},
+                                     job.error or "Resize job " + job.state))
+            self.journal.record_resized(resized)
+
+            if self.journal.compact():
+                self.hmdclog.log('debug', "Journal emptied.")
+
+        return failures
 
     def convert_to_kb(self, disk_limit):
         """Converts almost any file size unit into KB.
@@ -244,39 +1458,23 @@ class HMDCQuotas:
                        (also sets ERROR_MSG on error)
         """
 
-        # Use regex to parse the disk quota into numeric values and units.
-        match = re.match(r"^([0-9]+)([a-z])[Bb]?$", disk_limit, re.I)
-        if match:
-            items = match.groups()
-        else:
-            self.ERROR_MSG = "Unreadble disk quota format: " + disk_limit
-            self.hmdclog.log('error', self.ERROR_MSG)
-            return False
-
-        size = int(items[0])
-        unit = items[1][0].upper()
-
-        self.hmdclog.log('debug', "Parsed disk quota: " + str(size) + unit)
+        disk_limit, error = self._convert_to_kb(disk_limit)
 
-        # Sanity check so the numbers don't get out of control.
-        if unit in self.FILESIZES:
-            disk_limit = size * self.FILESIZES[unit]
-            _log_msg = "Converted disk quota: " + str(disk_limit)
-            self.hmdclog.log('debug', _log_msg)
-            return int(disk_limit)
-        else:
-            self.ERROR_MSG = "Unrecognized unit: " + unit
-            self.hmdclog.log('error', self.ERROR_MSG)
+        if error:
+            self.ERROR_MSG = error
             return False
 
-    def humanize_quotas(self):
+        return disk_limit
+
+    def humanize_quotas(self, na_invoke=None):
         """Makes NetApp quota results human readable.
 
            Requires that NA_INVOKE is defined by
-           first calling modify() or group_lookup().
+           first calling modify() or group_lookup(),
+           unless a result is passed in directly.
 
         Arguments:
-            (none)
+            na_invoke (instance): NaElement result to read; NA_INVOKE if None.
 
         Returns:
             ((boolean)/(string, string)): Tuple of disk_quota, file_quota;
@@ -284,31 +1482,105 @@ class HMDCQuotas:
                                           (also sets ERROR_MSG on error)
         """
 
-        if not self.NA_INVOKE:
+        if na_invoke is None:
+            na_invoke = self.NA_INVOKE
+
+        if not na_invoke:
             self.ERROR_MSG = "NA_INVOKE is null in humanize_quotas; search first"
             self.hmdclog.log('error', self.ERROR_MSG)
             return False
 
-        #
-        # The quota-get-entry disk-limit API reports in KB, but humanize
-        # translates bytes, therefore the * 1024.
-        #
-        disk_quota = self.NA_INVOKE.child_get_string("disk-limit")
-        self.hmdclog.log('debug', "Disk quota (raw): " + str(disk_quota))
-        disk_quota = int(disk_quota) * 1024
-        disk_quota = humanize.naturalsize(disk_quota, gnu=True)
-        self.hmdclog.log('info', "Disk quota: " + str(disk_quota))
+        return self._humanize_limits(
+            na_invoke.child_get_string("disk-limit"),
+            na_invoke.child_get_string("soft-file-limit"))
 
-        file_quota = self.NA_INVOKE.child_get_string("soft-file-limit")
-        file_quota = str(file_quota)
-        file_quota = None if file_quota == "-" else int(file_quota)
-        self.hmdclog.log('info', "File quota: " + str(file_quota))
+    def discover_volumes(self):
+        """Rediscovers the SVMs and their volumes via volume-get-iter.
 
-        return (disk_quota, file_quota)
+        Every known SVM, plus those listed in the vservers setting, is asked
+        for its data volumes. An SVM that cannot be reached keeps the
+        volumes it had. The new map replaces VOLUMES and is written to the
+        topology cache file.
+
+        Returns:
+            (dictionary/boolean): The discovered map on success, False if no
+                                  SVM could be queried
+                                  (also sets ERROR_MSG on error)
+        """
+
+        previous = self.topology.volumes
+        vservers = sorted(set(previous) | set(self.options['vservers']))
+        self.hmdclog.log('info', "Discovering volumes on " +
+                         str(len(vservers)) + " vservers.")
+
+        volumes = {}
+        reached = 0
+
+        for vserver, names in self._worker_pool().map(self._discover_task,
+                                                      vservers):
+            if names is None:
+                if vserver in previous:
+                    volumes[vserver] = previous[vserver]
+                continue
+            reached += 1
+            volumes[vserver] = names
+
+        if not reached:
+            self.ERROR_MSG = "Could not discover volumes on any vserver."
+            self.hmdclog.log('error', self.ERROR_MSG)
+            return False
+
+        self.topology.replace(volumes)
+        self._apply_topology()
+
+        try:
+            self.topology.save()
+        except (IOError, OSError) as err:
+            self.hmdclog.log('warning', "Could not save topology to " +
+                             str(self.topology.path) + ": " + str(err))
+
+        return volumes
+
+    def drop_index(self):
+        """Discards the in-memory index; searches go back to the NetApp."""
+
+        self.index = None
+
+    def entries(self, volume=None, vserver=None):
+        """Yields every group quota rule, scanning volumes in parallel.
+
+        Each volume is one paginated quota-list-entries-iter scan on the
+        worker pool; rules are yielded volume by volume, in order.
+
+        Arguments:
+            volume (string): Only this volume.
+            vserver (string): Only the volumes of this vserver; every
+                              volume in VOLUMES if neither is given.
+
+        Yields:
+            (instance): QuotaEntry of each volume-level group rule.
+
+        Raises:
+            RuntimeError: On an unknown volume or a failed scan
+                          (also sets ERROR_MSG).
+        """
+
+        targets = self._volume_targets(volume, vserver)
+
+        for entries, error in self._worker_pool().imap(self._scan_task,
+                                                       targets):
+            if entries is None:
+                self.ERROR_MSG = error
+                raise RuntimeError(error)
+            for entry in entries:
+                yield entry
 
     def get_vserver(self, volume_to_find):
         """Returns the vserver of the given volume.
 
+        A volume missing from the topology triggers one synchronous
+        rediscovery, at most every MISS_REDISCOVERY seconds.
+
         Arguments:
             volume_to_find (string): Name of the volume to search for.
 
@@ -317,13 +1589,20 @@ class HMDCQuotas:
                               (also sets ERROR_MSG on error)
         """
 
-        for vserver, volumes in self.VOLUMES.iteritems():
-            if volume_to_find in volumes:
-                self.hmdclog.log('debug', "Found vserver " + vserver)
-                return vserver
+        self._check_topology()
+        vserver = self.topology.vserver_of(volume_to_find)
+
+        # A volume created since the last discovery is found right away.
+        if vserver is None and self._rediscover(
+                lambda: self.topology.vserver_of(volume_to_find)):
+            vserver = self.topology.vserver_of(volume_to_find)
+
+        if vserver is not None:
+            self.hmdclog.log('debug', "Found vserver " + vserver)
+            return vserver
         else:
             self.ERROR_MSG = "Could not find volume " + volume_to_find + "."
-            _log_msg = volume_to_find + " not found in VOLUMES dictionary"
+            _log_msg = volume_to_find + " not found in the volume topology"
             self.hmdclog.log('error', _log_msg)
             return False
 
@@ -337,23 +1616,222 @@ class HMDCQuotas:
             vserver (string): The vserver the volume lives on.
 
         Returns:
-            (boolean): True on success or False on failure
-                       (also sets ERROR_MSG on error)
+            (instance): QuotaEntry with the group's limits; false if the group
+                        was not found (also sets ERROR_MSG on error)
         """
 
-        result = self._netapp_invoke('search', group, volume, vserver, policy,
-                                     None, None)
-
-        if not result:
+        policy = policy or 'default'
+
+        if self.cache is not None:
+            entry = self.cache.get(group, policy, volume)
+            if entry is not None:
+                self.hmdclog.log('debug', "Cache hit for " + group + " on " +
+                                 volume)
+                self._remember_location(entry)
+                return entry
+
+        result = self._netapp_query('search', group, volume, vserver, policy,
+                                    None, None)
+        self.NA_INVOKE = result
+
+        if result.results_status() == "failed":
+            errno = result.results_errno()
+            self.hmdclog.log('debug', str(result.results_reason()))
+            # Transport failures say nothing about the rule; don't cache them.
+            if str(errno) == str(TRANSPORT_ERRNO):
+                self.ERROR_MSG = ("Could not search " + volume + ": " +
+                                  str(result.results_reason()))
+                self.hmdclog.log('warning', self.ERROR_MSG)
+                return QuotaEntry(group, policy, volume, vserver,
+                                  error=self.ERROR_MSG, errno=errno)
             self.ERROR_MSG = group + " not found on " + volume
             self.hmdclog.log('debug', self.ERROR_MSG)
-            return False
+            entry = QuotaEntry(group, policy, volume, vserver,
+                               error=self.ERROR_MSG, errno=errno)
         else:
             self.hmdclog.log('info', group + " found on " + volume)
-            return True
+            entry = QuotaEntry(group, policy, volume, vserver,
+                               result.child_get_string("disk-limit"),
+                               result.child_get_string("soft-file-limit"))
+
+        if self.cache is not None:
+            self.cache.put(entry)
+
+        self._remember_location(entry)
+        return entry
+
+    def job_status(self, job):
+        """Polls the cluster for the state of a resize job via job-get.
+
+        Arguments:
+            job (instance): ResizeJob to refresh.
+
+        Returns:
+            (instance): New ResizeJob with the current state; the same job
+                        if it is done, or if the cluster could not be
+                        reached.
+        """
+
+        if job.done:
+            return job
+
+        result = self._netapp_call(job.vserver, 'job-get',
+                                   'job-id', str(job.jobid))
+
+        if result.results_status() == "failed":
+            if str(result.results_errno()) == str(TRANSPORT_ERRNO):
+                # Try again on the next poll.
+                return job
+            self.hmdclog.log('warning', "Lost track of resize job " +
+                             str(job.jobid) + " on " + job.volume + ": " +
+                             str(result.results_reason()))
+            return ResizeJob(job.volume, job.vserver, job.jobid, 'unknown',
+                             job.progress, str(result.results_reason()),
+                             job.started)
+
+        info = result.child_get('attributes').child_get('job-info')
+        state = info.child_get_string('job-state')
+        error = None
+        if state in ResizeJob.FAILED:
+            error = info.child_get_string('job-completion') or \
+                "Resize job " + state
+
+        return ResizeJob(job.volume, job.vserver, job.jobid, state,
+                         info.child_get_string('job-progress'), error,
+                         job.started)
+
+    def list_entries(self, volume, vserver):
+        """Yields every group quota rule on a volume.
+
+        Arguments:
+            volume (string): The volume to scan.
+            vserver (string): The vserver the volume lives on.
+
+        Yields:
+            (instance): QuotaEntry of each volume-level group rule.
+
+        Raises:
+            RuntimeError: When the NetApp reports a failed query
+                          (also sets ERROR_MSG).
+        """
+
+        query = NaElement('quota-entry')
+        query.child_add_string('quota-type', 'group')
+        query.child_add_string('volume', volume)
+
+        for entry in self._netapp_iter(vserver, 'quota-list-entries-iter',
+                                       query):
+            # Only volume-level rules are visible to quota-get-entry.
+            if entry.child_get_string('qtree'):
+                continue
+            yield QuotaEntry(entry.child_get_string('quota-target'),
+                             entry.child_get_string('policy'),
+                             volume,
+                             vserver,
+                             entry.child_get_string('disk-limit'),
+                             entry.child_get_string('soft-file-limit'))
+
+    def migrate(self, source, target, pattern=None, policy=None,
+                dry_run=False, wait=False, progress=None):
+        """Copies group quota rules from one volume to another, in bulk.
+
+        The source is read with one bulk scan and handed to reconcile as
+        the desired state of the target, so only missing or differing rules
+        are written, concurrently, with one resize of the target. Once
+        applied, the target is scanned again and every copied rule checked.
+        Rules with an unlimited disk or file limit cannot be expressed as a
+        change and are reported rather than copied.
+
+        Arguments:
+            dry_run (boolean): Only compute the changes; apply nothing.
+            pattern (string): Only groups matching this shell pattern.
+            policy (string): Only rules of this quota policy; any if None.
+            progress (function): Called with each ResizeJob whose state
+                                 changes while waiting.
+            source (string): Volume to copy the rules from.
+            target (string): Volume to copy the rules to; it may be on
+                             another vserver.
+            wait (boolean): Wait until the resize job has finished.
+
+        Returns:
+            ((list, list)/boolean): Changes and failures, as reconcile
+                                    returns them, with a verify failure for
+                                    each rule that did not land; False on
+                                    error (also sets ERROR_MSG).
+        """
+
+        vservers = {}
+        for volume in (source, target):
+            vservers[volume] = self.get_vserver(volume)
+            if not vservers[volume]:
+                self.ERROR_MSG = "Could not find volume " + volume + "."
+                return False
+
+        if source == target:
+            self.ERROR_MSG = "Source and target are the same volume."
+            return False
+
+        entries, error = self._scan_task((source, vservers[source]))
+        if error:
+            self.ERROR_MSG = ("Could not read rules on " + source + ": " +
+                              error)
+            self.hmdclog.log('error', self.ERROR_MSG)
+            return False
+
+        desired = []
+        skipped = []
+        for entry in entries:
+            if pattern and not fnmatch.fnmatchcase(entry.group, pattern):
+                continue
+            if policy and entry.policy != policy:
+                continue
+            if entry.disk_limit is None or entry.file_limit is None:
+                # A change always sets both limits; unlimited would become
+                # the defaults instead.
+                skipped.append(({'action': 'migrate', 'group': entry.group,
+                                 'volume': source},
+                                "Unlimited disk or file limit; not copied."))
+                continue
+            desired.append({'group': entry.group, 'volume': target,
+                            'policy': entry.policy,
+                            'size': str(entry.disk_limit) + 'K',
+                            'files': entry.file_limit})
+
+        self.hmdclog.log('info', "Migrating " + str(len(desired)) +
+                         " rules from " + source + " to " + target + ".")
+
+        changes, failures = self.reconcile(desired, dry_run=dry_run,
+                                           wait=wait, progress=progress)
+        failures = skipped + failures
+
+        if dry_run or not changes:
+            return (changes, failures)
+
+        # Check every copied rule against a fresh scan of the target.
+        entries, error = self._scan_task((target, vservers[target]))
+        if error:
+            failures.append(({'action': 'verify', 'volume': target}, error))
+            return (changes, failures)
+
+        landed = dict(((entry.group, entry.policy),
+                       (entry.disk_limit, entry.file_limit))
+                      for entry in entries)
+        # Rules whose change failed are already reported.
+        failed = set((change.get('group'), change.get('policy'))
+                     for change, error in failures)
+        for row in desired:
+            if (row['group'], row['policy']) in failed:
+                continue
+            if landed.get((row['group'], row['policy'])) != (
+                    int(row['size'][:-1]), row['files']):
+                failures.append(({'action': 'verify', 'group': row['group'],
+                                  'volume': target},
+                                 "Rule does not match the source."))
+
+        return (changes, failures)
 
     def modify(self, action, group, volume, vserver, policy, disk_limit=None,
-               file_limit=None):
+               file_limit=None, resize=True):
         """Preps disk and file quotas, then executes add/delete/modify queries.
 
         Arguments:
@@ -362,24 +1840,29 @@ class HMDCQuotas:
             file_limit (int): Number of maximum files allowed for the group.
             group (string): Name of the LDAP group.
             policy (string): Name of the quota policy.
+            resize (boolean): Commit with a quota resize; False leaves the
+                              resize to the caller.
             volume (string): The volume where the group quota resides.
             vserver (string): The vserver the volume lives on.
 
         Returns:
-            (boolean): True on success or False on failure
-                       (also sets ERROR_MSG on error)
+            (instance): QuotaEntry with the new limits; false on failure
+                        (also sets ERROR_MSG on error)
         """
 
+        policy = policy or 'default'
+
         # Set the disk quota.
         if disk_limit is None:
             disk_limit = self.DEFAULT_QUOTA
             _log_msg = "Used default disk quota: " + str(self.DEFAULT_QUOTA)
             self.hmdclog.log('debug', _log_msg)
 
-        disk_limit = self.convert_to_kb(disk_limit)
+        disk_limit, error = self._convert_to_kb(disk_limit)
 
-        if not disk_limit:
-            return False
+        if error:
+            self.ERROR_MSG = error
+            return QuotaEntry(group, policy, volume, vserver, error=error)
 
         # Set the file quota.
         if file_limit is None:
@@ -390,43 +1873,474 @@ class HMDCQuotas:
             self.hmdclog.log('warning', "File limit not normal.")
 
         # Perform the NetApp quota change.
-        result = self._netapp_invoke(action, group, volume, vserver,
-                                     policy, disk_limit, file_limit)
+        result = self._netapp_query(action, group, volume, vserver,
+                                    policy, disk_limit, file_limit)
+        errno = None
+
+        if result is None:
+            error = "Unrecognized action."
+        elif result.results_status() == "failed":
+            error = str(result.results_reason())
+            errno = result.results_errno()
+            self.hmdclog.log('debug', error)
+
+        if error:
+            self.ERROR_MSG = error
+            # The rule may or may not have changed; forget what we knew.
+            if self.cache is not None:
+                self.cache.invalidate(group, policy, volume)
+            return QuotaEntry(group, policy, volume, vserver, error=error,
+                              errno=errno)
+
+        if "delete" in action:
+            entry = QuotaEntry(group, policy, volume, vserver)
+        else:
+            entry = QuotaEntry(group, policy, volume, vserver, disk_limit,
+                               file_limit)
+
+        # Keep the cache and index in step with the NetApp.
+        if self.cache is not None:
+            if "delete" in action:
+                self.cache.put(QuotaEntry(group, policy, volume, vserver,
+                                          error=group + " not found on " +
+                                          volume))
+            else:
+                self.cache.put(entry)
 
-        if not result:
-            return False
+        if self.index is not None:
+            if "delete" in action:
+                self.index.discard(group, policy, volume)
+            else:
+                self.index.add(entry)
+
+        if "delete" in action:
+            self.locality.forget(group, volume)
+        else:
+            self.locality.found(group, volume)
+        self._save_locality()
+
+        if not resize:
+            return entry
 
         # Commit the quota change.
-        return self._netapp_resize(volume, vserver)
+        resized = self._netapp_resize(volume, vserver)
+
+        if not resized:
+            return QuotaEntry(group, policy, volume, vserver,
+                              entry.disk_limit, entry.file_limit,
+                              resized.error, resized.errno)
+
+        return entry
+
+    def modify_batch(self, changes, concurrent=False, wait=False,
+                     progress=None):
+        """Applies many add/delete/modify changes with one resize per volume.
 
-    def search_vservers(self, group, policy, volume=None):
+        Every entry change is applied first; each volume that had at least
+        one successful change is then committed with a single quota resize.
+        The resizes are started together and run in parallel on the cluster.
+
+        Arguments:
+            changes (list): Dictionaries with the keys action, group and
+                            volume, and optionally vserver, policy, size
+                            and files.
+            concurrent (boolean): Apply the changes and start the resizes on
+                                  the worker pool, bounded by svm_workers
+                                  per vserver.
+            progress (function): Called with each ResizeJob whose state
+                                 changes while waiting.
+            wait (boolean): Wait until every resize job has finished, and
+                            report the ones that failed.
+
+        Returns:
+            (list): (change, error) tuples for each failed change or resize;
+                    empty when everything was applied.
+        """
+
+        failures = []
+        resolved = []
+        touched = {}
+
+        for change in changes:
+            volume = change['volume']
+            vserver = change.get('vserver') or self.get_vserver(volume)
+
+            if not vserver:
+                failures.append((change, "Could not find volume " + volume +
+                                 "."))
+                continue
+
+            resolved.append(dict(change, vserver=vserver))
+
+        if concurrent:
+            entries = self._worker_pool().map(self._batch_task, resolved)
+        else:
+            entries = [self._batch_task(change) for change in resolved]
+
+        for change, entry in zip(resolved, entries):
+            if not entry:
+                self.hmdclog.log('error', "Batch change failed for " +
+                                 change['group'] + " on " +
+                                 change['volume'] + ": " + entry.error)
+                failures.append((change, entry.error))
+            else:
+                touched[change['volume']] = change['vserver']
+
+        self.hmdclog.log('info', "Resizing " + str(len(touched)) +
+                         " volumes.")
+
+        targets = sorted(touched.iteritems())
+        if concurrent:
+            jobs = self._worker_pool().map(self._batch_resize_task, targets)
+        else:
+            jobs = [self._batch_resize_task(target) for target in targets]
+
+        if wait:
+            jobs = self.wait_resize_jobs(jobs, progress=progress)
+
+        for job in jobs:
+            if not job:
+                failures.append(({'action': 'resize', 'volume': job.volume,
+                                  'vserver': job.vserver},
+                                 job.error or "Resize job " + job.state))
+
+        return failures
+
+    def queue_changes(self, changes):
+        """Durably records changes in the journal; commit_journal applies them.
+
+        Every change is written and fsynced in one append before this
+        returns, so a crash afterwards loses none of them.
+
+        Arguments:
+            changes (list): Dictionaries with the keys action, group and
+                            volume, and optionally vserver, policy, size
+                            and files.
+
+        Returns:
+            (list/boolean): (change, error) tuples for each change that
+                            could not be queued; False if there is no
+                            journal (also sets ERROR_MSG on error).
+        """
+
+        if self.journal is None:
+            self.ERROR_MSG = "No journal is configured."
+            return False
+
+        failures = []
+        resolved = []
+
+        for change in changes:
+            volume = change['volume']
+            vserver = change.get('vserver') or self.get_vserver(volume)
+
+            if not vserver:
+                failures.append((change, "Could not find volume " + volume +
+                                 "."))
+                continue
+
+            resolved.append(dict(change, vserver=vserver))
+
+        self.journal.queue(resolved)
+        return failures
+
+    def reconcile(self, desired, prune=False, dry_run=False, wait=False,
+                  progress=None):
+        """Applies the minimal changes that bring the NetApp to a desired state.
+
+        The current rules of every volume named in the desired state are
+        read with one bulk scan each. Only rules that are missing or differ
+        are added or modified, concurrently per vserver, and each changed
+        volume is resized once. Volumes that cannot be scanned are left
+        alone.
+
+        Arguments:
+            desired (list): Dictionaries with the keys group and volume, and
+                            optionally policy, size and files; size and
+                            files default as they do for modify.
+            dry_run (boolean): Only compute the changes; apply nothing.
+            progress (function): Called with each ResizeJob whose state
+                                 changes while waiting.
+            prune (boolean): Also delete rules on those volumes that are
+                             not in the desired state.
+            wait (boolean): Wait until every resize job has finished.
+
+        Returns:
+            ((list, list)): Changes planned, as modify_batch dictionaries
+                            with the previous QuotaEntry (or None) under
+                            current; and (change, error) tuples for each
+                            row, scan, change or resize that failed.
+        """
+
+        failures = []
+        wanted = {}
+        targets = {}
+
+        for row in desired:
+            volume = row['volume']
+            vserver = self.get_vserver(volume)
+
+            if not vserver:
+                failures.append((row, "Could not find volume " + volume +
+                                 "."))
+                continue
+
+            disk_limit, error = self._convert_to_kb(row.get('size') or
+                                                    self.DEFAULT_QUOTA)
+            if error:
+                failures.append((row, error))
+                continue
+
+            if row.get('files') is None:
+                file_limit = disk_limit / 16
+            else:
+                file_limit = int(row['files'])
+
+            key = (row['group'], row.get('policy') or 'default', volume)
+            if key in wanted:
+                self.hmdclog.log('warning', "Duplicate desired rule for " +
+                                 key[0] + " on " + volume +
+                                 "; the last one wins.")
+            wanted[key] = (disk_limit, file_limit)
+            targets[volume] = vserver
+
+        # Read the current state, one bulk scan per volume.
+        scans = sorted(targets.iteritems())
+        current = {}
+
+        for (volume, vserver), (entries, error) in zip(
+                scans, self._worker_pool().map(self._scan_task, scans)):
+            if error:
+                self.hmdclog.log('error', "Could not read rules on " +
+                                 volume + ": " + error)
+                failures.append(({'action': 'scan', 'volume': volume,
+                                  'vserver': vserver}, error))
+                del targets[volume]
+                continue
+            for entry in entries:
+                current[(entry.group, entry.policy, volume)] = entry
+
+        changes = []
+
+        for key, (disk_limit, file_limit) in sorted(wanted.iteritems()):
+            group, policy, volume = key
+            if volume not in targets:
+                continue
+
+            entry = current.get(key)
+            if entry is None:
+                action = 'add'
+            elif (entry.disk_limit, entry.file_limit) != (disk_limit,
+                                                          file_limit):
+                action = 'modify'
+            else:
+                continue
+
+            changes.append({'action': action, 'group': group,
+                            'volume': volume, 'vserver': targets[volume],
+                            'policy': policy, 'size': str(disk_limit) + 'K',
+                            'files': file_limit, 'current': entry})
+
+        if prune:
+            for key, entry in sorted(current.iteritems()):
+                if key not in wanted:
+                    changes.append({'action': 'delete', 'group': entry.group,
+                                    'volume': entry.volume,
+                                    'vserver': entry.vserver,
+                                    'policy': entry.policy,
+                                    'current': entry})
+
+        self.hmdclog.log('info', str(len(changes)) + " of " +
+                         str(len(wanted)) + " desired rules drifted.")
+
+        if changes and not dry_run:
+            failures.extend(self.modify_batch(changes, concurrent=True,
+                                              wait=wait, progress=progress))
+
+        return (changes, failures)
+
+    def report(self, volume=None, vserver=None, group=None,
+               quota_type='group'):
+        """Streams quota usage records page by page via quota-report-iter.
+
+        Only one page per volume is held in memory at a time, so whole-fleet
+        reports run in constant memory.
+
+        Arguments:
+            group (string): Only report this quota target.
+            quota_type (string): Rule type to report: group, user or tree.
+            volume (string): Only report this volume.
+            vserver (string): Only report the volumes of this vserver;
+                              every volume in VOLUMES if neither is given.
+
+        Yields:
+            (instance): QuotaUsage for each quota rule.
+
+        Raises:
+            RuntimeError: On an unknown volume or a failed query
+                          (also sets ERROR_MSG).
+        """
+
+        for name, owner in self._volume_targets(volume, vserver):
+            self.hmdclog.log('debug', "Reporting " + name)
+
+            query = NaElement('quota')
+            query.child_add_string('quota-type', quota_type)
+            query.child_add_string('volume', name)
+            if group is not None:
+                query.child_add_string('quota-target', group)
+
+            for record in self._netapp_iter(owner, 'quota-report-iter',
+                                            query):
+                yield QuotaUsage(record.child_get_string('quota-target'),
+                                 record.child_get_string('quota-type'),
+                                 name,
+                                 owner,
+                                 record.child_get_string('tree'),
+                                 record.child_get_string('disk-used'),
+                                 record.child_get_string('disk-limit'),
+                                 record.child_get_string('soft-disk-limit'),
+                                 record.child_get_string('files-used'),
+                                 record.child_get_string('file-limit'),
+                                 record.child_get_string('soft-file-limit'))
+
+    def resize(self, volume, vserver):
+        """Starts a quota resize and returns its job without waiting.
+
+        Arguments:
+            volume (string): The volume to resize.
+            vserver (string): The vserver the volume lives on.
+
+        Returns:
+            (instance): ResizeJob to pass to job_status or wait_resize_jobs;
+                        false if the resize could not be started
+                        (also sets ERROR_MSG on error)
+        """
+
+        started = time.time()
+        result = self._netapp_call(vserver, 'quota-resize', 'volume', volume)
+
+        if result.results_status() == "failed":
+            self.ERROR_MSG = str(result.results_reason())
+            self.hmdclog.log('debug', self.ERROR_MSG)
+            return ResizeJob(volume, vserver, None, 'failure',
+                             error=self.ERROR_MSG, started=started)
+
+        jobid = result.child_get_string("result-jobid")
+        status = result.child_get_string("result-status")
+
+        if status == "failed":
+            self.ERROR_MSG = str(result.child_get_string(
+                "result-error-message"))
+            self.hmdclog.log('debug', self.ERROR_MSG)
+            return ResizeJob(volume, vserver, jobid, 'failure',
+                             error=self.ERROR_MSG, started=started)
+
+        # status and jobid may be null if quota resize is done twice rapidly
+        if not jobid:
+            return ResizeJob(volume, vserver, None, 'untracked',
+                             started=started)
+
+        self.hmdclog.log('debug', "Quota resize job " + str(jobid) +
+                         " started on " + volume)
+        return ResizeJob(volume, vserver, jobid, 'queued', started=started)
+
+    def search_groups(self, groups, policy=None, volume=None):
+        """Finds the quotas of many groups in one scan per volume.
+
+        Every volume is read once with quota-list-entries-iter, or from the
+        index where it covers the volume, and matched against all the groups
+        locally, so the cost grows with the volumes rather than with groups
+        times volumes. Volumes are scanned in parallel on the worker pool.
+
+        Arguments:
+            groups (list): Names of the LDAP groups.
+            policy (string): Name of the quota policy; default if None.
+            volume (string): Only search this volume.
+
+        Returns:
+            (dictionary/boolean): {group: SearchResults of QuotaEntry matches
+                                  keyed by vserver, then volume}, with every
+                                  vserver that could not be scanned flagged
+                                  in each; False if the volume is unknown.
+                                  (also sets ERROR_MSG on error)
+        """
+
+        policy = policy or 'default'
+        results = dict((group, SearchResults()) for group in groups)
+
+        if volume is None:
+            self._check_topology()
+            targets = [(name, vserver)
+                       for vserver, volumes in self.VOLUMES.iteritems()
+                       for name in volumes]
+        else:
+            vserver = self.get_vserver(volume)
+
+            if not vserver:
+                return False
+
+            targets = [(volume, vserver)]
+
+        scans = []
+        for volume, vserver in targets:
+            if self.index is None or not self.index.covers(volume):
+                scans.append((volume, vserver))
+                continue
+            for group, matches in results.iteritems():
+                entry = self.index.lookup(group, policy, volume).get(
+                    vserver, {}).get(volume)
+                if entry is not None:
+                    matches.setdefault(vserver, {})[volume] = entry
+
+        self.hmdclog.log('info', "Searching " + str(len(results)) +
+                         " groups on " + str(len(targets)) + " volumes.")
+
+        for (volume, vserver), (entries, error) in zip(
+                scans, self._worker_pool().map(self._scan_task, scans)):
+            if entries is None:
+                self.hmdclog.log('error', "Could not search " + volume +
+                                 ": " + error)
+                for matches in results.itervalues():
+                    matches.unreachable[vserver] = error
+                continue
+            for entry in entries:
+                if entry.policy == policy and entry.group in results:
+                    results[entry.group].setdefault(
+                        vserver, {})[volume] = entry
+
+        return results
+
+    def search_vservers(self, group, policy, volume=None, concurrent=False,
+                        first_hit=False):
         """Finds group quota on any vserver/volume combination.
 
+        Volumes are probed where the group was last found first, then where
+        groups named like it live.
+
         Arguments:
+            concurrent (boolean): Probe all volumes in parallel.
+            first_hit (boolean): Stop at the first volume holding the group;
+                                 usually one call for a known group.
             group (string): Name of the LDAP group.
             policy (string): Name of the quota policy.
             volume (string): The volume where the group quota resides.
 
         Returns:
-            (dictionary/boolean): Dictionary of matches on success, or False
-                                  on failure.
-                                  (also sets ERROR_MSG on error)
+            (instance/boolean): SearchResults of QuotaEntry matches keyed by
+                                vserver, then volume, with unreachable
+                                vservers flagged; empty if the group was
+                                not found, False if the volume is unknown.
+                                (also sets ERROR_MSG on error)
         """
 
-        matches = {}
-
         if volume is None:
             # Volume was not specified.
             self.hmdclog.log('info', "Searching all vservers and volumes.")
-            for vserver in self.VOLUMES.iterkeys():
-                self.hmdclog.log('debug', "Searching " + vserver)
-                result = self.search_volumes(group, policy, vserver)
-
-                if not result:
-                    pass
-                elif len(result) > 0:
-                    # Filters out empty result sets.
-                    matches[vserver] = result
+            self._check_topology()
+            targets = [(name, vserver)
+                       for vserver, volumes in self.VOLUMES.iteritems()
+                       for name in volumes]
         else:
             # Volume was specified.
             vserver = self.get_vserver(volume)
@@ -434,53 +2348,151 @@ class HMDCQuotas:
             if not vserver:
                 return False
 
-            self.hmdclog.log('debug', "Searching " + vserver)
-
-            result = self.group_lookup(group, policy, volume, vserver)
+            targets = [(volume, vserver)]
 
-            if not result:
-                pass
-            else:
-                quotas = self.humanize_quotas()
-                # Each vserver with results becomes a dictionary.
-                matches[vserver] = {volume: quotas}
+        matches = self._search_targets(group, policy, targets, concurrent,
+                                       first_hit)
+        self._save_locality()
 
         if not matches:
             self.ERROR_MSG = "Group " + group + " not found on any Volume or Vserver"
+            if matches.unreachable:
+                self.ERROR_MSG += (" that could be reached; skipped " +
+                                   ", ".join(sorted(matches.unreachable)))
             self.hmdclog.log('debug', self.ERROR_MSG)
-            return False
 
         return matches
 
-    def search_volumes(self, group, policy, vserver):
+    def search_volumes(self, group, policy, vserver, concurrent=False,
+                       first_hit=False):
         """Finds group quota on any volume in a specific vserver.
 
         Arguments:
+            concurrent (boolean): Probe the vserver's volumes in parallel.
+            first_hit (boolean): Stop at the first volume holding the group.
             group (string): Name of the LDAP group.
             policy (string): Name of the quota policy.
             vserver (string): The vserver to search.
 
         Returns:
-            (dictionary/boolean): Dictionary of matches on success, or False
-                                  on failure.
-                                  (also sets ERROR_MSG on error)
+            (instance): SearchResults of QuotaEntry matches keyed by volume;
+                        unreachable flags the vserver if it was skipped.
         """
 
-        matches = {}
+        targets = [(name, vserver) for name in self.VOLUMES.get(vserver, ())]
+        matches = self._search_targets(group, policy, targets, concurrent,
+                                       first_hit)
+        self._save_locality()
+        return SearchResults(matches.get(vserver, {}), matches.unreachable)
 
-        for volume in self.VOLUMES[vserver]:
-            self.hmdclog.log('debug', "Searching " + volume)
+    def stats(self):
+        """Returns per-verb and per-vserver call metrics.
 
-            result = self.group_lookup(group, policy, volume, vserver)
+        Returns:
+            (dictionary): calls and resizes from ZapiMetrics.snapshot(), the
+                          circuit breaker of each vserver, the throttle
+                          limits, plus the lookup cache counters if the
+                          cache is enabled.
+        """
 
-            if not result:
-                pass
-            else:
-                quotas = self.humanize_quotas()
-                # Each volume with results becomes a dictionary.
-                matches[volume] = quotas
+        stats = self.metrics.snapshot()
+        stats['breakers'] = dict((vserver, breaker.snapshot())
+                                 for vserver, breaker in
+                                 self.breakers.items())
 
-        return matches
+        if self.throttle is not None:
+            stats['throttle'] = self.throttle.snapshot()
+
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+
+        return stats
+
+    def thread_error(self, clear=False):
+        """Returns the last ERROR_MSG set by the calling thread.
+
+        Unlike ERROR_MSG, it is never overwritten by another thread's
+        request. Errors set on the worker pool stay with the pool threads;
+        they are carried by the error field of the results instead.
+
+        Arguments:
+            clear (boolean): Reset it afterwards, e.g. before a new request.
+
+        Returns:
+            (string): The error message; empty if none was set.
+        """
+
+        message = getattr(self._errors, 'message', '')
+        if clear:
+            self._errors.message = ''
+        return message
+
+    def volume_sizes(self):
+        """Returns the size of every data volume, one call per SVM.
+
+        Returns:
+            (dictionary): {vserver: {volume: size in KB}}; an SVM that could
+                          not be queried maps to an empty dictionary.
+        """
+
+        self._check_topology()
+        return dict(self._worker_pool().map(self._size_task,
+                                            sorted(self.VOLUMES)))
+
+    def wait_resize_jobs(self, jobs, timeout=None, progress=None):
+        """Waits on many resize jobs at once.
+
+        Every job_poll_interval seconds, all unfinished jobs are polled in
+        parallel on the worker pool. Each job's total duration is recorded
+        in the resize metrics when it finishes.
+
+        Arguments:
+            jobs (list): ResizeJob objects from resize().
+            progress (function): Called with each ResizeJob whose state or
+                                 progress changes.
+            timeout (float): Seconds to wait at most; None waits until every
+                             job is done.
+
+        Returns:
+            (list): The latest ResizeJob for each job, in the same order;
+                    jobs still running at the timeout are not done.
+        """
+
+        jobs = list(jobs)
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            pending = [number for number, job in enumerate(jobs)
+                       if not job.done]
+            if not pending or (deadline is not None and
+                               time.time() >= deadline):
+                break
+
+            polled = self._worker_pool().map(self.job_status,
+                                             [jobs[number]
+                                              for number in pending])
+
+            for number, job in zip(pending, polled):
+                previous = jobs[number]
+                jobs[number] = job
+                if (job.state, job.progress) != (previous.state,
+                                                 previous.progress):
+                    self.hmdclog.log('debug', "Resize of " + job.volume +
+                                     " is " + job.state)
+                    if progress is not None:
+                        progress(job)
+                if job.done and job.started is not None:
+                    self.metrics.record_resize(job.volume, job.vserver,
+                                               time.time() - job.started,
+                                               not job)
+
+            if any(not job.done for job in jobs):
+                delay = self.options['job_poll_interval']
+                if deadline is not None:
+                    delay = max(0, min(delay, deadline - time.time()))
+                time.sleep(delay)
+
+        return jobs
 
 
 if __name__ == '__main__':
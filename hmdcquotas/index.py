@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import threading
+
+
+class QuotaIndex:
+    """In-memory map of group quota rules, built from bulk volume scans.
+
+    Example:
+        index = QuotaIndex()
+        index.add(entry)
+        index.mark_scanned(volume)
+        index.lookup(group, policy)
+
+    Public Functions:
+        add: Records one group quota rule.
+        covers: Reports whether a volume has been fully scanned.
+        discard: Forgets one group quota rule.
+        lookup: Returns the rules of a group, keyed by vserver and volume.
+        mark_scanned: Flags a volume as fully loaded into the index.
+    """
+
+    def __init__(self):
+        """Creates an empty index."""
+
+        self.groups = {}
+        self.scanned = set()
+        self._lock = threading.Lock()
+
+    def add(self, entry):
+        """Records one group quota rule, replacing any previous copy.
+
+        Arguments:
+            entry (instance): QuotaEntry of the rule.
+        """
+
+        with self._lock:
+            rules = self.groups.setdefault(entry.group, {})
+            rules[(entry.policy, entry.volume)] = entry
+
+    def covers(self, volume):
+        """Reports whether a volume has been fully scanned.
+
+        Arguments:
+            volume (string): Name of the volume.
+
+        Returns:
+            (boolean): True if misses on this volume are authoritative.
+        """
+
+        return volume in self.scanned
+
+    def discard(self, group, policy, volume):
+        """Forgets one group quota rule, if present.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            volume (string): The volume where the group quota resides.
+        """
+
+        with self._lock:
+            rules = self.groups.get(group, {})
+            rules.pop((policy, volume), None)
+            if not rules:
+                self.groups.pop(group, None)
+
+    def lookup(self, group, policy, volume=None):
+        """Returns the rules of a group, keyed by vserver and volume.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy.
+            volume (string): Restrict the answer to this volume.
+
+        Returns:
+            (dictionary): QuotaEntry rules keyed by vserver, then volume.
+        """
+
+        matches = {}
+
+        with self._lock:
+            rules = self.groups.get(group, {}).values()
+
+        for entry in rules:
+            if entry.policy != policy:
+                continue
+            if volume is not None and entry.volume != volume:
+                continue
+            matches.setdefault(entry.vserver, {})[entry.volume] = entry
+
+        return matches
+
+    def mark_scanned(self, volume):
+        """Flags a volume as fully loaded into the index.
+
+        Arguments:
+            volume (string): Name of the volume.
+        """
+
+        with self._lock:
+            self.scanned.add(volume)
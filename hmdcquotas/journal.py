@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Write-ahead journal of quota changes, one JSON object per line.
+
+A change is written and fsynced before it is sent to the NetApp; the
+outcome of applying it, and the quota resize that commits it, are written
+after. Reading the journal back therefore tells which changes were never
+applied and which volumes still need a resize:
+
+    {"id": "...", "queued": {"action": "add", "group": ..., ...}}
+    {"id": "...", "applied": true}
+    {"id": "...", "applied": false, "error": "..."}
+    {"resized": ["...", "..."], "volume": "...", "vserver": "..."}
+
+Records are only ever appended. A crash can tear the last line, which is
+skipped when read. Once nothing is outstanding the file is emptied.
+
+A commit holds an exclusive lock on a sidecar file, the journal path plus
+.lock, from reading what is outstanding until recording the outcome, so
+two processes never apply the same changes.
+"""
+
+import contextlib
+import fcntl
+import itertools
+import json
+import os
+import threading
+import time
+
+
+def _strings(value):
+    """Returns a parsed JSON value with str instead of unicode."""
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_strings(key), _strings(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+class QuotaJournal:
+    """Durable record of queued quota changes and their progress.
+
+    The file is locked while it is written or read, so several processes,
+    such as quotasUtil.py and quotasDaemon.py, can share one journal.
+
+    Public Functions:
+        close: Closes the journal file.
+        committing: Holds the journal exclusively for one commit cycle.
+        compact: Empties the journal once nothing is outstanding.
+        outstanding: Returns the changes to apply and volumes to resize.
+        queue: Durably records changes before they are applied.
+        record_applied: Durably records the outcome of applied changes.
+        record_resized: Durably records the resize of a volume's changes.
+
+    Private Functions:
+        _append: Writes records and fsyncs them, as one group commit.
+        _outstanding: Folds records into outstanding changes and resizes.
+        _read: Returns every complete record in the journal.
+
+    Instance Variables:
+        path (string): Location of the journal file.
+    """
+
+    def __init__(self, path):
+        """Opens the journal file, creating it and its directory if needed.
+
+        Arguments:
+            path (string): Location of the journal file.
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._counter = itertools.count(1)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0600)
+        # flock excludes other processes; this lock, other threads.
+        self._lock = threading.Lock()
+        # Separate from the journal file, whose flock each call takes.
+        self._commit_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT,
+                                  0600)
+        self._commit_lock = threading.Lock()
+
+    def _append(self, records):
+        """Writes records and fsyncs them, as one group commit.
+
+        Arguments:
+            records (list): Dictionaries to append, one per line.
+        """
+
+        data = ''.join(json.dumps(record, sort_keys=True) + "\n"
+                       for record in records)
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                # End a line torn by a crash, so it does not swallow ours.
+                with open(self.path, 'rb') as handle:
+                    handle.seek(0, os.SEEK_END)
+                    if handle.tell():
+                        handle.seek(-1, os.SEEK_END)
+                        if handle.read(1) != "\n":
+                            data = "\n" + data
+                while data:
+                    data = data[os.write(self._fd, data):]
+                os.fsync(self._fd)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _outstanding(self, records):
+        """Folds records into outstanding changes and resizes.
+
+        Arguments:
+            records (list): Every record of the journal, in order.
+
+        Returns:
+            ((list, dictionary)): As outstanding() returns them.
+        """
+
+        queued = []
+        changes = {}
+        applied = set()
+        resized = set()
+
+        for record in records:
+            if 'queued' in record:
+                queued.append(record['id'])
+                changes[record['id']] = record['queued']
+            elif 'applied' in record:
+                applied.add(record['id'])
+                if not record['applied']:
+                    # A failed change left nothing to commit.
+                    resized.add(record['id'])
+            elif 'resized' in record:
+                resized.update(record['resized'])
+
+        pending = [(change_id, changes[change_id]) for change_id in queued
+                   if change_id not in applied]
+        unresized = {}
+        for change_id in queued:
+            if change_id in applied and change_id not in resized:
+                change = changes[change_id]
+                unresized.setdefault((change['volume'], change['vserver']),
+                                     []).append(change_id)
+
+        return (pending, unresized)
+
+    def _read(self):
+        """Returns every complete record in the journal, in order.
+
+        The caller must hold the locks.
+
+        Returns:
+            (list): Dictionaries of each record.
+        """
+
+        records = []
+        with open(self.path) as handle:
+            for line in handle:
+                try:
+                    records.append(_strings(json.loads(line)))
+                except ValueError:
+                    # Torn by a crash mid-write; never fsynced, never acted on.
+                    continue
+
+        return records
+
+    def close(self):
+        """Closes the journal file."""
+
+        os.close(self._fd)
+        os.close(self._commit_fd)
+
+    @contextlib.contextmanager
+    def committing(self):
+        """Holds the journal exclusively for one commit cycle.
+
+        Other threads and processes wait to commit until the block ends;
+        queueing changes is not blocked.
+
+            with journal.committing():
+                pending, unresized = journal.outstanding()
+                ...
+        """
+
+        with self._commit_lock:
+            fcntl.flock(self._commit_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._commit_fd, fcntl.LOCK_UN)
+
+    def compact(self):
+        """Empties the journal once nothing is outstanding.
+
+        Returns:
+            (boolean): True if the journal was emptied.
+        """
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                pending, unresized = self._outstanding(self._read())
+                if pending or unresized:
+                    return False
+                os.ftruncate(self._fd, 0)
+                os.fsync(self._fd)
+                return True
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def outstanding(self):
+        """Returns the changes to apply and the volumes to resize.
+
+        Returns:
+            ((list, dictionary)): (id, change) of each queued change not
+                                  yet applied, in queue order; and
+                                  {(volume, vserver): [ids]} of the applied
+                                  changes not yet committed by a resize.
+        """
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                records = self._read()
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        return self._outstanding(records)
+
+    def queue(self, changes):
+        """Durably records changes before they are applied.
+
+        Arguments:
+            changes (list): Change dictionaries, each with its vserver.
+
+        Returns:
+            (list): Journal id of each change.
+        """
+
+        ids = ['%x-%x-%d' % (int(time.time() * 1000), os.getpid(),
+                             next(self._counter)) for change in changes]
+        self._append([{'id': change_id, 'queued': change}
+                      for change_id, change in zip(ids, changes)])
+        return ids
+
+    def record_applied(self, outcomes):
+        """Durably records the outcome of applied changes.
+
+        Arguments:
+            outcomes (list): (id, error) of each change; error is None on
+                             success.
+        """
+
+        records = []
+        for change_id, error in outcomes:
+            if error is None:
+                records.append({'id': change_id, 'applied': True})
+            else:
+                records.append({'id': change_id, 'applied': False,
+                                'error': error})
+
+        if records:
+            self._append(records)
+
+    def record_resized(self, resizes):
+        """Durably records that resizes committed their volumes' changes.
+
+        Arguments:
+            resizes (list): (volume, vserver, ids) of each resized volume.
+        """
+
+        if resizes:
+            self._append([{'resized': ids, 'volume': volume,
+                           'vserver': vserver}
+                          for volume, vserver, ids in resizes])
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import json
+import os
+import re
+import tempfile
+import threading
+
+
+def name_prefix(group):
+    """Returns the naming convention part of a group name.
+
+    Arguments:
+        group (string): Name of the LDAP group.
+
+    Returns:
+        (string): Leading letters of the name, lower case; empty if none.
+    """
+
+    match = re.match(r"[A-Za-z]+", group)
+    return match.group(0).lower() if match else ''
+
+
+class QuotaLocality:
+    """Where each group was last found, persisted to a JSON cache file.
+
+    Searches probe the volumes a group was last found on first, then the
+    volumes most groups with the same name prefix live on, then the volumes
+    most groups live on. The map is only a hint: a stale entry costs one
+    extra probe and is forgotten on the miss.
+
+    Example:
+        locality = QuotaLocality('/var/cache/hmdcquotas/locality.json')
+        locality.load()
+        targets = locality.order(group, targets)
+        locality.found(group, volume)
+
+    Public Functions:
+        forget: Drops a volume from a group's locations.
+        found: Records that a group was found on a volume.
+        known: Returns the volumes a group was last found on.
+        load: Reads the map from the cache file.
+        order: Sorts volumes by how likely they hold a group.
+        save: Atomically writes the map to the cache file, if changed.
+
+    Instance Variables:
+        dirty (boolean): Whether the map changed since it was saved.
+        groups (dictionary): {group: [volume, ...]}, most recent first.
+        path (string): Cache file; None to keep the map in memory only.
+        prefixes (dictionary): {name prefix: {volume: number of groups}}.
+        volumes (dictionary): {volume: number of groups}.
+    """
+
+    def __init__(self, path):
+        """Starts empty; call load() to read the cache file.
+
+        Arguments:
+            path (string): Cache file; None or empty to disable it.
+        """
+
+        self.path = path or None
+        self.dirty = False
+        self.groups = {}
+        self.prefixes = {}
+        self.volumes = {}
+        self._lock = threading.Lock()
+
+    def _count(self, group, volume, step):
+        """Adds step to the group counts of a volume; the caller locks."""
+
+        for counts in (self.prefixes.setdefault(name_prefix(group), {}),
+                       self.volumes):
+            counts[volume] = counts.get(volume, 0) + step
+            if counts[volume] <= 0:
+                del counts[volume]
+
+    def forget(self, group, volume):
+        """Drops a volume from a group's locations, after a miss or delete.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            volume (string): Volume the group is no longer on.
+        """
+
+        with self._lock:
+            volumes = self.groups.get(group)
+            if not volumes or volume not in volumes:
+                return
+            volumes.remove(volume)
+            if not volumes:
+                del self.groups[group]
+            self._count(group, volume, -1)
+            self.dirty = True
+
+    def found(self, group, volume):
+        """Records that a group was found on a volume.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            volume (string): Volume the group was found on.
+        """
+
+        with self._lock:
+            volumes = self.groups.setdefault(group, [])
+            if volumes[:1] == [volume]:
+                return
+            if volume in volumes:
+                volumes.remove(volume)
+            else:
+                self._count(group, volume, 1)
+            volumes.insert(0, volume)
+            self.dirty = True
+
+    def known(self, group):
+        """Returns the volumes a group was last found on.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+
+        Returns:
+            (list): Volume names, most recent first.
+        """
+
+        with self._lock:
+            return list(self.groups.get(group, ()))
+
+    def load(self):
+        """Reads the map from the cache file.
+
+        Returns:
+            (boolean): True if the file was read, False if it is missing
+                       or unreadable; the current map is kept then.
+        """
+
+        if self.path is None:
+            return False
+
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+            groups = dict((str(group), [str(volume) for volume in volumes])
+                          for group, volumes in data['groups'].iteritems())
+        except (IOError, OSError, AttributeError, KeyError, TypeError,
+                ValueError):
+            return False
+
+        with self._lock:
+            self.groups = {}
+            self.prefixes = {}
+            self.volumes = {}
+            for group, volumes in groups.iteritems():
+                self.groups[group] = volumes
+                for volume in volumes:
+                    self._count(group, volume, 1)
+            self.dirty = False
+        return True
+
+    def order(self, group, targets):
+        """Sorts volumes by how likely they hold a group.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            targets (list): (volume, vserver) tuples to search.
+
+        Returns:
+            (list): The targets, likeliest first; ties keep their order.
+        """
+
+        with self._lock:
+            known = self.groups.get(group, [])
+            prefix = self.prefixes.get(name_prefix(group), {})
+
+            def likelihood(item):
+                position, (volume, vserver) = item
+                rank = (known.index(volume) if volume in known
+                        else len(known))
+                return (rank, -prefix.get(volume, 0),
+                        -self.volumes.get(volume, 0), position)
+
+            return [target for position, target in
+                    sorted(enumerate(targets), key=likelihood)]
+
+    def save(self):
+        """Atomically writes the map to the cache file, if it changed.
+
+        Raises:
+            IOError/OSError: When the file or its directory is not writable.
+        """
+
+        if self.path is None or not self.dirty:
+            return
+
+        with self._lock:
+            content = json.dumps({'groups': self.groups}, sort_keys=True)
+            self.dirty = False
+
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            handle, temp_path = tempfile.mkstemp(dir=directory,
+                                                 suffix='.tmp')
+            with os.fdopen(handle, 'w') as output:
+                output.write(content)
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            # Try again at the next save.
+            self.dirty = True
+            raise
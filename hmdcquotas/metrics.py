@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import bisect
+import json
+import os
+import tempfile
+import threading
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram with fixed buckets, in seconds.
+
+    Public Functions:
+        observe: Records one duration.
+        snapshot: Returns the counts, sum and bucket counts.
+
+    Class Variables:
+        BUCKETS (tuple): Upper bounds of the buckets, in seconds.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+               10.0, 30.0, 60.0)
+
+    def __init__(self):
+        """Creates an empty histogram."""
+
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+
+    def observe(self, seconds, failed=False):
+        """Records one duration.
+
+        Arguments:
+            failed (boolean): Whether the timed call failed.
+            seconds (float): Duration of the call.
+        """
+
+        self.count += 1
+        self.total += seconds
+        if failed:
+            self.failures += 1
+        self.buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        """Returns the counts, sum and bucket counts.
+
+        Returns:
+            (dictionary): count, failures, sum and cumulative buckets keyed
+                          by upper bound ("+Inf" for the last).
+        """
+
+        buckets = []
+        running = 0
+        for bound, hits in zip(self.BUCKETS + ('+Inf',), self.buckets):
+            running += hits
+            buckets.append((str(bound), running))
+
+        return {'count': self.count,
+                'failures': self.failures,
+                'sum': self.total,
+                'buckets': buckets}
+
+
+class ZapiMetrics:
+    """Thread-safe call counters and latency histograms for ZAPI traffic.
+
+    Calls are keyed by (ZAPI verb, vserver); quota resizes are additionally
+    keyed by (volume, vserver).
+
+    Example:
+        metrics = ZapiMetrics()
+        metrics.record('quota-get-entry', vserver, 0.012, False)
+        metrics.to_prometheus()
+
+    Public Functions:
+        record: Records one ZAPI call.
+        record_resize: Records one quota resize.
+        reset: Drops every recorded value.
+        snapshot: Returns every metric as a dictionary.
+        to_json: Renders the metrics as JSON.
+        to_prometheus: Renders the metrics in Prometheus text format.
+        write: Atomically writes the metrics to a file.
+    """
+
+    def __init__(self):
+        """Creates empty metrics."""
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, api, vserver, seconds, failed):
+        """Records one ZAPI call.
+
+        Arguments:
+            api (string): ZAPI verb, e.g. quota-get-entry.
+            failed (boolean): Whether the call returned a failed status.
+            seconds (float): Duration of the call.
+            vserver (string): The vserver the call went to.
+        """
+
+        with self._lock:
+            key = (api, vserver)
+            if key not in self._calls:
+                self._calls[key] = LatencyHistogram()
+            self._calls[key].observe(seconds, failed)
+
+    def record_resize(self, volume, vserver, seconds, failed):
+        """Records one quota resize.
+
+        Arguments:
+            failed (boolean): Whether the resize failed.
+            seconds (float): Duration of the resize.
+            volume (string): The volume that was resized.
+            vserver (string): The vserver the volume lives on.
+        """
+
+        with self._lock:
+            key = (volume, vserver)
+            if key not in self._resizes:
+                self._resizes[key] = LatencyHistogram()
+            self._resizes[key].observe(seconds, failed)
+
+    def reset(self):
+        """Drops every recorded value."""
+
+        with self._lock:
+            self._calls = {}
+            self._resizes = {}
+
+    def snapshot(self):
+        """Returns every metric as a dictionary.
+
+        Returns:
+            (dictionary): calls and resizes, each a list of dictionaries
+                          with their labels and histogram snapshot.
+        """
+
+        with self._lock:
+            calls = [dict(api=api, vserver=vserver, **histogram.snapshot())
+                     for (api, vserver), histogram in
+                     sorted(self._calls.iteritems())]
+            resizes = [dict(volume=volume, vserver=vserver,
+                            **histogram.snapshot())
+                       for (volume, vserver), histogram in
+                       sorted(self._resizes.iteritems())]
+
+        return {'calls': calls, 'resizes': resizes}
+
+    def to_json(self):
+        """Renders the metrics as JSON.
+
+        Returns:
+            (string): JSON document of snapshot().
+        """
+
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Renders the metrics in Prometheus text exposition format.
+
+        Returns:
+            (string): Metrics suitable for the node_exporter textfile
+                      collector.
+        """
+
+        snapshot = self.snapshot()
+        lines = []
+
+        def _histogram(name, help_text, rows, label_names):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " histogram")
+            for row in rows:
+                labels = ",".join(label + '="' + row[label] + '"'
+                                  for label in label_names)
+                for bound, count in row['buckets']:
+                    lines.append(name + '_bucket{' + labels + ',le="' +
+                                 bound + '"} ' + str(count))
+                lines.append(name + '_sum{' + labels + '} ' +
+                             repr(row['sum']))
+                lines.append(name + '_count{' + labels + '} ' +
+                             str(row['count']))
+
+        def _counter(name, help_text, rows, label_names):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " counter")
+            for row in rows:
+                labels = ",".join(label + '="' + row[label] + '"'
+                                  for label in label_names)
+                lines.append(name + '{' + labels + '} ' +
+                             str(row['failures']))
+
+        _histogram('hmdcquotas_zapi_call_seconds',
+                   "Duration of ZAPI calls.",
+                   snapshot['calls'], ('api', 'vserver'))
+        _counter('hmdcquotas_zapi_failures_total',
+                 "ZAPI calls that returned a failed status.",
+                 snapshot['calls'], ('api', 'vserver'))
+        _histogram('hmdcquotas_resize_seconds',
+                   "Duration of quota resizes.",
+                   snapshot['resizes'], ('volume', 'vserver'))
+        _counter('hmdcquotas_resize_failures_total',
+                 "Quota resizes that failed.",
+                 snapshot['resizes'], ('volume', 'vserver'))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, output_format='json'):
+        """Atomically writes the metrics to a file.
+
+        The file is written next to its destination and renamed into
+        place, so collectors never read a partial file.
+
+        Arguments:
+            output_format (string): json or prometheus.
+            path (string): Destination file.
+        """
+
+        if output_format == 'prometheus':
+            content = self.to_prometheus()
+        else:
+            content = self.to_json()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as output:
+            output.write(content)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
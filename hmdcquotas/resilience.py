@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import random
+import threading
+import time
+
+# Error number NaServer and ZapiTransport use when the filer is unreachable.
+TRANSPORT_ERRNO = 13001
+
+
+def backoff_delay(attempt, base):
+    """Returns a jittered, exponentially growing retry delay.
+
+    Uses "full jitter": a uniform draw up to base * 2 ** attempt, so clients
+    that failed together do not retry together.
+
+    Arguments:
+        attempt (int): Number of the failed attempt, starting at 0.
+        base (float): Delay ceiling of the first retry, in seconds.
+
+    Returns:
+        (float): Seconds to wait before the next attempt.
+    """
+
+    return random.uniform(0, base * 2 ** attempt)
+
+
+class CircuitBreaker:
+    """Stops calls to a vserver after repeated transport failures.
+
+    Closed, calls flow normally. After threshold consecutive failures the
+    breaker opens and calls are refused outright. Once reset_timeout
+    seconds have passed, one trial call is let through (half-open): success
+    closes the breaker, failure opens it again.
+
+    Example:
+        breaker = CircuitBreaker(5, 30)
+        if breaker.allow():
+            breaker.record(call_succeeded)
+
+    Public Functions:
+        allow: Reports whether a call may be made now.
+        record: Records the outcome of an allowed call.
+        snapshot: Returns the state and failure count.
+
+    Class Variables:
+        CLOSED (string): Calls flow normally.
+        HALF_OPEN (string): One trial call is in flight.
+        OPEN (string): Calls are refused.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half-open'
+    OPEN = 'open'
+
+    def __init__(self, threshold, reset_timeout):
+        """Creates a closed breaker.
+
+        Arguments:
+            reset_timeout (float): Seconds the breaker stays open.
+            threshold (int): Consecutive failures that open the breaker;
+                             0 never opens it.
+        """
+
+        self.failures = 0
+        self.opened = 0
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.threshold = threshold
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Reports whether a call may be made now.
+
+        Returns:
+            (boolean): True if the call may go ahead; the caller must then
+                       record() its outcome.
+        """
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    self.opened + self.reset_timeout <= time.time()):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record(self, success):
+        """Records the outcome of an allowed call.
+
+        Arguments:
+            success (boolean): False if the vserver could not be reached.
+        """
+
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.state = self.CLOSED
+                return
+
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.threshold > 0 and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened = time.time()
+
+    def snapshot(self):
+        """Returns the state and failure count.
+
+        Returns:
+            (dictionary): state and consecutive failures.
+        """
+
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
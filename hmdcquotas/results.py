@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import humanize
+
+
+def parse_limit(value):
+    """Converts a raw NetApp limit into an int; "-" means unlimited.
+
+    Arguments:
+        value (string/int): Limit as the NetApp reports it.
+
+    Returns:
+        (int/None): The limit, or None when unlimited or missing.
+    """
+
+    if value is None or str(value) in ('', '-'):
+        return None
+    return int(value)
+
+
+class QuotaRecord(object):
+    """Immutable, slotted base for result records.
+
+    Subclasses list their fields in __slots__ and pass the values, in that
+    order, to QuotaRecord.__init__.
+
+    Public Functions:
+        as_dict: Returns the fields as a dictionary.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        """Sets every field once; the record is read-only afterwards."""
+
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError(self.__class__.__name__ + " is immutable")
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __reduce__(self):
+        return (self.__class__, self._fields())
+
+    def __repr__(self):
+        fields = ", ".join(name + "=" + repr(getattr(self, name))
+                           for name in self.__slots__)
+        return self.__class__.__name__ + "(" + fields + ")"
+
+    def __setattr__(self, name, value):
+        raise AttributeError(self.__class__.__name__ + " is immutable")
+
+    def _fields(self):
+        """Returns every field as a tuple, in __slots__ order."""
+
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def as_dict(self):
+        """Returns the fields as a dictionary.
+
+        Returns:
+            (dictionary): Field names mapped to their values.
+        """
+
+        return dict(zip(self.__slots__, self._fields()))
+
+
+class QuotaEntry(QuotaRecord):
+    """Immutable result of a single quota query or change.
+
+    A QuotaEntry is true when the call succeeded and false when it carries
+    an error, so existing "if not result" checks keep working. Iterating
+    over it yields the humanized (disk_quota, file_quota) pair that search
+    results used to hold.
+
+    Example:
+        entry = qh.group_lookup(group, policy, volume, vserver)
+        if entry:
+            disk_quota, file_quota = entry
+        else:
+            print(entry.error)
+
+    Instance Variables:
+        disk_limit (int): Disk limit in KB; None if unlimited or unknown.
+        errno (int): NetApp error number of the failure; None on success
+                     or when the failure happened before any call.
+        error (string): Error message; None on success.
+        file_limit (int): Soft file limit; None if unlimited or unknown.
+        group (string): Name of the LDAP group.
+        policy (string): Name of the quota policy.
+        volume (string): The volume where the group quota resides.
+        vserver (string): The vserver the volume lives on.
+    """
+
+    __slots__ = ('group', 'policy', 'volume', 'vserver', 'disk_limit',
+                 'file_limit', 'error', 'errno')
+
+    def __init__(self, group, policy, volume, vserver, disk_limit=None,
+                 file_limit=None, error=None, errno=None):
+        """Sets every field once; the record is read-only afterwards."""
+
+        QuotaRecord.__init__(self, group, policy, volume, vserver,
+                             parse_limit(disk_limit), parse_limit(file_limit),
+                             error, parse_limit(errno))
+
+    def __iter__(self):
+        return iter((self.disk_quota, self.file_quota))
+
+    def __nonzero__(self):
+        return self.error is None
+
+    @property
+    def disk_quota(self):
+        """(string) Human readable disk limit; None if unlimited."""
+
+        if self.disk_limit is None:
+            return None
+        # The NetApp reports KB, but humanize translates bytes.
+        return humanize.naturalsize(self.disk_limit * 1024, gnu=True)
+
+    @property
+    def file_quota(self):
+        """(int) Soft file limit; None if unlimited."""
+
+        return self.file_limit
+
+
+class ResizeJob(QuotaRecord):
+    """Immutable snapshot of a quota resize job on the cluster.
+
+    A ResizeJob is false once the job failed, so "if not job" checks work
+    like they do for QuotaEntry. Poll it with HMDCQuotas.job_status or
+    wait on many with HMDCQuotas.wait_resize_jobs.
+
+    Instance Variables:
+        error (string): Error message of a failed job; None otherwise.
+        jobid (int): Cluster job id; None if the job cannot be tracked.
+        progress (string): Progress message reported by the cluster.
+        started (float): When the resize was started, as a Unix time.
+        state (string): Job state as the cluster reports it, e.g. queued,
+                        running, success or failure; untracked when the
+                        cluster gave no job id, unknown when the job is
+                        no longer known to the cluster.
+        volume (string): The volume being resized.
+        vserver (string): The vserver the volume lives on.
+
+    Class Variables:
+        FAILED (tuple): States of jobs that did not complete.
+        TERMINAL (tuple): States of jobs that will not change any more.
+    """
+
+    FAILED = ('dead', 'error', 'failure', 'quit')
+    TERMINAL = FAILED + ('success', 'unknown', 'untracked')
+
+    __slots__ = ('volume', 'vserver', 'jobid', 'state', 'progress', 'error',
+                 'started')
+
+    def __init__(self, volume, vserver, jobid, state, progress=None,
+                 error=None, started=None):
+        """Sets every field once; the record is read-only afterwards."""
+
+        QuotaRecord.__init__(self, volume, vserver, parse_limit(jobid),
+                             state, progress, error, started)
+
+    def __nonzero__(self):
+        return self.state not in self.FAILED
+
+    @property
+    def done(self):
+        """(boolean) True once the job will not change any more."""
+
+        return self.state in self.TERMINAL
+
+
+class SearchResults(dict):
+    """Search matches keyed by vserver, then volume, that may be partial.
+
+    Behaves exactly like the plain dictionary searches used to return;
+    vservers that could not be searched are listed in unreachable rather
+    than failing the whole search.
+
+    Example:
+        matches = qh.search_vservers(group, policy)
+        for vserver, error in matches.unreachable.iteritems():
+            print(vserver + " was skipped: " + error)
+
+    Instance Variables:
+        unreachable (dictionary): {vserver: error} of skipped vservers.
+    """
+
+    def __init__(self, matches=None, unreachable=None):
+        """Wraps matches and the vservers that could not be searched.
+
+        Arguments:
+            matches (dictionary): QuotaEntry matches by vserver and volume.
+            unreachable (dictionary): {vserver: error} of skipped vservers.
+        """
+
+        dict.__init__(self, matches or {})
+        self.unreachable = dict(unreachable or {})
+
+    @property
+    def complete(self):
+        """(boolean) True if every vserver was searched."""
+
+        return not self.unreachable
+
+
+class QuotaUsage(QuotaRecord):
+    """Immutable row of a quota report: limits plus actual usage.
+
+    Instance Variables:
+        disk_limit (int): Disk limit in KB; None if unlimited.
+        disk_used (int): Disk used in KB.
+        file_limit (int): File limit; None if unlimited.
+        files_used (int): Number of files used.
+        quota_type (string): group, user or tree.
+        soft_disk_limit (int): Soft disk limit in KB; None if unlimited.
+        soft_file_limit (int): Soft file limit; None if unlimited.
+        target (string): Name of the group, user or qtree.
+        tree (string): Qtree the rule applies to; empty for the volume.
+        volume (string): The volume the rule lives on.
+        vserver (string): The vserver the volume lives on.
+    """
+
+    __slots__ = ('target', 'quota_type', 'volume', 'vserver', 'tree',
+                 'disk_used', 'disk_limit', 'soft_disk_limit', 'files_used',
+                 'file_limit', 'soft_file_limit')
+
+    def __init__(self, target, quota_type, volume, vserver, tree, disk_used,
+                 disk_limit, soft_disk_limit, files_used, file_limit,
+                 soft_file_limit):
+        """Sets every field once; the record is read-only afterwards."""
+
+        QuotaRecord.__init__(self, target, quota_type, volume, vserver,
+                             tree or '', parse_limit(disk_used),
+                             parse_limit(disk_limit),
+                             parse_limit(soft_disk_limit),
+                             parse_limit(files_used), parse_limit(file_limit),
+                             parse_limit(soft_file_limit))
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Fleet-wide jobs sharded across a pool of worker processes.
+
+Parsing ZAPI XML is CPU-bound, so in one process a whole-fleet report is
+held back by the GIL no matter how many threads wait on the network. A
+ShardedQuotas splits such jobs into one shard per volume, ordered so that
+every cluster and vserver has work in flight, and runs them on a process
+pool. Each worker builds its own HMDCQuotas, with its own authenticated
+connections and an even share of the throttle limits. Report records come back to the parent in chunks of one page,
+max_records, through a bounded queue, so a report stays streamed however
+large its volumes are; rule scans come back one volume at a time:
+
+    sharded = ShardedQuotas(HMDCQuotas())
+    for record in sharded.report():
+        ...
+    sharded.close()
+
+Every other HMDCQuotas function is passed through to the parent handler.
+"""
+
+from hmdcquotas import HMDCQuotas
+from multiprocessing import cpu_count, Pool, Queue
+from Queue import Empty
+from results import SearchResults
+import signal
+import threading
+
+# Seconds the parent waits on the queue before checking on the workers.
+POLL_INTERVAL = 1.0
+# Report chunks the queue holds per worker before workers wait on the parent.
+QUEUED_CHUNKS = 2
+
+# The HMDCQuotas of a worker process, built once by _init_worker.
+_handler = None
+# Why _init_worker could not build the handler; None if it could.
+_init_error = None
+# Queue the worker sends report chunks to the parent through.
+_queue = None
+
+
+def _init_worker(config_file, endpoints, queue, processes):
+    """Builds the worker's own HMDCQuotas; runs once in each worker.
+
+    Arguments:
+        config_file (string): Conf file of the parent handler.
+        endpoints (dictionary): (host, port) overrides of the parent.
+        processes (int): Number of workers sharing the throttle limits.
+        queue (instance): Queue for report chunks, shared with the parent.
+    """
+
+    global _handler, _init_error, _queue
+
+    # Leave Ctrl-C to the parent, which tears the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _queue = queue
+    try:
+        _handler = HMDCQuotas(config_file=config_file)
+    except Exception as err:
+        # A raising initializer is retried forever by the pool; fail each
+        # shard instead, so the parent hears about it.
+        _init_error = "Shard worker failed to start: " + str(err)
+        return
+    _handler.endpoints = endpoints
+
+    # The conf file caps the whole job, not each worker; limiters are made
+    # on first use, so they pick up the shares.
+    throttle = _handler.throttle
+    if throttle is not None:
+        throttle.svm_max_inflight = max(1, throttle.svm_max_inflight //
+                                        processes)
+        throttle.cluster_max_inflight = max(
+            1, throttle.cluster_max_inflight // processes)
+        throttle.cluster_rate = throttle.cluster_rate / float(processes)
+
+
+def _report_shard(shard):
+    """Worker body for report: streams the usage of one volume.
+
+    Records are sent to the parent through the queue, one page of
+    max_records at a time, as (records, done, error) chunks. The last
+    chunk of a shard has done set, and error set if the report failed.
+
+    Arguments:
+        shard (tuple): volume, vserver, group and quota_type.
+    """
+
+    if _init_error is not None:
+        _queue.put((None, True, _init_error))
+        return
+
+    volume, vserver, group, quota_type = shard
+    chunk = max(1, _handler.options['max_records'])
+    records = []
+
+    try:
+        for record in _handler.report(volume, vserver, group, quota_type):
+            records.append(record)
+            if len(records) >= chunk:
+                _queue.put((records, False, None))
+                records = []
+    except Exception as err:
+        # Anything else would leave the parent waiting for this shard.
+        _queue.put((None, True, str(err)))
+        return
+
+    _queue.put((records, True, None))
+
+
+def _scan_shard(shard):
+    """Worker body for entries: reads every group rule of one volume.
+
+    Arguments:
+        shard (tuple): volume and vserver.
+
+    Returns:
+        ((tuple, list, string)): The shard, then QuotaEntry rules and None
+                                 on success, or None and an error message.
+    """
+
+    if _init_error is not None:
+        return (shard, None, _init_error)
+
+    entries, error = _handler._scan_task(shard)
+    return (shard, entries, error)
+
+
+class ShardedQuotas:
+    """Runs fleet-wide jobs of a handler on a pool of worker processes.
+
+    Public Functions:
+        close: Shuts the worker processes down.
+        entries: Yields every group quota rule, shard by shard.
+        report: Streams quota usage records, shard by shard.
+        search_groups: Finds the quotas of many groups, one scan per volume.
+
+    Private Functions:
+        _next_chunk: Waits for the next report chunk, watching the workers.
+        _shards: Returns the volumes to work on, interleaved by cluster.
+        _start: Starts the worker processes and their report queue.
+
+    Instance Variables:
+        handler (instance): HMDCQuotas that plans the shards and answers
+                            everything else.
+        processes (int): Number of worker processes.
+    """
+
+    def __init__(self, handler, processes=None):
+        """Starts the worker processes.
+
+        Arguments:
+            handler (instance): HMDCQuotas whose conf file the workers read.
+            processes (int): Worker processes; the shard_processes setting,
+                             or one per CPU, if None or 0.
+        """
+
+        self.handler = handler
+        self.processes = (processes or handler.options['shard_processes'] or
+                          cpu_count())
+        # The queue carries one report at a time.
+        self._report_lock = threading.Lock()
+        self._start()
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+    def _next_chunk(self, result, workers):
+        """Waits for the next report chunk, watching the workers meanwhile.
+
+        Arguments:
+            result (instance): AsyncResult of the report's shards.
+            workers (list): Worker processes when the report started.
+
+        Returns:
+            ((list, boolean, string)): records, done and error of the chunk.
+
+        Raises:
+            RuntimeError: When a shard failed or a worker died, so that some
+                          chunks will never come.
+        """
+
+        while True:
+            # Checked before waiting, so chunks queued by shards that had
+            # finished by then have had POLL_INTERVAL to arrive.
+            finished = result.ready()
+            try:
+                return self._queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+
+            if finished:
+                if not result.successful():
+                    try:
+                        result.get()
+                    except Exception as err:
+                        raise RuntimeError("Shard report failed: " +
+                                           str(err))
+                raise RuntimeError("Shard workers finished without "
+                                   "reporting every volume.")
+
+            if not all(worker.is_alive() for worker in workers):
+                raise RuntimeError("A shard worker died mid-report.")
+
+    def _shards(self, volume=None, vserver=None):
+        """Returns the volumes to work on, interleaved by cluster and vserver.
+
+        Taking one volume from each cluster, then each vserver, in turn
+        spreads the first shards over the whole fleet instead of queueing
+        them all on one SVM.
+
+        Arguments:
+            volume (string): Only this volume.
+            vserver (string): Only the volumes of this vserver.
+
+        Returns:
+            (list): (volume, vserver) tuples.
+
+        Raises:
+            RuntimeError: On an unknown volume or vserver
+                          (also sets ERROR_MSG).
+        """
+
+        clusters = self.handler._parse_clusters(
+            self.handler.options['clusters'])
+        queues = {}
+        for name, owner in self.handler._volume_targets(volume, vserver):
+            lanes = queues.setdefault(clusters.get(owner, owner), {})
+            lanes.setdefault(owner, []).append((name, owner))
+
+        # Round robin over clusters, and within each over its vservers.
+        lanes = []
+        for cluster in sorted(queues):
+            lane = []
+            vservers = [queues[cluster][owner]
+                        for owner in sorted(queues[cluster])]
+            while any(vservers):
+                for names in vservers:
+                    if names:
+                        lane.append(names.pop(0))
+            lanes.append(lane)
+
+        shards = []
+        while any(lanes):
+            for lane in lanes:
+                if lane:
+                    shards.append(lane.pop(0))
+
+        return shards
+
+    def close(self):
+        """Shuts the worker processes down."""
+
+        self._pool.close()
+        self._pool.join()
+
+    def _start(self):
+        """Starts the worker processes and their report queue."""
+
+        self._queue = Queue(self.processes * QUEUED_CHUNKS)
+        self._pool = Pool(self.processes, _init_worker,
+                          (self.handler.config_file, self.handler.endpoints,
+                           self._queue, self.processes))
+
+    def entries(self, volume=None, vserver=None):
+        """Yields every group quota rule, shard by shard as workers finish.
+
+        Arguments:
+            volume (string): Only this volume.
+            vserver (string): Only the volumes of this vserver.
+
+        Yields:
+            (instance): QuotaEntry of each volume-level group rule.
+
+        Raises:
+            RuntimeError: When a volume could not be scanned
+                          (also sets ERROR_MSG).
+        """
+
+        for shard, entries, error in self._pool.imap_unordered(
+                _scan_shard, self._shards(volume, vserver)):
+            if entries is None:
+                self.handler.ERROR_MSG = error
+                raise RuntimeError(error)
+            for entry in entries:
+                yield entry
+
+    def report(self, volume=None, vserver=None, group=None,
+               quota_type='group'):
+        """Streams quota usage records, page by page as workers read them.
+
+        Records of one volume arrive in NetApp order, but pages of different
+        volumes interleave. At most QUEUED_CHUNKS pages per worker wait on
+        the parent, so memory stays bounded; a caller that stops early waits
+        for the workers to finish their shards. One report runs at a time.
+
+        Arguments:
+            group (string): Only report this quota target.
+            quota_type (string): Rule type to report: group, user or tree.
+            volume (string): Only report this volume.
+            vserver (string): Only report the volumes of this vserver.
+
+        Yields:
+            (instance): QuotaUsage for each quota rule.
+
+        Raises:
+            RuntimeError: On an unknown volume, a failed query or a failed
+                          or dead worker (also sets ERROR_MSG).
+        """
+
+        shards = [(name, owner, group, quota_type)
+                  for name, owner in self._shards(volume, vserver)]
+
+        with self._report_lock:
+            result = self._pool.map_async(_report_shard, shards)
+            # Workers never retire, so any that stops has died; the pool
+            # replaces it, but its shard is lost. Private, as Pool offers
+            # no other way to tell.
+            workers = list(self._pool._pool)
+            remaining = len(shards)
+
+            try:
+                while remaining:
+                    try:
+                        records, done, error = self._next_chunk(result,
+                                                                workers)
+                    except RuntimeError as err:
+                        self.handler.ERROR_MSG = str(err)
+                        raise
+                    remaining -= done
+                    if error is not None:
+                        self.handler.ERROR_MSG = error
+                        raise RuntimeError(error)
+                    for record in records:
+                        yield record
+            finally:
+                # Drain the shards still running, for the next report.
+                try:
+                    while remaining:
+                        remaining -= self._next_chunk(result, workers)[1]
+                except RuntimeError:
+                    # Chunks of lost shards would leak into the next
+                    # report; start over with fresh workers and queue.
+                    self._pool.terminate()
+                    self._start()
+
+    def search_groups(self, groups, policy=None, volume=None):
+        """Finds the quotas of many groups, one scan per volume, sharded.
+
+        Arguments:
+            groups (list): Names of the LDAP groups.
+            policy (string): Name of the quota policy; default if None.
+            volume (string): Only search this volume.
+
+        Returns:
+            (dictionary/boolean): As HMDCQuotas.search_groups.
+                                  (also sets ERROR_MSG on error)
+        """
+
+        policy = policy or 'default'
+        results = dict((group, SearchResults()) for group in groups)
+
+        try:
+            shards = self._shards(volume)
+        except RuntimeError:
+            return False
+
+        for (name, owner), entries, error in self._pool.imap_unordered(
+                _scan_shard, shards):
+            if entries is None:
+                for matches in results.itervalues():
+                    matches.unreachable[owner] = error
+                continue
+            for entry in entries:
+                if entry.policy == policy and entry.group in results:
+                    results[entry.group].setdefault(owner, {})[name] = entry
+
+        return results
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Offline snapshot of every quota rule and usage row, in an SQLite file.
+
+A snapshot answers read-only questions without touching the filers:
+
+    QuotaSnapshot.capture(qh, '/var/cache/hmdcquotas/snapshot.db')
+    snapshot = QuotaSnapshot('/var/cache/hmdcquotas/snapshot.db')
+    snapshot.search(group, policy)
+    snapshot.usage(min_disk_used=1073741824)
+    QuotaAnalytics.from_snapshot(snapshot)
+"""
+
+from results import QuotaEntry, QuotaUsage, SearchResults
+import os
+import sqlite3
+import tempfile
+import time
+
+DEFAULT_SNAPSHOT = '/var/cache/hmdcquotas/snapshot.db'
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE rules (target TEXT, policy TEXT, volume TEXT, vserver TEXT,
+                    disk_limit INTEGER, file_limit INTEGER);
+CREATE TABLE usage (target TEXT, quota_type TEXT, volume TEXT, vserver TEXT,
+                    tree TEXT, disk_used INTEGER, disk_limit INTEGER,
+                    soft_disk_limit INTEGER, files_used INTEGER,
+                    file_limit INTEGER, soft_file_limit INTEGER);
+CREATE TABLE volumes (volume TEXT, vserver TEXT, size INTEGER);
+"""
+
+# Built after the bulk load, which is faster than maintaining them during it.
+INDEXES = """
+CREATE INDEX rules_target ON rules (target, policy);
+CREATE INDEX usage_target ON usage (target);
+CREATE INDEX usage_disk_used ON usage (disk_used);
+CREATE INDEX usage_disk_limit ON usage (disk_limit);
+"""
+
+
+class QuotaSnapshot:
+    """Read-only view of a quota snapshot file.
+
+    Public Functions:
+        age: Returns the seconds since the snapshot was taken.
+        capture: Writes a new snapshot from a handler (class method).
+        close: Closes the snapshot file.
+        entries: Yields every quota rule.
+        search: Finds a group's rules, shaped like search_vservers results.
+        search_groups: Finds the rules of many groups, like search_groups.
+        usage: Yields usage rows, largest first, optionally filtered.
+        volume_sizes: Returns the size of every volume.
+
+    Instance Variables:
+        path (string): Location of the snapshot file.
+        taken (float): When the snapshot was taken, as a Unix time.
+    """
+
+    def __init__(self, path=DEFAULT_SNAPSHOT):
+        """Opens a snapshot file.
+
+        Arguments:
+            path (string): Location of the snapshot file.
+
+        Raises:
+            IOError: When the file does not exist.
+        """
+
+        if not os.path.exists(path):
+            raise IOError("No quota snapshot at " + path)
+
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self.taken = float(self._db.execute(
+            "SELECT value FROM meta WHERE key = 'taken'").fetchone()[0])
+
+    @classmethod
+    def capture(cls, handler, path=DEFAULT_SNAPSHOT):
+        """Writes a new snapshot from a handler.
+
+        Usage comes from one quota report over every volume; rules come from
+        entries(), one quota-list-entries-iter scan of each volume, and
+        sizes from volume_sizes(). The file is built aside and renamed into
+        place, so readers never see a partial snapshot.
+
+        Arguments:
+            handler (instance): HMDCQuotas, ShardedQuotas or QuotaClient
+                                to read from.
+            path (string): Location of the snapshot file.
+
+        Returns:
+            ((int, int)): Number of rules and usage rows saved.
+
+        Raises:
+            RuntimeError: When a scan fails; the old snapshot is kept.
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(handle)
+
+        try:
+            db = sqlite3.connect(temp_path)
+            db.executescript(SCHEMA)
+
+            usage = 0
+            for record in handler.report():
+                db.execute("INSERT INTO usage VALUES "
+                           "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           [getattr(record, name)
+                            for name in QuotaUsage.__slots__])
+                usage += 1
+
+            rules = 0
+            for entry in handler.entries():
+                db.execute("INSERT INTO rules VALUES (?, ?, ?, ?, ?, ?)",
+                           (entry.group, entry.policy, entry.volume,
+                            entry.vserver, entry.disk_limit,
+                            entry.file_limit))
+                rules += 1
+
+            for vserver, sizes in handler.volume_sizes().iteritems():
+                for volume, size in sizes.iteritems():
+                    db.execute("INSERT INTO volumes VALUES (?, ?, ?)",
+                               (volume, vserver, size))
+
+            db.executescript(INDEXES)
+            db.execute("INSERT INTO meta VALUES ('taken', ?)",
+                       (repr(time.time()),))
+            db.commit()
+            db.close()
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+        return (rules, usage)
+
+    def age(self):
+        """Returns the seconds since the snapshot was taken.
+
+        Returns:
+            (float): Age of the snapshot.
+        """
+
+        return time.time() - self.taken
+
+    def close(self):
+        """Closes the snapshot file."""
+
+        self._db.close()
+
+    def entries(self):
+        """Yields every quota rule.
+
+        Yields:
+            (instance): QuotaEntry of each rule.
+        """
+
+        for row in self._db.execute("SELECT target, policy, volume, vserver, "
+                                    "disk_limit, file_limit FROM rules"):
+            yield QuotaEntry(*row)
+
+    def search(self, group, policy=None, volume=None):
+        """Finds a group's rules, shaped like search_vservers results.
+
+        Arguments:
+            group (string): Name of the LDAP group.
+            policy (string): Name of the quota policy; default if None.
+            volume (string): Only look on this volume.
+
+        Returns:
+            (instance): SearchResults of QuotaEntry matches keyed by vserver,
+                        then volume.
+        """
+
+        query = ("SELECT target, policy, volume, vserver, disk_limit, "
+                 "file_limit FROM rules WHERE target = ? AND policy = ?")
+        params = [group, policy or 'default']
+
+        if volume is not None:
+            query += " AND volume = ?"
+            params.append(volume)
+
+        matches = SearchResults()
+        for row in self._db.execute(query, params):
+            entry = QuotaEntry(*row)
+            matches.setdefault(entry.vserver, {})[entry.volume] = entry
+
+        return matches
+
+    def search_groups(self, groups, policy=None, volume=None):
+        """Finds the rules of many groups, shaped like search_groups results.
+
+        Arguments:
+            groups (list): Names of the LDAP groups.
+            policy (string): Name of the quota policy; default if None.
+            volume (string): Only look on this volume.
+
+        Returns:
+            (dictionary): {group: SearchResults of QuotaEntry matches}.
+        """
+
+        return dict((group, self.search(group, policy, volume))
+                    for group in groups)
+
+    def usage(self, group=None, volume=None, vserver=None,
+              min_disk_used=None, min_disk_limit=None, limit=None):
+        """Yields usage rows, largest disk usage first, optionally filtered.
+
+        Arguments:
+            group (string): Only rows of this quota target.
+            limit (int): Yield at most this many rows.
+            min_disk_limit (int): Only rows with a disk limit of at least
+                                  this many KB.
+            min_disk_used (int): Only rows using at least this many KB.
+            volume (string): Only rows of this volume.
+            vserver (string): Only rows of this vserver.
+
+        Yields:
+            (instance): QuotaUsage of each matching row.
+        """
+
+        clauses = []
+        params = []
+
+        for column, operator, value in (('target', '=', group),
+                                        ('volume', '=', volume),
+                                        ('vserver', '=', vserver),
+                                        ('disk_used', '>=', min_disk_used),
+                                        ('disk_limit', '>=',
+                                         min_disk_limit)):
+            if value is not None:
+                clauses.append(column + " " + operator + " ?")
+                params.append(value)
+
+        query = "SELECT " + ", ".join(QuotaUsage.__slots__) + " FROM usage"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY disk_used DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        for row in self._db.execute(query, params):
+            yield QuotaUsage(*row)
+
+    def volume_sizes(self):
+        """Returns the size of every volume, shaped like volume_sizes results.
+
+        Returns:
+            (dictionary): {vserver: {volume: size in KB}}.
+        """
+
+        sizes = {}
+        for volume, vserver, size in self._db.execute(
+                "SELECT volume, vserver, size FROM volumes"):
+            sizes.setdefault(vserver, {})[volume] = size
+
+        return sizes
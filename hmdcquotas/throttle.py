@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import threading
+import time
+
+# Error numbers that mean the filer is overloaded: HTTP 429/503 from the
+# servlet. A transport failure or timeout means the filer is unreachable,
+# which the circuit breaker handles, not that it lacks capacity.
+OVERLOAD_ERRNOS = ('429', '503')
+
+
+class AdaptiveLimiter:
+    """Caps in-flight calls, adapting the cap to latency and errors (AIMD).
+
+    Each fast, successful call raises the cap by 1/cap, so about one more
+    slot per round of calls; a slow or failed call halves it, at most once
+    per latency_target so one burst of bad answers counts once.
+
+    Public Functions:
+        acquire: Waits for a free slot and takes it.
+        release: Frees a slot and adapts the cap to the call's outcome.
+        snapshot: Returns the cap and in-flight count.
+    """
+
+    def __init__(self, maximum, minimum=1, latency_target=1.0):
+        """Creates a limiter starting halfway between minimum and maximum.
+
+        Arguments:
+            latency_target (float): Seconds above which a call counts as
+                                    slow.
+            maximum (int): Highest cap.
+            minimum (int): Lowest cap.
+        """
+
+        self.latency_target = latency_target
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(max(self.minimum, self.maximum / 2))
+        self.inflight = 0
+        self._condition = threading.Condition()
+        self._decreased = 0
+
+    def acquire(self):
+        """Waits for a free slot and takes it."""
+
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+
+    def release(self, seconds, overloaded):
+        """Frees a slot and adapts the cap to the call's outcome.
+
+        Arguments:
+            overloaded (boolean): Whether the call failed for lack of
+                                  capacity.
+            seconds (float): Duration of the call; None if it is not held
+                             to the latency target.
+        """
+
+        with self._condition:
+            self.inflight -= 1
+            now = time.time()
+
+            if overloaded or (seconds is not None and
+                              seconds > self.latency_target):
+                if now - self._decreased >= self.latency_target:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+
+    def snapshot(self):
+        """Returns the cap and in-flight count.
+
+        Returns:
+            (dictionary): limit and inflight.
+        """
+
+        with self._condition:
+            return {'limit': int(self.limit), 'inflight': self.inflight}
+
+
+class TokenBucket:
+    """Limits calls to a steady rate, allowing short bursts.
+
+    Public Functions:
+        acquire: Waits for a token and takes it.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Creates a full bucket.
+
+        Arguments:
+            burst (int): Tokens the bucket holds; rate if None.
+            rate (float): Tokens added per second; 0 means unlimited.
+        """
+
+        self.rate = rate
+        self.burst = max(1, burst or int(rate))
+        self.tokens = float(self.burst)
+        self._lock = threading.Lock()
+        self._updated = time.time()
+
+    def acquire(self):
+        """Waits for a token and takes it."""
+
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QuotaThrottle:
+    """Per-vserver and per-cluster admission control for ZAPI calls.
+
+    A call takes a token from its cluster's TokenBucket, then a slot from
+    its vserver's AdaptiveLimiter, then from its cluster's: no slot is held
+    while waiting on the rate limit, and one busy SVM cannot hold cluster
+    capacity while it waits. Only the APIs in
+    latency_apis are held to the latency target, since scans and resizes
+    are slow by nature; every API backs off on overload errors.
+
+    Any object with the same acquire, release and snapshot functions can
+    replace it as HMDCQuotas.throttle.
+
+    Example:
+        throttle = QuotaThrottle(8, 16, 50, 1.0, {'nc-hmdc-svm01-mgmt': 'c1'},
+                                 ('quota-get-entry',))
+        throttle.acquire(vserver)
+        ...
+        throttle.release(vserver, seconds, overloaded, api)
+
+    Public Functions:
+        acquire: Waits until a call to the vserver may be made.
+        release: Reports a finished call and frees its capacity.
+        snapshot: Returns the limits and in-flight counts.
+    """
+
+    def __init__(self, svm_max_inflight, cluster_max_inflight, cluster_rate,
+                 latency_target, clusters=None, latency_apis=()):
+        """Creates the throttle; limiters are made on first use.
+
+        Arguments:
+            cluster_max_inflight (int): Highest in-flight cap per cluster.
+            cluster_rate (float): Calls per second per cluster; 0 is
+                                  unlimited.
+            clusters (dictionary): {vserver: cluster}; a vserver missing
+                                   from it is a cluster of its own.
+            latency_apis (tuple): APIs whose calls count as slow above
+                                  latency_target.
+            latency_target (float): Seconds above which a call is slow.
+            svm_max_inflight (int): Highest in-flight cap per vserver.
+        """
+
+        self.cluster_max_inflight = cluster_max_inflight
+        self.cluster_rate = cluster_rate
+        self.clusters = clusters or {}
+        self.latency_apis = frozenset(latency_apis)
+        self.latency_target = latency_target
+        self.svm_max_inflight = svm_max_inflight
+        self._buckets = {}
+        self._cluster_limiters = {}
+        self._lock = threading.Lock()
+        self._svm_limiters = {}
+
+    def _limiters(self, vserver):
+        """Returns the vserver limiter, cluster limiter and cluster bucket."""
+
+        # Unlisted vservers must not share, and so starve, one cluster.
+        cluster = self.clusters.get(vserver, vserver)
+
+        with self._lock:
+            if vserver not in self._svm_limiters:
+                self._svm_limiters[vserver] = AdaptiveLimiter(
+                    self.svm_max_inflight, 1, self.latency_target)
+            if cluster not in self._cluster_limiters:
+                self._cluster_limiters[cluster] = AdaptiveLimiter(
+                    self.cluster_max_inflight, 1, self.latency_target)
+                self._buckets[cluster] = TokenBucket(self.cluster_rate)
+
+            return (self._svm_limiters[vserver],
+                    self._cluster_limiters[cluster],
+                    self._buckets[cluster])
+
+    def acquire(self, vserver):
+        """Waits until a call to the vserver may be made.
+
+        Arguments:
+            vserver (string): The vserver about to be called.
+        """
+
+        svm, cluster, bucket = self._limiters(vserver)
+        bucket.acquire()
+        svm.acquire()
+        cluster.acquire()
+
+    def release(self, vserver, seconds, overloaded, api=None):
+        """Reports a finished call and frees its capacity.
+
+        Arguments:
+            api (string): Name of the ZAPI called; only those in
+                          latency_apis are judged by their duration.
+            overloaded (boolean): Whether the call failed for lack of
+                                  capacity.
+            seconds (float): Duration of the call.
+            vserver (string): The vserver that was called.
+        """
+
+        svm, cluster, bucket = self._limiters(vserver)
+        if api not in self.latency_apis:
+            seconds = None
+        cluster.release(seconds, overloaded)
+        svm.release(seconds, overloaded)
+
+    def snapshot(self):
+        """Returns the limits and in-flight counts.
+
+        Returns:
+            (dictionary): vservers and clusters, each {name: limiter
+                          snapshot}.
+        """
+
+        with self._lock:
+            svms = self._svm_limiters.items()
+            clusters = self._cluster_limiters.items()
+
+        return {'vservers': dict((name, limiter.snapshot())
+                                 for name, limiter in svms),
+                'clusters': dict((name, limiter.snapshot())
+                                 for name, limiter in clusters)}
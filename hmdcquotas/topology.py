@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class QuotaTopology:
+    """Map of SVMs to their volumes, persisted to a JSON cache file.
+
+    The map is replaced as a whole, never edited in place, so readers can
+    use the volumes and owners dictionaries without taking the lock.
+
+    Example:
+        topology = QuotaTopology('/var/cache/hmdcquotas/topology.json',
+                                 86400, HMDCQuotas.VOLUMES)
+        topology.load()
+        vserver = topology.vserver_of(volume)
+
+    Public Functions:
+        is_stale: Reports whether the map is older than the TTL.
+        load: Reads the map from the cache file.
+        replace: Swaps in a freshly discovered map.
+        save: Atomically writes the map to the cache file.
+        vserver_of: Returns the SVM owning a volume.
+
+    Instance Variables:
+        discovered (float): When the map was discovered; for the seed, when
+                            it was installed.
+        owners (dictionary): {volume: vserver}, built from volumes.
+        path (string): Cache file; None to keep the map in memory only.
+        seeded (boolean): Whether the map is still the seed, neither read
+                          from the cache file nor discovered.
+        ttl (int): Seconds the map stays fresh.
+        volumes (dictionary): {vserver: (volume, ...)}.
+    """
+
+    def __init__(self, path, ttl, seed):
+        """Starts from the seed map; call load() to read the cache file.
+
+        The seed counts as fresh, so a handler without a cache file does
+        not contact every SVM as soon as it is built; only a cached map
+        past its TTL, or discover_volumes(), triggers a discovery.
+
+        Arguments:
+            path (string): Cache file; None or empty to disable it.
+            seed (dictionary): SVMs with their respective volumes.
+            ttl (int): Seconds the map stays fresh.
+        """
+
+        self.path = path or None
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._set(seed, time.time())
+        self.seeded = True
+
+    def _set(self, volumes, discovered):
+        """Installs a map and its volume index."""
+
+        volumes = dict((vserver, tuple(names))
+                       for vserver, names in volumes.iteritems())
+        owners = dict((name, vserver)
+                      for vserver, names in volumes.iteritems()
+                      for name in names)
+
+        # Index first, so a reader never sees a volume without its owner.
+        self.owners = owners
+        self.volumes = volumes
+        self.discovered = discovered
+
+    def is_stale(self):
+        """Reports whether the map is older than the TTL.
+
+        Returns:
+            (boolean): True if the map should be rediscovered.
+        """
+
+        return self.discovered + self.ttl < time.time()
+
+    def load(self):
+        """Reads the map from the cache file.
+
+        Returns:
+            (boolean): True if the file was read, False if it is missing
+                       or unreadable; the current map is kept then.
+        """
+
+        if self.path is None:
+            return False
+
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+            volumes = data['volumes']
+            discovered = float(data['discovered'])
+        except (IOError, OSError, KeyError, TypeError, ValueError):
+            return False
+
+        with self._lock:
+            self._set(dict((str(vserver), [str(name) for name in names])
+                           for vserver, names in volumes.iteritems()),
+                      discovered)
+            self.seeded = False
+        return True
+
+    def replace(self, volumes):
+        """Swaps in a freshly discovered map.
+
+        Arguments:
+            volumes (dictionary): SVMs with their respective volumes.
+        """
+
+        with self._lock:
+            self._set(volumes, time.time())
+            self.seeded = False
+
+    def save(self):
+        """Atomically writes the map to the cache file.
+
+        Raises:
+            IOError/OSError: When the file or its directory is not writable.
+        """
+
+        if self.path is None:
+            return
+
+        with self._lock:
+            content = json.dumps({'discovered': self.discovered,
+                                  'volumes': self.volumes},
+                                 indent=2, sort_keys=True)
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as output:
+            output.write(content)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, self.path)
+
+    def vserver_of(self, volume):
+        """Returns the SVM owning a volume.
+
+        Arguments:
+            volume (string): Name of the volume.
+
+        Returns:
+            (string/None): Name of the vserver; None if the volume is unknown.
+        """
+
+        return self.owners.get(volume)
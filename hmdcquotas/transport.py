@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+from NaServer import *
+from resilience import TRANSPORT_ERRNO
+import base64
+import errno
+import httplib
+import re
+import socket
+import ssl
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+
+def failed_result(errno, reason):
+    """Builds a failed result, as NaServer does for transport errors.
+
+    Arguments:
+        errno (int): Error number.
+        reason (string): Error message.
+
+    Returns:
+        (instance): NaElement results with status failed.
+    """
+
+    result = NaElement('results')
+    result.attr_set('status', 'failed')
+    result.attr_set('reason', reason)
+    result.attr_set('errno', str(errno))
+    return result
+
+
+class ZapiConnectionPool:
+    """Keeps idle keep-alive HTTP(S) connections to one host for reuse.
+
+    Example:
+        pool = ZapiConnectionPool(host, 443, 'HTTPS', 4, 60)
+        conn, reused = pool.acquire()
+        ...
+        pool.release(conn)
+
+    Public Functions:
+        acquire: Returns an idle connection, or opens a new one.
+        close: Closes every idle connection.
+        discard: Closes a connection instead of returning it to the pool.
+        release: Returns a healthy connection to the pool.
+    """
+
+    def __init__(self, host, port, transport_type, size, idle_timeout,
+                 timeout=None):
+        """Creates an empty pool; connections are opened on demand.
+
+        Arguments:
+            host (string): Host name of the management LIF.
+            idle_timeout (int): Seconds before an idle connection is dropped.
+            port (int): TCP port of the ZAPI endpoint.
+            size (int): Maximum number of idle connections kept open.
+            timeout (float): Socket timeout in seconds for connecting and
+                             each read; None waits forever.
+            transport_type (string): HTTP or HTTPS.
+        """
+
+        self.host = host
+        self.idle_timeout = idle_timeout
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.transport_type = transport_type
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Opens a new connection to the host.
+
+        Returns:
+            (instance): Unconnected httplib connection.
+        """
+
+        if self.transport_type == 'HTTP':
+            return httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+        # Matches the NMSDK default of not verifying the server certificate.
+        context = ssl._create_unverified_context()
+        return httplib.HTTPSConnection(self.host, self.port,
+                                       timeout=self.timeout, context=context)
+
+    def acquire(self):
+        """Returns an idle connection, or opens a new one.
+
+        Returns:
+            ((instance, boolean)): The connection, and whether it was reused.
+        """
+
+        now = time.time()
+
+        with self._lock:
+            while self._idle:
+                conn, released = self._idle.pop()
+                if now - released < self.idle_timeout:
+                    return (conn, True)
+                conn.close()
+
+        return (self._open(), False)
+
+    def close(self):
+        """Closes every idle connection."""
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn, released in idle:
+            conn.close()
+
+    def discard(self, conn):
+        """Closes a connection instead of returning it to the pool.
+
+        Arguments:
+            conn (instance): Connection that hit an error.
+        """
+
+        conn.close()
+
+    def release(self, conn):
+        """Returns a healthy connection to the pool.
+
+        Arguments:
+            conn (instance): Connection whose response was fully read.
+        """
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+
+        conn.close()
+
+
+class ZapiTransport:
+    """Drop-in for NaServer.invoke/invoke_elem over pooled connections.
+
+    NaServer opens a new TCP and TLS session for every call. This sends the
+    same ZAPI envelope over keep-alive connections from a ZapiConnectionPool
+    and returns NaElement results, so callers cannot tell the difference.
+
+    Example:
+        svm = ZapiTransport(vserver, 1, 20, username, password)
+        svm.invoke('quota-resize', 'volume', volume)
+
+    Public Functions:
+        close: Closes the pooled connections.
+        invoke: Builds and sends a flat ZAPI request.
+        invoke_elem: Sends a prebuilt NaElement request.
+
+    Private Functions:
+        _envelope: Wraps a request in the ZAPI netapp envelope.
+        _fail_response: Builds a failed result for transport errors.
+        _parse: Converts a ZAPI response document into results.
+        _post: POSTs a document over a pooled connection.
+        _stale: Tells whether an error proves the request was never served.
+        _tag: Strips the ZAPI XML namespace from a tag name.
+        _to_element: Converts an ElementTree node into an NaElement.
+
+    Instance Variables:
+        idempotent_apis (tuple): ZAPIs safe to resend after any error on a
+                                 reused connection.
+        pool (instance): ZapiConnectionPool of the keep-alive connections.
+        server (string): Host name of the management LIF.
+        version (string): ZAPI version sent in every envelope.
+
+    Class Variables:
+        URL (string): ZAPI servlet path on the management LIF.
+    """
+
+    URL = '/servlets/netapp.servlets.admin.XMLrequest_filer'
+
+    def __init__(self, server, major, minor, username, password,
+                 pool_size=4, idle_timeout=60, transport_type='HTTPS',
+                 port=None, timeout=None, idempotent_apis=()):
+        """Prepares the transport; no connection is opened until used.
+
+        Arguments:
+            idempotent_apis (tuple): ZAPIs safe to resend after any error
+                                     on a reused connection.
+            idle_timeout (int): Seconds before an idle connection is dropped.
+            major (int): ZAPI major version.
+            minor (int): ZAPI minor version.
+            password (string): NetApp password.
+            pool_size (int): Maximum number of idle connections kept open.
+            port (int): TCP port; the transport default if None.
+            server (string): Host name of the management LIF.
+            timeout (float): Socket timeout in seconds; None waits forever.
+            transport_type (string): HTTP or HTTPS.
+            username (string): NetApp username.
+        """
+
+        if port is None:
+            port = 80 if transport_type == 'HTTP' else 443
+
+        self.idempotent_apis = idempotent_apis
+        self.server = server
+        self.version = str(major) + '.' + str(minor)
+        self.pool = ZapiConnectionPool(server, port, transport_type,
+                                       pool_size, idle_timeout, timeout)
+        self._auth = 'Basic ' + base64.b64encode(username + ':' + password)
+
+    def _envelope(self, encoded):
+        """Wraps a request in the ZAPI netapp envelope.
+
+        Arguments:
+            encoded (string): The NaElement request, encoded.
+
+        Returns:
+            (string): Complete XML document to POST.
+        """
+
+        return ("<?xml version='1.0' encoding='utf-8'?>" +
+                "<!DOCTYPE netapp SYSTEM 'file:/etc/netapp_filer.dtd'>" +
+                "<netapp version='" + self.version + "' " +
+                "xmlns='http://www.netapp.com/filer/admin'>" +
+                encoded + "</netapp>")
+
+    def _fail_response(self, errno, reason):
+        """Builds a failed result, as NaServer does for transport errors.
+
+        Arguments:
+            errno (int): Error number.
+            reason (string): Error message.
+
+        Returns:
+            (instance): NaElement results with status failed.
+        """
+
+        return failed_result(errno, reason)
+
+    def _parse(self, body):
+        """Converts a ZAPI response document into an NaElement results.
+
+        Arguments:
+            body (string): Raw XML response.
+
+        Returns:
+            (instance): NaElement results, or a failed result.
+        """
+
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError as err:
+            return self._fail_response(TRANSPORT_ERRNO,
+                                       "Unparseable response: " + str(err))
+
+        for node in root:
+            if self._tag(node) == 'results':
+                return self._to_element(node)
+
+        return self._fail_response(TRANSPORT_ERRNO,
+                                   "No results element in response")
+
+    def _post(self, body, idempotent=False):
+        """POSTs a document over a pooled connection.
+
+        A reused connection may have been closed by the filer while idle.
+        The request is resent once, on a fresh connection, when the error
+        proves the filer never served it, or for an idempotent request on
+        any error but a timeout. Anything else could apply a change twice.
+
+        Arguments:
+            body (string): XML document to send.
+            idempotent (boolean): The request is safe to send twice.
+
+        Returns:
+            ((int, string, string)): HTTP status, reason and response body.
+        """
+
+        retried = False
+
+        while True:
+            conn, reused = self.pool.acquire()
+            responded = False
+            try:
+                conn.request('POST', self.URL, body,
+                             {'Authorization': self._auth,
+                              'Content-Type': 'text/xml; charset="UTF-8"'})
+                response = conn.getresponse()
+                responded = True
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as err:
+                self.pool.discard(conn)
+                # A timeout means the filer is slow, not that it closed an
+                # idle connection.
+                if (reused and not retried and
+                        not isinstance(err, socket.timeout) and
+                        (idempotent or
+                         (not responded and self._stale(err)))):
+                    retried = True
+                    continue
+                raise
+
+            if response.will_close:
+                self.pool.discard(conn)
+            else:
+                self.pool.release(conn)
+
+            return (response.status, response.reason, data)
+
+    def _stale(self, err):
+        """Tells whether an error proves the filer closed an idle connection.
+
+        The filer closes an idle keep-alive connection without reading what
+        is sent on it, so the connection is reset, or closed before the
+        first byte of a response.
+
+        Arguments:
+            err (instance): Error raised before any response was read.
+
+        Returns:
+            (boolean): True if the request was never served.
+        """
+
+        if isinstance(err, httplib.BadStatusLine):
+            # Closed without sending a single byte.
+            return not (err.line or '').strip("'\"")
+        if isinstance(err, socket.error):
+            return err.errno in (errno.ECONNRESET, errno.EPIPE)
+        return False
+
+    def _tag(self, node):
+        """Strips the ZAPI XML namespace from a tag name."""
+
+        return node.tag.split('}', 1)[-1]
+
+    def _to_element(self, node):
+        """Recursively converts an ElementTree node into an NaElement.
+
+        Arguments:
+            node (instance): ElementTree element.
+
+        Returns:
+            (instance): Equivalent NaElement.
+        """
+
+        children = list(node)
+
+        if children:
+            element = NaElement(self._tag(node))
+            for child in children:
+                element.child_add(self._to_element(child))
+        else:
+            element = NaElement(self._tag(node), node.text or '')
+
+        for key, value in node.attrib.iteritems():
+            element.attr_set(key, value)
+
+        return element
+
+    def close(self):
+        """Closes the pooled connections."""
+
+        self.pool.close()
+
+    def invoke(self, api, *args):
+        """Builds and sends a flat ZAPI request, like NaServer.invoke.
+
+        Arguments:
+            api (string): Name of the ZAPI.
+            args (strings): Alternating child names and values.
+
+        Returns:
+            (instance): NaElement results.
+        """
+
+        request = NaElement(api)
+
+        for i in range(0, len(args), 2):
+            request.child_add_string(args[i], args[i + 1])
+
+        return self.invoke_elem(request)
+
+    def invoke_elem(self, request):
+        """Sends a prebuilt NaElement request, like NaServer.invoke_elem.
+
+        Arguments:
+            request (instance): NaElement request.
+
+        Returns:
+            (instance): NaElement results; failed results on transport
+                        errors, with errno TRANSPORT_ERRNO as NaServer uses.
+        """
+
+        encoded = request.toEncodedString()
+        # The name of the ZAPI is the outermost tag of the request.
+        api = re.match(r"\s*<([^\s/>]+)", encoded).group(1)
+
+        try:
+            status, reason, data = self._post(self._envelope(encoded),
+                                              api in self.idempotent_apis)
+        except (httplib.HTTPException, socket.error) as err:
+            return self._fail_response(TRANSPORT_ERRNO, "Cannot reach " +
+                                       self.server + ": " + str(err))
+
+        if status != 200:
+            return self._fail_response(status, reason)
+
+        return self._parse(data)
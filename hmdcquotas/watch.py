@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Continuous quota monitoring that reports only what changed.
+
+A QuotaWatch runs one streamed quota report per interval and keeps the rows
+of the last one in memory. Each poll compares the new rows with the old and
+emits JSON-ready events only for rows that appeared, changed or vanished,
+and for rows whose disk usage crossed the threshold, in either direction:
+
+    watch = QuotaWatch(qh, threshold=0.9)
+    for event in watch.watch(60):
+        print(json.dumps(event))
+
+Sizes in events are raw KB; nothing is humanized here.
+"""
+
+import time
+
+# Fields of a QuotaUsage that identify its rule rather than its usage.
+KEY_FIELDS = ('quota_type', 'target', 'volume', 'vserver', 'tree')
+
+
+class QuotaWatch:
+    """Polls quota reports and emits events for the rows that changed.
+
+    The first poll only sets the baseline: it emits an over event for each
+    row already above the threshold, and nothing else.
+
+    Public Functions:
+        poll: Runs one report and returns the events since the last one.
+        watch: Polls every interval and yields each event.
+
+    Private Functions:
+        _event: Builds one event for a row.
+        _over: Returns whether a row uses more than the threshold.
+
+    Instance Variables:
+        group (string): Only watch this quota target.
+        handler (instance): HMDCQuotas, ShardedQuotas or QuotaClient to
+                            report from.
+        polls (int): Number of polls run so far.
+        rows (dictionary): Fields of each row as of the last poll, keyed by
+                           the KEY_FIELDS of the row.
+        threshold (float): Fraction of the disk limit that counts as over.
+        volume (string): Only watch this volume.
+        vserver (string): Only watch the volumes of this vserver.
+    """
+
+    def __init__(self, handler, threshold=0.9, volume=None, vserver=None,
+                 group=None):
+        """Sets up a watch; nothing is read until the first poll.
+
+        Arguments:
+            group (string): Only watch this quota target.
+            handler (instance): HMDCQuotas, ShardedQuotas or QuotaClient to
+                                report from.
+            threshold (float): Fraction of the disk limit that counts as
+                               over, e.g. 0.9.
+            volume (string): Only watch this volume.
+            vserver (string): Only watch the volumes of this vserver.
+        """
+
+        self.handler = handler
+        self.threshold = threshold
+        self.volume = volume
+        self.vserver = vserver
+        self.group = group
+        self.polls = 0
+        self.rows = {}
+
+    def _event(self, event, fields, now, changes=None):
+        """Builds one event for a row.
+
+        Arguments:
+            changes (dictionary): {field: [old, new]} of a changed row.
+            event (string): added, changed, removed, over or under.
+            fields (dictionary): Fields of the row.
+            now (float): Time of the poll, as a Unix time.
+
+        Returns:
+            (dictionary): The event, made of JSON types only.
+        """
+
+        message = dict(fields, event=event, time=now)
+        if fields.get('disk_limit'):
+            message['utilization'] = (fields['disk_used'] /
+                                      float(fields['disk_limit']))
+        if changes is not None:
+            message['changes'] = changes
+        return message
+
+    def _over(self, fields):
+        """Returns whether a row uses more than the threshold of its limit."""
+
+        return bool(fields['disk_limit'] and fields['disk_used'] >=
+                    self.threshold * fields['disk_limit'])
+
+    def poll(self):
+        """Runs one report and returns the events since the last poll.
+
+        Rows are compared as they stream in, so only the rows that changed
+        are ever copied into events. When the report fails, the last rows
+        are kept and the next poll compares against them.
+
+        Returns:
+            (list): Event dictionaries: the fields of the row, plus event,
+                    time and, for limited rows, utilization; changed events
+                    also carry {field: [old, new]} under changes.
+
+        Raises:
+            RuntimeError: When the report fails (also sets ERROR_MSG).
+        """
+
+        now = time.time()
+        baseline = not self.polls
+        events = []
+        rows = {}
+
+        for record in self.handler.report(self.volume, self.vserver,
+                                          self.group):
+            fields = record.as_dict()
+            key = tuple(fields[name] for name in KEY_FIELDS)
+            rows[key] = fields
+            previous = self.rows.get(key)
+
+            if baseline:
+                if self._over(fields):
+                    events.append(self._event('over', fields, now))
+                continue
+
+            if previous is None:
+                events.append(self._event('added', fields, now))
+                if self._over(fields):
+                    events.append(self._event('over', fields, now))
+                continue
+
+            if previous == fields:
+                continue
+
+            changes = dict((name, [previous[name], fields[name]])
+                           for name in fields
+                           if previous[name] != fields[name])
+            events.append(self._event('changed', fields, now, changes))
+
+            if self._over(fields) and not self._over(previous):
+                events.append(self._event('over', fields, now))
+            elif self._over(previous) and not self._over(fields):
+                events.append(self._event('under', fields, now))
+
+        if not baseline:
+            for key in sorted(set(self.rows) - set(rows)):
+                events.append(self._event('removed', self.rows[key], now))
+
+        self.rows = rows
+        self.polls += 1
+        return events
+
+    def watch(self, interval, count=None):
+        """Polls every interval and yields each event.
+
+        A failed report yields an error event and is retried at the next
+        interval; the rows of the last good poll are kept.
+
+        Arguments:
+            count (int): Stop after this many polls; never if None.
+            interval (float): Seconds from the start of one poll to the
+                              start of the next.
+
+        Yields:
+            (dictionary): Each event of poll(), or an error event with
+                          event, time and error.
+        """
+
+        polls = 0
+
+        while count is None or polls < count:
+            started = time.time()
+
+            try:
+                events = self.poll()
+            except RuntimeError as err:
+                events = [{'event': 'error', 'time': started,
+                           'error': str(err)}]
+
+            for event in events:
+                yield event
+
+            polls += 1
+            if count is None or polls < count:
+                time.sleep(max(0, started + interval - time.time()))
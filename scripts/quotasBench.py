@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Development"
+
+"""
+Benchmarks the Quotas module against a local FakeZapiServer.
+
+Public Functions:
+    bench: Times one workload and summarizes its latency and call counts.
+    make_handler: Builds an HMDCQuotas pointed at the fake endpoints.
+    percentile: Returns a percentile of a sorted list of timings.
+    print_results: Formats the benchmark summaries as a table.
+"""
+
+from hmdcquotas.fakezapi import FakeZapiServer
+import argparse
+import hmdcquotas
+import hmdclogger
+import json
+import os
+import tempfile
+import time
+
+
+def bench(name, operation, iterations, fake):
+    """Times one workload and summarizes its latency and call counts.
+
+    Arguments:
+        fake (object): FakeZapiServer serving the workload.
+        iterations (int): Number of times to run the operation.
+        name (string): Label of the workload.
+        operation (function): Runs one operation; called with its index.
+
+    Returns:
+        (dictionary): Workload summary.
+    """
+
+    fake.reset_counters()
+    timings = []
+    started = time.time()
+
+    for number in range(iterations):
+        begin = time.time()
+        operation(number)
+        timings.append(time.time() - begin)
+
+    elapsed = time.time() - started
+    timings.sort()
+
+    return {'workload': name,
+            'operations': iterations,
+            'calls_per_op': sum(fake.calls.values()) / float(iterations),
+            'calls': dict(fake.calls),
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'ops_per_sec': iterations / elapsed if elapsed else 0.0}
+
+
+def make_handler(args, fake, hmdclog):
+    """Builds an HMDCQuotas pointed at the fake endpoints.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        fake (object): Started FakeZapiServer.
+        hmdclog (object): HMDCLogger object handler.
+
+    Returns:
+        (object): Quotas object handler.
+    """
+
+    handle, path = tempfile.mkstemp(suffix='.conf')
+    with os.fdopen(handle, 'w') as conf:
+        conf.write("[HMDCQuotas]\n"
+                   "debug_level = NOTSET\n"
+                   "cdot_username = bench\n"
+                   "cdot_password = bench\n"
+                   "cdot_transport = HTTP\n"
+                   "pool_size = " + str(args.pool_size) + "\n"
+                   "max_workers = " + str(args.workers) + "\n"
+                   "job_poll_interval = 0.01\n"
+                   "locality_cache =\n"
+                   "topology_cache =\n"
+                   "topology_ttl = 0\n")
+
+    try:
+        qh = hmdcquotas.HMDCQuotas(hmdclog, config_file=path)
+    finally:
+        os.remove(path)
+
+    qh.endpoints = fake.endpoints
+    return qh
+
+
+def percentile(timings, rank):
+    """Returns a percentile of a sorted list of timings.
+
+    Arguments:
+        rank (int): Percentile, from 0 to 100.
+        timings (list): Sorted timings.
+
+    Returns:
+        (float): The timing at that percentile.
+    """
+
+    if not timings:
+        return 0.0
+    index = int(round(rank / 100.0 * (len(timings) - 1)))
+    return timings[index]
+
+
+def print_results(results):
+    """Formats the benchmark summaries as a table.
+
+    Arguments:
+        results (list): Workload summaries from bench().
+    """
+
+    output = "{0:<15} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10}"
+
+    print output.format("WORKLOAD", "OPS", "CALLS/OP", "P50 MS", "P99 MS",
+                        "OPS/S")
+    for result in results:
+        print output.format(result['workload'], result['operations'],
+                            "%.1f" % result['calls_per_op'],
+                            "%.2f" % result['p50_ms'],
+                            "%.2f" % result['p99_ms'],
+                            "%.1f" % result['ops_per_sec'])
+
+
+parser = argparse.ArgumentParser(
+    description="Benchmark quota operations against a fake ZAPI server.")
+parser.add_argument('-n', '--iterations', type=int, default=50,
+                    help="Operations per workload. (Default: 50)")
+parser.add_argument('-r', '--rules', type=int, default=2000,
+                    help="Synthetic rules per volume. (Default: 2000)")
+parser.add_argument('-l', '--latency', type=float, default=0.005,
+                    help="Seconds of latency per call. (Default: 0.005)")
+parser.add_argument('--jitter', type=float, default=0.0,
+                    help="Extra random seconds per call. (Default: 0)")
+parser.add_argument('--resize-latency', type=float, default=0.05,
+                    help="Seconds each quota resize job runs. "
+                         "(Default: 0.05)")
+parser.add_argument('--failure-rate', type=float, default=0.0,
+                    help="Share of calls that fail, 0 to 1. (Default: 0)")
+parser.add_argument('--batch-size', type=int, default=50,
+                    help="Changes per batch-modify operation. (Default: 50)")
+parser.add_argument('--pool-size', type=int, default=4,
+                    help="Keep-alive connections per SVM. (Default: 4)")
+parser.add_argument('--workers', type=int, default=8,
+                    help="Parallel search workers. (Default: 8)")
+parser.add_argument('--json',
+                    help="Also write the results to this JSON file.")
+args = parser.parse_args()
+
+hmdclog = hmdclogger.HMDCLogger("QuotasBench", 'NOTSET')
+
+fake = FakeZapiServer(hmdcquotas.HMDCQuotas.VOLUMES,
+                      rules_per_volume=args.rules, latency=args.latency,
+                      jitter=args.jitter, resize_latency=args.resize_latency,
+                      failure_rate=args.failure_rate, seed=0)
+fake.start()
+qh = make_handler(args, fake, hmdclog)
+
+# Groups that exist, and one that never does, for the search workloads.
+group = lambda number: 'grp%05d' % (number % args.rules)
+volume = sorted(fake.tables)[0]
+
+results = [
+    bench('single-lookup',
+          lambda number: qh.search_vservers(group(number), None, volume),
+          args.iterations, fake),
+    bench('full-search',
+          lambda number: qh.search_vservers(group(number), None,
+                                            concurrent=True),
+          args.iterations, fake),
+    bench('first-hit',
+          lambda number: qh.search_vservers(group(number), None,
+                                            concurrent=True, first_hit=True),
+          args.iterations, fake),
+    bench('full-miss',
+          lambda number: qh.search_vservers('nosuchgroup', None,
+                                            concurrent=True),
+          args.iterations, fake),
+    bench('batch-modify',
+          lambda number: qh.modify_batch(
+              [{'action': 'modify', 'group': group(number + offset),
+                'volume': volume, 'size': '10G'}
+               for offset in range(args.batch_size)], wait=True),
+          max(1, args.iterations / 10), fake),
+    bench('report',
+          lambda number: sum(1 for record in qh.report()),
+          max(1, args.iterations / 25), fake),
+]
+
+qh.close()
+fake.stop()
+
+print_results(results)
+
+if args.json:
+    with open(args.json, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
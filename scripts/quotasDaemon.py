@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+__author__ = "Harvard-MIT Data Center DevOps"
+__copyright__ = "Copyright 2018, HMDC"
+__credits__ = ["Wesley Harrell", "Bradley Frank"]
+__license__ = "GPL"
+__maintainer__ = "HMDC"
+__email__ = "ops@latte.harvard.edu"
+__status__ = "Production"
+
+"""
+Serves the Quotas module over a Unix domain socket.
+
+One HMDCQuotas with warm connections, caches and topology answers every
+client; quotasUtil.py uses the daemon whenever its socket exists.
+
+Public Functions:
+    housekeeping: Periodically rebuilds the index and writes the metrics.
+    journal_committer: Applies the journaled changes every journal_window.
+    stop: Shuts the daemon down from a signal handler.
+"""
+
+from hmdcquotas.daemon import DEFAULT_SOCKET, QuotaDaemon
+import argparse
+import hmdcquotas
+import hmdclogger
+import signal
+import threading
+import time
+
+
+def housekeeping(args, qh, hmdclog, stopping):
+    """Periodically rebuilds the index and writes the metrics.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        hmdclog (object): HMDCLogger object handler.
+        qh (object): Quotas object handler.
+        stopping (object): Event set when the daemon shuts down.
+    """
+
+    last_index = time.time()
+
+    # Event.wait returns True once the daemon is stopping.
+    while not stopping.wait(max(1, args.metrics_interval)):
+        if (args.index and args.index_interval > 0 and
+                time.time() - last_index >= args.index_interval):
+            hmdclog.log('info', "Rebuilding the index.")
+            qh.build_index()
+            last_index = time.time()
+        if args.metrics:
+            qh.metrics.write(args.metrics, args.metrics_format)
+
+
+def journal_committer(qh, hmdclog, stopping):
+    """Applies the journaled changes every journal_window seconds.
+
+    Changes queued during one window share one resize per volume. The
+    first commit also replays whatever a crash left in the journal.
+
+    Arguments:
+        hmdclog (object): HMDCLogger object handler.
+        qh (object): Quotas object handler.
+        stopping (object): Event set when the daemon shuts down.
+    """
+
+    while not stopping.wait(max(0.1, qh.options['journal_window'])):
+        try:
+            failures = qh.commit_journal()
+        except Exception as err:
+            # Leave the changes in the journal for the next window.
+            hmdclog.log('error', "Journal commit failed: " + str(err))
+            continue
+        for change, error in failures:
+            hmdclog.log('error', "Journaled " + change['action'] + " on " +
+                        change['volume'] + " failed: " + error)
+
+
+def stop(signum, frame):
+    """Shuts the daemon down from a signal handler.
+
+    The socket server must be stopped from another thread than the one
+    serving it, which here is the one receiving the signal.
+    """
+
+    stopping.set()
+    threading.Thread(target=daemon.shutdown).start()
+
+
+parser = argparse.ArgumentParser(
+    description="Serve RCE group quotas over a Unix domain socket.")
+parser.add_argument('-d', '--debug', action='store_true',
+                    help="Enables verbose output.")
+parser.add_argument('-c', '--config',
+                    help="Conf file to read. (Default: /etc/hmdcquotas.conf)")
+parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                    help="Socket to listen on. (Default: " + DEFAULT_SOCKET +
+                         ")")
+parser.add_argument('--mode', default='0660',
+                    help="Permissions of the socket, in octal. "
+                         "(Default: 0660)")
+parser.add_argument('--index', action='store_true',
+                    help="Build the group quota index at startup.")
+parser.add_argument('--index-interval', type=int, default=3600,
+                    help="Seconds between index rebuilds; 0 builds it once. "
+                         "(Default: 3600)")
+parser.add_argument('--metrics',
+                    help="Write ZAPI call metrics to this file. (Optional)")
+parser.add_argument('--metrics-format', choices=['json', 'prometheus'],
+                    default='json',
+                    help="Metrics file format. (Default: json)")
+parser.add_argument('--metrics-interval', type=int, default=60,
+                    help="Seconds between metrics writes. (Default: 60)")
+args = parser.parse_args()
+
+debug_level = 'DEBUG' if args.debug else 'NOTSET'
+hmdclog = hmdclogger.HMDCLogger("QuotasDaemon", debug_level)
+hmdclog.log_to_console()
+
+qh = hmdcquotas.HMDCQuotas(hmdclog, config_file=args.config)
+
+# The first run has no topology cache; discover before serving, and before
+# the index, so both cover the volumes that exist now.
+if qh.topology.seeded and qh.options['topology_ttl'] > 0:
+    hmdclog.log('info', "No topology cache; discovering volumes.")
+    if qh.discover_volumes() is False:
+        hmdclog.log('warning', "Serving the built-in topology: " +
+                    qh.ERROR_MSG)
+
+if args.index:
+    hmdclog.log('info', "Building the index.")
+    qh.build_index()
+
+daemon = QuotaDaemon(qh, args.socket, int(args.mode, 8))
+stopping = threading.Event()
+
+signal.signal(signal.SIGINT, stop)
+signal.signal(signal.SIGTERM, stop)
+
+worker = threading.Thread(target=housekeeping,
+                          args=(args, qh, hmdclog, stopping))
+worker.daemon = True
+worker.start()
+
+if qh.journal is not None:
+    committer = threading.Thread(target=journal_committer,
+                                 args=(qh, hmdclog, stopping))
+    committer.daemon = True
+    committer.start()
+
+daemon.serve_forever()
+qh.close()
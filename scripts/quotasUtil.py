@@ -11,17 +11,302 @@ __status__ = "Production"
 """
 Script for manipulating group quotas on the NetApp using the Quotas module.
 
+When quotasDaemon.py is running, requests go to it over its socket rather
+than to the NetApp directly; --local skips the daemon. With --queue, changes
+are only written to the journal, to be applied by the daemon or -a J. With
+--processes, fleet-wide reports, searches, exports, plans and watches are
+sharded across worker processes. -a V rediscovers the SVMs and their
+volumes and saves the topology cache. -a T migrates the rules of one volume to
+another in bulk, and -a W watches usage, printing only what changed. With
+--offline, searches and reports are answered from a snapshot saved by -a E,
+without touching the NetApp at all.
+
 Public Functions:
+    batch_quotas: Applies add/delete/modify changes read from a file.
+    commit_journal: Applies every change queued in the journal.
+    discover_volumes: Rediscovers the SVMs and volumes, saving the cache.
+    export_snapshot: Saves every rule and usage row for offline queries.
+    human_size: Formats a size in KB for display.
+    load_changes: Reads quota changes from a CSV or JSON lines file.
+    load_groups: Reads group names from a file or stdin.
+    migrate_quotas: Copies group rules from one volume to another.
     modify_quota: Preps and calls add/delete/modify NetApp queries.
+    parse_size: Converts a size with unit into KB for argparse.
+    plan_capacity: Prints fleet overcommit, top consumers and percentiles.
+    print_changes: Formats reconcile changes as a diff.
     print_quotas: Formats the quota results for printing to console.
+    print_resize: Prints the progress of a quota resize job.
+    reconcile_quotas: Syncs the NetApp with a desired state file.
+    report_quotas: Streams quota usage records as CSV or JSON lines.
+    resize_progress: Returns the progress callback for resize jobs.
     search_quotas: Preps and calls search NetApp queries.
+    watch_quotas: Streams quota changes and threshold crossings as JSON.
 """
 
 ERROR_MSG = ""
 
+from hmdcquotas.analytics import QuotaAnalytics, TOP_KEYS
+from hmdcquotas.daemon import DEFAULT_SOCKET, QuotaClient
+from hmdcquotas.shard import ShardedQuotas
+from hmdcquotas.snapshot import DEFAULT_SNAPSHOT, QuotaSnapshot
+from hmdcquotas.watch import QuotaWatch
 import hmdcquotas
 import hmdclogger
 import argparse
+import csv
+import humanize
+import json
+import os
+import re
+import socket
+import sys
+import time
+
+# Batch file actions, by their short or long names.
+BATCH_ACTIONS = {'A': 'add', 'D': 'delete', 'M': 'modify',
+                 'ADD': 'add', 'DELETE': 'delete', 'MODIFY': 'modify'}
+
+
+def batch_quotas(args, qh, hmdclog):
+    """Applies a file of quota changes, resizing each volume only once.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True if every change was applied, False otherwise.
+    """
+
+    changes = load_changes(args.batch)
+    if changes is False:
+        return False
+
+    if args.queue:
+        failures = qh.queue_changes(changes)
+        if failures is False:
+            print("Error: " + qh.ERROR_MSG)
+            return False
+        for change, error in failures:
+            print("Error: " + change['action'] + " " +
+                  str(change.get('group', '')) + " on " + change['volume'] +
+                  ": " + error)
+        print(str(len(changes) - len(failures)) + " of " + str(len(changes)) +
+              " changes queued.")
+        return not failures
+
+    hmdclog.log('info', "Applying " + str(len(changes)) + " changes.")
+    failures = qh.modify_batch(changes, wait=args.wait,
+                               progress=resize_progress(args, qh))
+
+    for change, error in failures:
+        print("Error: " + change['action'] + " " +
+              str(change.get('group', '')) + " on " + change['volume'] +
+              ": " + error)
+
+    print(str(len(changes) - len(failures)) + " of " + str(len(changes)) +
+          " changes applied.")
+    return not failures
+
+
+def commit_journal(args, qh, hmdclog):
+    """Applies every change queued in the journal, replaying after a crash.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True if everything was applied, False otherwise.
+    """
+
+    failures = qh.commit_journal(wait=args.wait,
+                                 progress=resize_progress(args, qh))
+
+    if failures is False:
+        print("Error: " + qh.ERROR_MSG)
+        return False
+
+    for change, error in failures:
+        print("Error: " + change['action'] + " " +
+              str(change.get('group', '')) + " on " + change['volume'] +
+              ": " + error)
+
+    if failures:
+        print(str(len(failures)) + " journaled changes or resizes failed.")
+    else:
+        print("Journal committed.")
+    return not failures
+
+
+def discover_volumes(args, qh, hmdclog):
+    """Rediscovers the SVMs and their volumes and saves the topology cache.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True on success or False on failure
+    """
+
+    volumes = qh.discover_volumes()
+    if volumes is False:
+        print("Error: " + qh.ERROR_MSG)
+        return False
+
+    output = "{0:<30} {1}"
+    print(output.format("SVM", "VOLUMES"))
+    for vserver, names in sorted(volumes.iteritems()):
+        print(output.format(vserver, ", ".join(sorted(names))))
+    return True
+
+
+def export_snapshot(args, qh, hmdclog):
+    """Saves every quota rule and usage row for offline queries.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True on success or False on failure
+    """
+
+    try:
+        rules, usage = QuotaSnapshot.capture(qh, args.snapshot)
+    except (RuntimeError, IOError, OSError) as err:
+        hmdclog.log('error', str(err))
+        print("Error: " + str(err))
+        return False
+
+    print("Saved " + str(rules) + " rules and " + str(usage) +
+          " usage rows to " + args.snapshot + ".")
+    return True
+
+
+def human_size(size):
+    """Formats a size in KB for display, the way search results are.
+
+    Arguments:
+        size (int): Size in KB; None if unlimited or unknown.
+
+    Returns:
+        (string): Human readable size, or - for None.
+    """
+
+    if size is None:
+        return "-"
+    return humanize.naturalsize(size * 1024, gnu=True)
+
+
+def load_changes(path, actions=True):
+    """Reads quota changes from a CSV or JSON lines file.
+
+    CSV files need a header row; both formats use the fields action, group,
+    volume, and optionally policy, size and files. Files ending in .csv are
+    read as CSV, anything else as one JSON object per line.
+
+    Arguments:
+        actions (boolean): Require an action per row; False for desired
+                           state files, which have none.
+        path (string): Location of the batch file.
+
+    Returns:
+        (list/boolean): Change dictionaries on success, False on failure.
+    """
+
+    changes = []
+
+    with open(path) as batch_file:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(batch_file))
+        else:
+            rows = [json.loads(line) for line in batch_file if line.strip()]
+
+    for number, row in enumerate(rows, 1):
+        # Blank CSV cells mean "use the default".
+        change = dict((key, value) for key, value in row.iteritems()
+                      if value not in ('', None))
+        action = str(change.get('action', '')).upper()
+
+        if actions and action not in BATCH_ACTIONS:
+            print("Error: Unhandled action on line " + str(number) + ".")
+            return False
+        if 'group' not in change or 'volume' not in change:
+            print("Error: Missing group or volume on line " +
+                  str(number) + ".")
+            return False
+
+        if actions:
+            change['action'] = BATCH_ACTIONS[action]
+        if 'files' in change:
+            change['files'] = int(change['files'])
+        changes.append(change)
+
+    return changes
+
+
+def load_groups(path):
+    """Reads group names, one per line, from a file or stdin.
+
+    Blank lines and lines starting with # are skipped.
+
+    Arguments:
+        path (string): Location of the file; - reads stdin.
+
+    Returns:
+        (list): Group names, in file order.
+    """
+
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as handle:
+            lines = handle.readlines()
+
+    return [line.strip() for line in lines
+            if line.strip() and not line.strip().startswith('#')]
+
+
+def migrate_quotas(args, qh, hmdclog):
+    """Copies group rules from one volume to another.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True if nothing failed, False otherwise.
+    """
+
+    result = qh.migrate(args.volume, args.target, pattern=args.pattern,
+                        policy=args.policy, dry_run=args.dry_run,
+                        wait=args.wait, progress=resize_progress(args, qh))
+    if result is False:
+        print("Error: " + qh.ERROR_MSG)
+        return False
+
+    changes, failures = result
+    print_changes(changes)
+
+    for change, error in failures:
+        print("Error: " + change['action'] + " " +
+              str(change.get('group', '')) + " on " + change['volume'] +
+              ": " + error)
+
+    if args.dry_run:
+        print(str(len(changes)) + " changes needed.")
+    else:
+        print(str(len(changes)) + " changes needed, " + str(len(failures)) +
+              " failures.")
+    return not failures
+
 
 def modify_quota(args, qh, hmdclog):
     """Checks requirements, then calls appropriate function from Quotas module.
@@ -36,6 +321,8 @@ def modify_quota(args, qh, hmdclog):
                        (also sets ERROR_MSG on error)
     """
 
+    global ERROR_MSG
+
     # Volume is required because of duplicate group names.
     if args.volume is None:
         hmdclog.log('error', "No volume specified in query")
@@ -45,6 +332,7 @@ def modify_quota(args, qh, hmdclog):
     # Find the right vserver to use.
     vserver = qh.get_vserver(args.volume)
     if not vserver:
+        ERROR_MSG = "Error: " + qh.ERROR_MSG
         return False
 
     # Determine specific modify action (add/delete/modify).
@@ -58,31 +346,269 @@ def modify_quota(args, qh, hmdclog):
         ERROR_MSG = "Unhandled action."
         return False
 
+    # Only record the change; it is applied at the next journal commit.
+    if args.queue:
+        failures = qh.queue_changes([{'action': action, 'group': args.group,
+                                      'volume': args.volume,
+                                      'vserver': vserver,
+                                      'policy': args.policy,
+                                      'size': args.size,
+                                      'files': args.files}])
+        if failures is False:
+            ERROR_MSG = "Error: " + qh.ERROR_MSG
+            return False
+        return True
+
     # Perform the NetApp quota change.
     result = qh.modify(action, args.group, args.volume, vserver,
                        args.policy, args.size, args.files)
     if not result:
-        ERROR_MSG = "An error occurred while modifying quota: " + qh.ERROR_MSG
+        ERROR_MSG = "An error occurred while modifying quota: " + result.error
         return False
     else:
         return True
 
 
-def print_quotas(results):
+def parse_size(size):
+    """Converts a size with unit, e.g. 2T, into KB for argparse.
+
+    Arguments:
+        size (string): Size with a K, M, G or T unit.
+
+    Returns:
+        (int): Size in KB.
+    """
+
+    match = re.match(r"^([0-9]+)([KMGT])[Bb]?$", size, re.I)
+    if not match:
+        raise argparse.ArgumentTypeError("Unreadable size: " + size)
+
+    return int(match.group(1)) * \
+        hmdcquotas.HMDCQuotas.FILESIZES[match.group(2).upper()]
+
+
+def plan_capacity(args, qh, hmdclog):
+    """Prints fleet overcommit, top consumers and utilization percentiles.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler, or a snapshot when offline.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True on success or False on failure
+    """
+
+    try:
+        if args.offline:
+            analytics = QuotaAnalytics.from_snapshot(qh)
+        else:
+            analytics = QuotaAnalytics.from_handler(qh)
+    except (ImportError, RuntimeError) as err:
+        hmdclog.log('error', str(err))
+        print("Error: " + str(err))
+        return False
+
+    summary = analytics.summary()
+    volumes = analytics.overcommit()
+    top = analytics.top(args.top, args.by, args.volume)
+    percentiles = analytics.percentiles(volume=args.volume)
+
+    if args.volume is not None:
+        volumes = [row for row in volumes if row['volume'] == args.volume]
+
+    # Raw KB for programs; humanized only for people.
+    if args.format == 'json':
+        print(json.dumps({'summary': summary, 'volumes': volumes,
+                          'top': top, 'percentiles': percentiles},
+                         sort_keys=True))
+        return True
+
+    print(str(summary['rules']) + " rules on " + str(summary['volumes']) +
+          " volumes commit " + human_size(summary['committed']) + " of " +
+          human_size(summary['size']) + "; " + human_size(summary['used']) +
+          " used.")
+
+    output = "{0:<25} {1:>8} {2:>7} {3:>12} {4:>12} {5:>7}"
+    print("")
+    print(output.format("VOLUME", "SVM", "RULES", "COMMITTED", "SIZE",
+                        "RATIO"))
+    for row in volumes:
+        ratio = "-" if row['ratio'] is None else "%.2f" % row['ratio']
+        print(output.format(row['volume'], row['vserver'].split('-')[1],
+                            row['rules'], human_size(row['committed']),
+                            human_size(row['size'] or None), ratio))
+
+    output = "{0:<15} {1:<25} {2:>12} {3:>12} {4:>12} {5:>6}"
+    print("")
+    print(output.format("GROUP", "VOLUME", "DISK USED", "DISK QUOTA",
+                        "FILES USED", "USED"))
+    for row in top:
+        used = ("-" if row['utilization'] is None else
+                "%d%%" % round(row['utilization'] * 100))
+        print(output.format(row['target'], row['volume'],
+                            human_size(row['disk_used']),
+                            human_size(row['disk_limit']),
+                            row['files_used'], used))
+
+    if percentiles:
+        print("")
+        print("Quota utilization: " + ", ".join(
+            "p%d %d%%" % (point, round(value * 100))
+            for point, value in sorted(percentiles.iteritems())))
+
+    return True
+
+
+def print_changes(changes):
+    """Prints reconcile changes as a diff, one line per rule.
+
+    Each line shows the disk limit in KB and the file limit, before and
+    after; "+" adds, "~" modifies and "-" deletes a rule.
+
+    Arguments:
+        changes (list): Change dictionaries from HMDCQuotas.reconcile.
+    """
+
+    signs = {'add': '+', 'delete': '-', 'modify': '~'}
+
+    for change in changes:
+        line = (signs[change['action']] + " " + change['group'] + " on " +
+                change['volume'])
+        current = change['current']
+        if current is not None:
+            line += (" " + str(current.disk_limit) + "K/" +
+                     str(current.file_limit))
+        if change['action'] != 'delete':
+            line += " -> " + change['size'] + "/" + str(change['files'])
+        print(line)
+
+
+def print_quotas(results, group, header=True):
     """Iterates through the results to print a formatted list of quotas.
 
     Arguments:
+        group (string): Name of the group the results belong to.
+        header (boolean): Print the column names first.
         results (dictionary): Each vserver and volume where quotas were found.
     """
 
     output = "{0:<15} {1:<25} {2:>5} {3:>15} {4:>15}"
 
-    print output.format("GROUP", "VOLUME", "SVM", "DISK QUOTA", "FILE QUOTA")
+    if header:
+        print output.format("GROUP", "VOLUME", "SVM", "DISK QUOTA",
+                            "FILE QUOTA")
     for vserver, volumes in results.iteritems():
         for name, quotas in volumes.iteritems():
             disk_quota, file_quota = quotas
             svm = vserver.split('-')[1]
-            print output.format(args.group, name, svm, disk_quota, file_quota)
+            print output.format(group, name, svm, disk_quota, file_quota)
+    sys.stdout.flush()
+
+
+def print_resize(job):
+    """Prints the progress of a quota resize job.
+
+    Arguments:
+        job (object): ResizeJob whose state changed.
+    """
+
+    line = "Resize of " + job.volume + ": " + job.state
+    if job.progress:
+        line += " (" + job.progress + ")"
+    print(line)
+    sys.stdout.flush()
+
+
+def resize_progress(args, qh):
+    """Returns the progress callback for resize jobs, if there can be one.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+
+    Returns:
+        (function/None): print_resize when waiting on a local handler; the
+                         daemon cannot call back, so None through it.
+    """
+
+    if args.wait and not isinstance(qh, QuotaClient):
+        return print_resize
+    return None
+
+
+def reconcile_quotas(args, qh, hmdclog):
+    """Brings the NetApp in line with a desired state file.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True if nothing failed, False otherwise.
+    """
+
+    desired = load_changes(args.batch, actions=False)
+    if desired is False:
+        return False
+
+    changes, failures = qh.reconcile(desired, prune=args.prune,
+                                     dry_run=args.dry_run, wait=args.wait,
+                                     progress=resize_progress(args, qh))
+    print_changes(changes)
+
+    for change, error in failures:
+        print("Error: " + change.get('action', 'desired') + " " +
+              str(change.get('group', '')) + " on " + change['volume'] +
+              ": " + error)
+
+    if args.dry_run:
+        print(str(len(changes)) + " changes needed.")
+    else:
+        print(str(len(changes)) + " changes needed, " + str(len(failures)) +
+              " failures.")
+    return not failures
+
+
+def report_quotas(args, qh, hmdclog):
+    """Streams quota usage records to stdout as they arrive.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+
+        Returns:
+            (boolean): True on success or False on failure
+    """
+
+    if args.offline:
+        records = qh.usage(args.group, args.volume, args.vserver,
+                           min_disk_used=args.over)
+    else:
+        records = qh.report(args.volume, args.vserver, args.group)
+    writer = None
+
+    try:
+        for record in records:
+            if args.over is not None and record.disk_used < args.over:
+                continue
+            if args.format == 'json':
+                sys.stdout.write(json.dumps(record.as_dict(),
+                                            sort_keys=True) + "\n")
+            else:
+                if writer is None:
+                    writer = csv.DictWriter(sys.stdout, record.__slots__)
+                    writer.writeheader()
+                writer.writerow(record.as_dict())
+            sys.stdout.flush()
+    except RuntimeError as err:
+        hmdclog.log('error', str(err))
+        print("Error: " + str(err))
+        return False
+
+    return True
 
 
 def search_quotas(args, qh, hmdclog):
@@ -93,66 +619,308 @@ def search_quotas(args, qh, hmdclog):
         qh (object): Quotas object handler.
         hmdclog (object): HMDCLogger object handler.
 
+    Many groups are resolved together with one scan per volume; a single
+    group is probed volume by volume, which is cheaper for one.
+
     (also sets ERROR_MSG on error)
     """
 
-    result = qh.search_vservers(args.group, args.policy, args.volume)
+    if len(args.groups) > 1:
+        results = qh.search_groups(args.groups, args.policy, args.volume)
+    elif args.offline:
+        results = {args.group: qh.search(args.group, args.policy,
+                                         args.volume)}
+    else:
+        # Without a volume every SVM is probed, so fan the lookups out.
+        result = qh.search_vservers(args.group, args.policy, args.volume,
+                                    concurrent=args.volume is None,
+                                    first_hit=args.first)
+        results = result if result is False else {args.group: result}
 
-    if not result:
+    if results is False:
         print("Error: " + qh.ERROR_MSG)
-    elif len(result) < 1:
-        ERROR_MSG = "No matches for " + args.group + " were found."
+        return
+
+    # Keep stdout to the records when it is meant for a program.
+    out = sys.stderr if args.format == 'json' else sys.stdout
+
+    # A slow or down SVM is skipped rather than failing the whole search.
+    unreachable = {}
+    for result in results.itervalues():
+        unreachable.update(result.unreachable)
+    for vserver, error in sorted(unreachable.iteritems()):
+        out.write("Warning: " + vserver + " was not searched: " + error +
+                  "\n")
+
+    missing = []
+    header = True
+    for group in args.groups:
+        result = results[group]
+        if len(result) < 1:
+            missing.append(group)
+        elif args.format == 'json':
+            for vserver, volumes in sorted(result.iteritems()):
+                for name, entry in sorted(volumes.iteritems()):
+                    sys.stdout.write(json.dumps(entry.as_dict(),
+                                                sort_keys=True) + "\n")
+            sys.stdout.flush()
+        else:
+            print_quotas(result, group, header)
+            header = False
+
+    if missing:
+        ERROR_MSG = "No matches for " + ", ".join(missing) + " were found."
         hmdclog.log('debug', ERROR_MSG)
-        print(ERROR_MSG)
-    else:
-        print_quotas(result)
+        out.write(ERROR_MSG + "\n")
+
+
+def watch_quotas(args, qh, hmdclog):
+    """Polls quota usage and prints each change as a JSON line.
+
+    Arguments:
+        args (object): Namespace object of parsed arguments.
+        qh (object): Quotas object handler.
+        hmdclog (object): HMDCLogger object handler.
+    """
+
+    watch = QuotaWatch(qh, args.threshold / 100.0, args.volume, args.vserver,
+                       args.group)
 
-# Temporarily instantiate unconfigured Quotas class handler
-#  just to grab some of its internal data
-temp_qh = hmdcquotas.HMDCQuotas()
-vol_list = ()
-vols = temp_qh.VOLUMES
-for volume in vols.itervalues():
-    vol_list = vol_list + volume
-del temp_qh
+    try:
+        for event in watch.watch(args.interval, args.count):
+            print(json.dumps(event, sort_keys=True))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        hmdclog.log('debug', "Watch stopped after " + str(watch.polls) +
+                    " polls.")
 
 # Setup argument parsing with the argparse module.
 parser = argparse.ArgumentParser(description="Manage RCE group quotas.")
 parser.add_argument('-d', '--debug', action='store_true',
                     help="Enables verbose output.")
-parser.add_argument('-a', '--action', required=True, choices=['A', 'D', 'M', 'S'],
-                    help="Add | Delete | Modify | Search")
-parser.add_argument('-g', '--group', required=True,
-                    help="Name of the group.")
-parser.add_argument('-v', '--volume', choices=vol_list,
-                    help="The NetApp volume.")
-del vol_list
+parser.add_argument('-a', '--action', required=True,
+                    choices=['A', 'B', 'C', 'D', 'E', 'J', 'M', 'P', 'R',
+                             'S', 'T', 'V', 'W'],
+                    help="Add | Batch | reConcile | Delete | Export | "
+                         "Journal commit | Modify | capacity Plan | Report | "
+                         "Search | Transfer | Volume discovery | Watch")
+parser.add_argument('-b', '--batch',
+                    help="CSV or JSON lines file of changes, for Batch; "
+                         "of desired rules, for reConcile.")
+parser.add_argument('-g', '--group', action='append',
+                    help="Name of the group; Search takes it repeatedly.")
+parser.add_argument('--groups-file',
+                    help="Search: file of group names, one per line; - reads "
+                         "stdin.")
+# Volumes and SVMs are discovered at run time, so the handler checks them.
+parser.add_argument('-v', '--volume',
+                    help="The NetApp volume; Transfer copies from it.")
+parser.add_argument('--target',
+                    help="Transfer: volume to copy the rules to.")
+parser.add_argument('--pattern',
+                    help="Transfer: only groups matching this shell "
+                         "pattern, e.g. 'lab-*'. (Optional)")
 parser.add_argument('-s', '--size',
                     help="Size of the disk quota.")
 parser.add_argument('-p', '--policy',
                     help="Name of the quota policy to use. (Optional)")
 parser.add_argument('-f', '--files', type=int,
                     help="Maximum number of files. (Optional)")
+parser.add_argument('--wait', action='store_true',
+                    help="Batch/reConcile/Journal/Transfer: wait for the "
+                         "quota resizes to finish.")
+parser.add_argument('--queue', action='store_true',
+                    help="Add/Delete/Modify/Batch: only write the changes to "
+                         "the journal, for the daemon or -a J to apply.")
+parser.add_argument('--dry-run', action='store_true',
+                    help="Reconcile/Transfer: only print the changes "
+                         "needed.")
+parser.add_argument('--prune', action='store_true',
+                    help="Reconcile: delete rules missing from the file.")
+parser.add_argument('--first', action='store_true',
+                    help="Search: stop at the first volume the group is "
+                         "found on, probing where it was last seen first.")
+parser.add_argument('--format', choices=['csv', 'json'], default='csv',
+                    help="Report output format; Search prints JSON lines "
+                         "rather than a table with json. (Default: csv)")
+parser.add_argument('--over', type=parse_size,
+                    help="Report: only rows using at least this much disk, "
+                         "e.g. 2T. (Optional)")
+parser.add_argument('--top', type=int, default=10,
+                    help="Plan: number of top consumers to list. "
+                         "(Default: 10)")
+parser.add_argument('--by', choices=TOP_KEYS, default='disk_used',
+                    help="Plan: how to rank the top consumers. "
+                         "(Default: disk_used)")
+parser.add_argument('--interval', type=float, default=60,
+                    help="Watch: seconds between polls. (Default: 60)")
+parser.add_argument('--threshold', type=float, default=90,
+                    help="Watch: percent of the disk limit that counts as "
+                         "over. (Default: 90)")
+parser.add_argument('--count', type=int,
+                    help="Watch: stop after this many polls. (Optional)")
+parser.add_argument('--offline', action='store_true',
+                    help="Search/Report/Plan: answer from the snapshot "
+                         "instead of the NetApp.")
+parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT,
+                    help="Snapshot file for Export and --offline. "
+                         "(Default: " + DEFAULT_SNAPSHOT + ")")
+parser.add_argument('--metrics',
+                    help="Write ZAPI call metrics to this file. (Optional)")
+parser.add_argument('--metrics-format', choices=['json', 'prometheus'],
+                    default='json',
+                    help="Metrics file format. (Default: json)")
+parser.add_argument('--vserver',
+                    help="Limit a report or watch to one SVM. (Optional)")
+parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                    help="Socket of the quota daemon. (Default: " +
+                         DEFAULT_SOCKET + ")")
+parser.add_argument('--processes', type=int,
+                    help="Report/Search/Export/Plan/Watch: shard the work "
+                         "across this many processes; 0 is one per CPU. "
+                         "Implies --local. (Optional)")
+parser.add_argument('--local', action='store_true',
+                    help="Query the NetApp directly, even if the daemon "
+                         "is running.")
 args = parser.parse_args()
 
+# Every group given with -g or in the groups file, once each, in order.
+args.groups = []
+try:
+    for group in (args.group or []) + (load_groups(args.groups_file)
+                                       if args.groups_file else []):
+        if group not in args.groups:
+            args.groups.append(group)
+except IOError as err:
+    parser.error(str(err))
+args.group = args.groups[0] if args.groups else None
+
+if len(args.groups) > 1 and args.action != 'S':
+    parser.error("Only Search takes more than one group.")
+elif args.action == 'B' and args.batch is None:
+    parser.error("Batch requires a file of changes (-b).")
+elif args.action == 'C' and args.batch is None:
+    parser.error("Reconcile requires a file of desired rules (-b).")
+elif args.action == 'T' and (args.volume is None or args.target is None):
+    parser.error("Transfer requires a source (-v) and a --target volume.")
+elif args.first and (args.action != 'S' or len(args.groups) > 1):
+    parser.error("--first only works with a Search for one group.")
+elif args.queue and args.action not in ('A', 'B', 'D', 'M'):
+    parser.error("--queue only works with Add, Batch, Delete and Modify.")
+elif (args.action not in ('B', 'C', 'E', 'J', 'P', 'R', 'T', 'V', 'W') and
+      args.group is None):
+    parser.error("argument -g/--group is required")
+elif args.offline and args.action not in ('P', 'R', 'S'):
+    parser.error("--offline only works with Plan, Report and Search.")
+elif args.processes is not None and (args.offline or
+                                     args.action not in ('E', 'P', 'R', 'S',
+                                                         'W')):
+    parser.error("--processes only works online, with Export, Plan, Report, "
+                 "Search and Watch.")
+elif args.processes is not None and args.metrics:
+    # The workers make the calls, and their metrics stay in the workers.
+    parser.error("--metrics cannot be combined with --processes.")
+
 # Set logging level based on the debug argument.
 debug_level = 'DEBUG' if args.debug else 'NOTSET'
 hmdclog = hmdclogger.HMDCLogger("QuotasUtil", debug_level)
 hmdclog.log_to_console()
 
-# Instantiate a Quotas class handler.
-qh = hmdcquotas.HMDCQuotas(hmdclog)
+# Offline, the snapshot stands in for the handler; otherwise use the
+# daemon's warm handler if there is one, or build our own.
+qh = None
+if args.offline:
+    try:
+        qh = QuotaSnapshot(args.snapshot)
+    except IOError as err:
+        parser.error(str(err))
+    # On stderr, so that CSV and JSON reports stay machine readable.
+    sys.stderr.write("Snapshot taken " + str(int(qh.age() / 60)) +
+                     " minutes ago, at " +
+                     time.strftime('%Y-%m-%d %H:%M',
+                                   time.localtime(qh.taken)) + ".\n")
+elif (not args.local and args.processes is None and
+      os.path.exists(args.socket)):
+    try:
+        qh = QuotaClient(args.socket)
+        # A daemon that accepts but is dying fails here, where falling back
+        # is still safe, rather than halfway through the action.
+        qh.cache_stats()
+        hmdclog.log('debug', "Using the quota daemon on " + args.socket)
+    except (socket.error, RuntimeError) as err:
+        hmdclog.log('warning', "Quota daemon unavailable: " + str(err))
+        if qh is not None:
+            qh.close()
+            qh = None
 
-# Determine action to perform.
-if args.action == 'S':
-    search_quotas(args, qh, hmdclog)
-else:
-    result = modify_quota(args, qh, hmdclog)
-    if not result:
-        print(ERROR_MSG)
+if qh is None:
+    qh = hmdcquotas.HMDCQuotas(hmdclog)
+    # Workers need their own connections, so never through the daemon.
+    if args.processes is not None:
+        qh = ShardedQuotas(qh, args.processes)
+
+# The daemon can still go away mid-action; that is an error, not a
+# traceback. Retrying locally could apply a change twice.
+try:
+    # Volumes and SVMs are discovered at run time, so check them against the
+    # handler's topology; an unknown one is rediscovered once before failing.
+    if not args.offline and args.action != 'V':
+        for volume in (args.volume, args.target):
+            if volume is not None and not qh.get_vserver(volume):
+                parser.error(qh.ERROR_MSG)
+
+    # Determine action to perform.
+    if args.action == 'S':
+        search_quotas(args, qh, hmdclog)
+    elif args.action == 'B':
+        batch_quotas(args, qh, hmdclog)
+    elif args.action == 'C':
+        reconcile_quotas(args, qh, hmdclog)
+    elif args.action == 'E':
+        export_snapshot(args, qh, hmdclog)
+    elif args.action == 'J':
+        commit_journal(args, qh, hmdclog)
+    elif args.action == 'P':
+        plan_capacity(args, qh, hmdclog)
+    elif args.action == 'R':
+        report_quotas(args, qh, hmdclog)
+    elif args.action == 'T':
+        migrate_quotas(args, qh, hmdclog)
+    elif args.action == 'V':
+        discover_volumes(args, qh, hmdclog)
+    elif args.action == 'W':
+        watch_quotas(args, qh, hmdclog)
     else:
-        if args.action == 'D':
-            print("Quota successfully deleted.")
+        result = modify_quota(args, qh, hmdclog)
+        if not result:
+            print(ERROR_MSG)
+        elif args.queue:
+            print("Quota change queued.")
         else:
-            print("Quota successfully modified.")
-            search_quotas(args, qh, hmdclog)
+            if args.action == 'D':
+                print("Quota successfully deleted.")
+            else:
+                print("Quota successfully modified.")
+                search_quotas(args, qh, hmdclog)
+
+    # Export call timings and counters, e.g. for the node_exporter textfile
+    # collector. The daemon writes its own, cumulative since it started.
+    if args.metrics and not args.offline:
+        if isinstance(qh, QuotaClient):
+            qh.write_metrics(os.path.abspath(args.metrics),
+                             args.metrics_format)
+        else:
+            qh.metrics.write(args.metrics, args.metrics_format)
+except (socket.error, RuntimeError) as err:
+    if not isinstance(qh, QuotaClient):
+        raise
+    hmdclog.log('error', "Quota daemon failed: " + str(err))
+    print("Error: Quota daemon failed: " + str(err))
+    qh.close()
+    sys.exit(1)
+
+# Closing a local handler also writes the group locations it learned.
+if isinstance(qh, ShardedQuotas):
+    qh.close()
+    qh = qh.handler
+qh.close()
@@ -8,7 +8,8 @@ setup(author='Bradley Frank',
       name='HMDCQuotas',
       packages=['hmdcquotas'],
       requires=['ConfigParser','hmdclogger','humanize','re','sys'],
-      scripts=['scripts/quotasUtil.py'],
+      scripts=['scripts/quotasBench.py', 'scripts/quotasDaemon.py',
+               'scripts/quotasUtil.py'],
       url='https://github.com/hmdc/hmdc-quotas',
       version='2.0',
 )